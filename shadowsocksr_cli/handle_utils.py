@@ -7,7 +7,10 @@
 @desc: 提供shadowsocksr节点控制功能工具类
 """
 
+import json
 import signal
+import socket
+import traceback
 from shadowsocksr_cli.shadowsocks import daemon, eventloop, tcprelay, udprelay, asyncdns
 from shadowsocksr_cli.logger import *
 
@@ -45,10 +48,10 @@ class ControlShadowsocksr(object):
             asyncdns.IPV6_CONNECTION_SUPPORT = False
         try:
             daemon.daemon_exec(ssr_dict)
-            dns_resolver = asyncdns.DNSResolver()
+            dns_resolver = ControlShadowsocksr.create_dns_resolver(ssr_dict)
             tcp_server = tcprelay.TCPRelay(ssr_dict, dns_resolver, True)
             udp_server = udprelay.UDPRelay(ssr_dict, dns_resolver, True)
-            loop = eventloop.EventLoop()
+            loop = eventloop.EventLoop(ssr_dict.get('edge_triggered', False))
             dns_resolver.add_to_loop(loop)
             tcp_server.add_to_loop(loop)
             udp_server.add_to_loop(loop)
@@ -62,6 +65,7 @@ class ControlShadowsocksr(object):
 
             def int_handler(signum, _):
                 logger.info("Shadowsocksr is stop")
+                dns_resolver.save_cache()
                 sys.exit(1)
 
             signal.signal(signal.SIGINT, int_handler)
@@ -100,29 +104,287 @@ class ControlShadowsocksr(object):
             asyncdns.IPV6_CONNECTION_SUPPORT = False
         try:
             daemon.daemon_exec(ssr_dict)
-            dns_resolver = asyncdns.DNSResolver()
-            tcp_server = tcprelay.TCPRelay(ssr_dict, dns_resolver, True)
-            udp_server = udprelay.UDPRelay(ssr_dict, dns_resolver, True)
-            loop = eventloop.EventLoop()
-            dns_resolver.add_to_loop(loop)
-            tcp_server.add_to_loop(loop)
-            udp_server.add_to_loop(loop)
+            workers = int(ssr_dict.get('workers', 1))
+            if workers > 1 and hasattr(socket, 'SO_REUSEPORT'):
+                ssr_dict['reuse_port'] = True
+                logger.info('Shadowsocksr is start on {0}:{1} with {2} workers'.format(
+                    kwargs['local_address'], kwargs['local_port'], workers))
+                supervisor = WorkerSupervisor(
+                    workers, lambda report_sock: ControlShadowsocksr.run_local(ssr_dict, report_sock))
+                supervisor.run()
+            else:
+                logger.info('Shadowsocksr is start on {0}:{1}'.format(kwargs['local_address'], kwargs['local_port']))
+                ControlShadowsocksr.run_local(ssr_dict)
+        except Exception as e:
+            logger.error(e)
+            sys.exit(1)
 
-            def handler(signum, _):
-                logger.info('received SIGQUIT, doing graceful shutting down..')
-                tcp_server.close(next_tick=True)
-                udp_server.close(next_tick=True)
+    @staticmethod
+    def create_dns_resolver(ssr_dict):
+        """创建DNS解析器，默认将DNS缓存持久化到配置目录，重启后直接使用未过期的缓存
 
-            signal.signal(getattr(signal, 'SIGQUIT', signal.SIGTERM), handler)
+        :param ssr_dict: shadowsocksr节点信息字典
 
-            def int_handler(signum, _):
-                logger.info("Shadowsocksr is stop")
-                sys.exit(1)
+        """
+        cache_file = None
+        if ssr_dict.get('dns_cache_persist', True):
+            cache_file = init_config.dns_cache_file
+        return asyncdns.DNSResolver(cache_file=cache_file,
+                                    system_resolver=ssr_dict.get('dns_system_resolver', False))
 
-            signal.signal(signal.SIGINT, int_handler)
-            daemon.set_user(ssr_dict.get('user', None))
-            logger.info('Shadowsocksr is start on {0}:{1}'.format(kwargs['local_address'], kwargs['local_port']))
-            loop.run()
-        except Exception as e:
-            logger.error(e)
+    @staticmethod
+    def run_local(ssr_dict, report_sock=None):
+        """在当前进程中运行shadowsocksr本地代理事件循环
+
+        :param ssr_dict: shadowsocksr节点信息字典
+        :param report_sock: 多进程模式下向WorkerSupervisor汇报流量的socket
+
+        """
+        dns_resolver = ControlShadowsocksr.create_dns_resolver(ssr_dict)
+        tcp_server = tcprelay.TCPRelay(ssr_dict, dns_resolver, True)
+        udp_server = udprelay.UDPRelay(ssr_dict, dns_resolver, True)
+        loop = eventloop.EventLoop(ssr_dict.get('edge_triggered', False))
+        dns_resolver.add_to_loop(loop)
+        tcp_server.add_to_loop(loop)
+        udp_server.add_to_loop(loop)
+
+        def handler(signum, _):
+            logger.info('received SIGQUIT, doing graceful shutting down..')
+            tcp_server.close(next_tick=True)
+            udp_server.close(next_tick=True)
+
+        signal.signal(getattr(signal, 'SIGQUIT', signal.SIGTERM), handler)
+
+        def int_handler(signum, _):
+            if report_sock is None:
+                logger.info("Shadowsocksr is stop")
+            dns_resolver.save_cache()
             sys.exit(1)
+
+        signal.signal(signal.SIGINT, int_handler)
+        daemon.set_user(ssr_dict.get('user', None))
+        if report_sock is not None:
+            WorkerSupervisor.report_transfer(loop, report_sock, (tcp_server, udp_server))
+        loop.run()
+
+
+class WorkerSupervisor(object):
+    """shadowsocksr多进程工作模式管理类
+
+    fork出workers个子进程，每个子进程各自以SO_REUSEPORT绑定监听端口并运行
+    独立的事件循环，由内核在子进程之间分配连接。子进程异常退出后自动重启，
+    子进程定期通过socketpair汇报流量，由本类汇总
+
+    属性:
+        transfer_ul: 所有子进程累计上传字节数
+        transfer_dl: 所有子进程累计下载字节数
+    """
+
+    # 子进程汇报流量间隔(秒)
+    REPORT_INTERVAL = 1
+    # 子进程退出后重启前的等待时间(秒)，避免崩溃的子进程被频繁重启
+    RESTART_DELAY = 1
+
+    def __init__(self, workers, target):
+        """
+        :param workers: 子进程数量
+        :param target: 子进程中执行的函数，参数为汇报流量的socket
+        """
+        self._workers = workers
+        self._target = target
+        self._loop = eventloop.EventLoop()
+        self._children = {}  # pid -> (index, report socket)
+        self._fd_to_index = {}
+        self._reported = {}  # index -> (ul, dl), 当前子进程最近一次汇报的值
+        self._exited_ul = 0
+        self._exited_dl = 0
+        self._stopping = False
+
+    @property
+    def transfer_ul(self):
+        return self._exited_ul + sum(ul for ul, dl in self._reported.values())
+
+    @property
+    def transfer_dl(self):
+        return self._exited_dl + sum(dl for ul, dl in self._reported.values())
+
+    @staticmethod
+    def report_transfer(loop, report_sock, relays):
+        """在子进程中定期汇报流量，父进程退出时停止事件循环
+
+        :param loop: 子进程事件循环
+        :param report_sock: 汇报流量的socket
+        :param relays: 需要统计流量的TCPRelay与UDPRelay
+        """
+        supervisor_pid = os.getppid()
+
+        def report():
+            ul = dl = 0
+            for relay in relays:
+                relay_ul, relay_dl = relay.get_ud()
+                ul += relay_ul
+                dl += relay_dl
+            try:
+                report_sock.send(json.dumps([ul, dl]).encode('utf-8'))
+            except (OSError, IOError):
+                pass
+            if os.getppid() != supervisor_pid:
+                logger.error('supervisor exited, worker {0} stopping'.format(os.getpid()))
+                loop.stop()
+                return
+            loop.call_later(WorkerSupervisor.REPORT_INTERVAL, report)
+
+        loop.call_later(WorkerSupervisor.REPORT_INTERVAL, report)
+
+    def _spawn(self, index):
+        if self._stopping:
+            return
+        parent_sock, child_sock = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+        pid = os.fork()
+        if pid == 0:
+            parent_sock.close()
+            for _, sock in self._children.values():
+                sock.close()
+            for signum in (signal.SIGTERM, signal.SIGQUIT, signal.SIGINT):
+                signal.signal(signum, signal.SIG_DFL)
+            code = 1
+            try:
+                self._target(child_sock)
+                code = 0
+            except SystemExit as e:
+                code = e.code if isinstance(e.code, int) else 0
+            except BaseException:
+                traceback.print_exc()
+            finally:
+                os._exit(code)
+        child_sock.close()
+        parent_sock.setblocking(False)
+        self._children[pid] = (index, parent_sock)
+        self._fd_to_index[parent_sock.fileno()] = index
+        self._reported[index] = (0, 0)
+        self._loop.add(parent_sock, eventloop.POLL_IN, self)
+        logger.info('worker {0} started, pid {1}'.format(index, pid))
+
+    def handle_event(self, sock, fd, event):
+        index = self._fd_to_index.get(fd)
+        while True:
+            try:
+                data = sock.recv(64)
+            except (OSError, IOError):
+                break
+            if not data:
+                break
+            try:
+                ul, dl = json.loads(data.decode('utf-8'))
+            except ValueError:
+                continue
+            if index is not None:
+                self._reported[index] = (ul, dl)
+        return True
+
+    def _collect(self, pid):
+        # 读取子进程退出前的最后一次汇报，再把它的流量计入已退出部分
+        index, sock = self._children.pop(pid)
+        self.handle_event(sock, sock.fileno(), eventloop.POLL_IN)
+        del self._fd_to_index[sock.fileno()]
+        self._loop.remove(sock)
+        sock.close()
+        ul, dl = self._reported.pop(index)
+        self._exited_ul += ul
+        self._exited_dl += dl
+        return index
+
+    def _reap(self):
+        while self._children:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError:
+                break
+            if pid == 0 or pid not in self._children:
+                break
+            index = self._collect(pid)
+            if self._stopping:
+                continue
+            logger.error('worker {0} (pid {1}) exited with status {2}, restarting'.format(index, pid, status))
+            self._loop.call_later(self.RESTART_DELAY, self._spawn, index)
+        if not self._stopping:
+            self._loop.call_later(self.REPORT_INTERVAL, self._reap)
+
+    def stop(self, signum=signal.SIGTERM):
+        """停止所有子进程并退出事件循环"""
+        self._stopping = True
+        for pid in list(self._children):
+            try:
+                os.kill(pid, signum)
+            except OSError:  # child may already exited
+                pass
+        self._loop.stop()
+
+    def run(self):
+        """启动子进程并监控，直到收到退出信号"""
+
+        def handler(signum, _):
+            self.stop(signum)
+
+        signal.signal(signal.SIGTERM, handler)
+        signal.signal(getattr(signal, 'SIGQUIT', signal.SIGTERM), handler)
+        signal.signal(signal.SIGINT, handler)
+
+        for index in range(self._workers):
+            self._spawn(index)
+        self._loop.call_later(self.REPORT_INTERVAL, self._reap)
+        self._loop.run()
+
+        for pid in list(self._children):
+            try:
+                os.waitpid(pid, 0)
+            except OSError:
+                pass
+            self._collect(pid)
+        logger.info('Shadowsocksr is stop, upload {0} bytes, download {1} bytes'.format(
+            self.transfer_ul, self.transfer_dl))
+
+
+def test_worker_supervisor():
+    """fork两个子进程，杀掉其中一个，检查它被重启且流量汇报被汇总"""
+
+    def target(report_sock):
+        report_sock.send(json.dumps([10, 20]).encode('utf-8'))
+        time.sleep(60)
+
+    supervisor = WorkerSupervisor(2, target)
+    supervisor.REPORT_INTERVAL = 0.2
+    supervisor.RESTART_DELAY = 0.2
+    checks = {}
+
+    def kill_one():
+        checks['before'] = (supervisor.transfer_ul, supervisor.transfer_dl)
+        checks['killed'] = pid = min(supervisor._children)
+        os.kill(pid, signal.SIGKILL)
+
+    def check_restarted():
+        checks['children'] = sorted(index for index, sock in supervisor._children.values())
+        checks['pids'] = list(supervisor._children)
+        checks['after'] = (supervisor.transfer_ul, supervisor.transfer_dl)
+        supervisor.stop()
+
+    supervisor._loop.call_later(0.6, kill_one)
+    supervisor._loop.call_later(1.8, check_restarted)
+    handlers = [(signum, signal.getsignal(signum))
+                for signum in (signal.SIGTERM, signal.SIGQUIT, signal.SIGINT)]
+    try:
+        supervisor.run()
+    finally:
+        for signum, handler in handlers:
+            signal.signal(signum, handler)
+    assert checks['before'] == (20, 40), checks
+    # 被杀的子进程已重启，最后一次汇报计入已退出部分
+    assert checks['killed'] not in checks['pids'], checks
+    assert checks['children'] == [0, 1], checks
+    assert checks['after'] == (30, 60), checks
+    assert not supervisor._children
+    assert (supervisor.transfer_ul, supervisor.transfer_dl) == (30, 60)
+
+
+if __name__ == '__main__':
+    test_worker_supervisor()
@@ -33,6 +33,7 @@ class InitConfig(object):
         ssr_json: shadowsocksr节点json文件
         pac_file: pac代理文件
         clash_config_file: clash配置文件
+        dns_cache_file: DNS缓存持久化文件
         subscribe_url: shadowsocksr订阅链接
         local_address: shadowsocksr本地监听地址
         timeout: shadowsocksr客户端延迟
@@ -64,6 +65,8 @@ class InitConfig(object):
                                      'autoProxy.pac')
         self.clash_config_file = os.path.join(self.config_dir,
                                               'clashConfig.yaml')
+        self.dns_cache_file = os.path.join(self.config_dir,
+                                           'dns-cache.json')
         self.http_server_pid_file = os.path.join(self.config_dir,
                                                  'httpd.pid')
         self.http_log_file = os.path.join(self.config_dir,
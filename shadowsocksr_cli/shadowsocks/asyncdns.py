@@ -19,12 +19,18 @@ from __future__ import absolute_import, division, print_function, \
     with_statement
 
 import os
+import sys
+import time
+import json
+import mmap
+import zlib
+import errno
 import socket
 import struct
 import re
+import collections
 
 if __name__ == '__main__':
-    import sys
     import inspect
 
     file_path = os.path.dirname(os.path.realpath(inspect.getfile(inspect.currentframe())))
@@ -35,6 +41,42 @@ logging = common.logging
 
 CACHE_SWEEP_INTERVAL = 30
 
+# answers are cached for their TTL clamped to [DNS_MIN_TTL, DNS_MAX_TTL];
+# an expired answer is still served for DNS_STALE_TTL seconds while it is
+# being refreshed
+DNS_MIN_TTL = 30
+DNS_MAX_TTL = 3600
+DNS_STALE_TTL = 300
+# how often a persistent cache is written to its file
+DNS_CACHE_SAVE_INTERVAL = 300
+
+# forked workers can share their answers through a hash table in an
+# anonymous shared mmap, of this many fixed size slots; a hostname is
+# looked for in DNS_SHARED_CACHE_PROBES slots from the one it hashes to
+DNS_SHARED_CACHE_SLOTS = 4096
+DNS_SHARED_CACHE_SLOT_SIZE = 512
+DNS_SHARED_CACHE_PROBES = 8
+
+# a query goes to one server at a time, the one with the lowest smoothed
+# RTT first. If it isn't answered within the server's retransmission
+# timeout it's sent to the next server with the timeout doubled, and
+# given up after DNS_MAX_TRIES sends
+DNS_INITIAL_RTO = 1
+DNS_MIN_RTO = 0.2
+DNS_MAX_RTO = 4
+DNS_MAX_TRIES = 4
+
+# UDP payload size advertised with EDNS0 (rfc6891); an answer that still
+# doesn't fit comes back truncated and is asked again over TCP
+DNS_UDP_PAYLOAD = 1232
+DNS_TCP_TIMEOUT = 5
+BUF_SIZE = 65536
+
+# names DNS can't resolve are handed to the system resolver (nsswitch,
+# mDNS, VPN split DNS ...) on a few threads, at most this many at a time
+GETADDRINFO_WORKERS = 2
+GETADDRINFO_MAX_PENDING = 64
+
 VALID_HOSTNAME = re.compile(br"(?!-)[A-Z\d_-]{1,63}(?<!-)$", re.IGNORECASE)
 
 common.patch_socket()
@@ -75,6 +117,7 @@ QTYPE_A = 1
 QTYPE_AAAA = 28
 QTYPE_CNAME = 5
 QTYPE_NS = 2
+QTYPE_OPT = 41
 QCLASS_IN = 1
 
 
@@ -110,12 +153,15 @@ def build_address(address):
     return b''.join(results)
 
 
-def build_request(address, qtype):
-    request_id = os.urandom(2)
-    header = struct.pack('!BBHHHH', 1, 0, 1, 0, 0, 0)
+def build_request(address, qtype, request_id=None):
+    if request_id is None:
+        request_id = os.urandom(2)
+    header = struct.pack('!BBHHHH', 1, 0, 1, 0, 0, 1)
     addr = build_address(address)
     qtype_qclass = struct.pack('!HH', qtype, QCLASS_IN)
-    return request_id + header + addr + qtype_qclass
+    # EDNS0 OPT record: root name, class is our UDP payload size
+    opt = b'\0' + struct.pack('!HHIH', QTYPE_OPT, DNS_UDP_PAYLOAD, 0, 0)
+    return request_id + header + addr + qtype_qclass + opt
 
 
 def parse_ip(addrtype, data, length, offset):
@@ -236,12 +282,14 @@ def parse_response(data):
                 l, r = parse_record(data, offset)
                 offset += l
             response = DNSResponse()
+            response.id = res_id
+            response.truncated = bool(res_tc)
             if qds:
                 response.hostname = qds[0][0]
             for an in qds:
                 response.questions.append((an[1], an[2], an[3]))
             for an in ans:
-                response.answers.append((an[1], an[2], an[3]))
+                response.answers.append((an[1], an[2], an[3], an[4]))
             return response
     except Exception as e:
         shell.print_exception(e)
@@ -258,26 +306,481 @@ def is_valid_hostname(hostname):
 
 class DNSResponse(object):
     def __init__(self):
+        self.id = None
+        self.truncated = False
         self.hostname = None
         self.questions = []  # each: (addr, type, class)
-        self.answers = []  # each: (addr, type, class)
+        self.answers = []  # each: (addr, type, class, ttl)
 
     def __str__(self):
         return '%s: %s' % (self.hostname, str(self.answers))
 
 
-STATUS_IPV4 = 0
-STATUS_IPV6 = 1
+class DNSCacheEntry(object):
+    __slots__ = ('ips', 'expire', 'stale_expire', 'next')
+
+    def __init__(self, ips, expire, stale_expire):
+        self.ips = ips
+        self.expire = expire
+        self.stale_expire = stale_expire
+        self.next = 0
+
+    def pick(self):
+        # round robin, so connections are spread over all the addresses
+        ip = self.ips[self.next % len(self.ips)]
+        self.next += 1
+        return ip
+
+
+class SharedDNSCache(object):
+    # hostname -> (addresses, expire) in memory shared with the processes
+    # forked after it's created. There is no lock: each slot carries the
+    # crc32 of its content, a slot being written by another process at the
+    # same time fails the check and reads as a miss
+    #
+    # slot: crc32 | length | expire | hostname length | hostname | addresses
+    _header = struct.Struct('<IH')
+    _entry = struct.Struct('<dB')
+
+    def __init__(self, slots=DNS_SHARED_CACHE_SLOTS):
+        self._slots = slots
+        self._mem = mmap.mmap(-1, slots * DNS_SHARED_CACHE_SLOT_SIZE)
+
+    def _offsets(self, hostname):
+        first = zlib.crc32(hostname) % self._slots
+        for i in range(min(DNS_SHARED_CACHE_PROBES, self._slots)):
+            yield ((first + i) % self._slots) * DNS_SHARED_CACHE_SLOT_SIZE
+
+    def _read(self, offset):
+        # (hostname, ips, expire), None for an empty or torn slot
+        mem = self._mem
+        crc, length = self._header.unpack_from(mem, offset)
+        if not length:
+            return None
+        start = offset + self._header.size
+        body = mem[start:start + length]
+        if zlib.crc32(body) != crc:
+            return None
+        expire, name_len = self._entry.unpack_from(body)
+        name_end = self._entry.size + name_len
+        ips = body[name_end:].decode('ascii').split(',')
+        return body[self._entry.size:name_end], ips, expire
+
+    def get(self, hostname):
+        # (ips, expire) of an unexpired entry or None
+        now = time.time()
+        for offset in self._offsets(hostname):
+            item = self._read(offset)
+            if item and item[0] == hostname and item[2] > now:
+                return item[1], item[2]
+        return None
+
+    def set(self, hostname, ips, expire):
+        room = DNS_SHARED_CACHE_SLOT_SIZE - self._header.size - \
+            self._entry.size - len(hostname)
+        ips = list(ips)
+        value = ','.join(ips).encode('ascii')
+        while len(value) > room and len(ips) > 1:
+            ips.pop()
+            value = ','.join(ips).encode('ascii')
+        if len(value) > room:
+            return
+        # the slot of the same hostname, else an empty or expired one,
+        # else the one expiring first
+        now = time.time()
+        victim = victim_expire = None
+        for offset in self._offsets(hostname):
+            item = self._read(offset)
+            if item is None or item[0] == hostname or item[2] <= now:
+                victim = offset
+                break
+            if victim is None or item[2] < victim_expire:
+                victim, victim_expire = offset, item[2]
+        body = self._entry.pack(expire, len(hostname)) + hostname + value
+        self._mem[victim:victim + self._header.size + len(body)] = \
+            self._header.pack(zlib.crc32(body), len(body)) + body
+
+    def close(self):
+        self._mem.close()
+
+
+class DNSCache(object):
+    # hostname -> every address of the answer, kept for the answer's TTL
+
+    def __init__(self, min_ttl=DNS_MIN_TTL, max_ttl=DNS_MAX_TTL,
+                 stale_ttl=DNS_STALE_TTL, shared_slots=0):
+        self.min_ttl = min_ttl
+        self.max_ttl = max(min_ttl, max_ttl)
+        self.stale_ttl = stale_ttl
+        # entries nobody asked for during a whole lifetime are dropped early
+        self._store = lru_cache.LRUCache(timeout=self.max_ttl + stale_ttl)
+        # consulted on a miss, for what other workers have resolved
+        self._shared = None
+        if shared_slots:
+            self._shared = SharedDNSCache(shared_slots)
+
+    def add_to_loop(self, loop):
+        self._store.add_to_loop(loop)
+
+    def set(self, hostname, ips, ttl):
+        ttl = min(max(ttl, self.min_ttl), self.max_ttl)
+        now = time.time()
+        entry = DNSCacheEntry(ips, now + ttl, now + ttl + self.stale_ttl)
+        self._store[hostname] = entry
+        if self._shared:
+            self._shared.set(hostname, ips, entry.expire)
+        return entry
+
+    def get(self, hostname):
+        # returns (ip, stale)
+        entry = self._store[hostname]
+        return entry.pick(), time.time() >= entry.expire
+
+    def __contains__(self, hostname):
+        entry = self._store.get(hostname)
+        if entry is None:
+            return self._get_shared(hostname)
+        if time.time() >= entry.stale_expire:
+            del self._store[hostname]
+            return False
+        return True
+
+    def _get_shared(self, hostname):
+        # copies an answer of another worker in, True if there was one
+        if not self._shared:
+            return False
+        item = self._shared.get(hostname)
+        if item is None:
+            return False
+        ips, expire = item
+        self._store[hostname] = DNSCacheEntry(ips, expire,
+                                              expire + self.stale_ttl)
+        return True
+
+    def __len__(self):
+        return len(self._store)
+
+    def close(self):
+        if self._shared:
+            self._shared.close()
+            self._shared = None
+
+    def save(self, path):
+        # entries still fresh, written to a temporary file which then
+        # replaces path, so a reader never sees half a file
+        now = time.time()
+        entries = {}
+        for hostname in self._store:
+            entry = self._store.peek(hostname)
+            if entry.expire > now:
+                entries[common.to_str(hostname)] = [entry.ips, entry.expire]
+        tmp_path = '%s.%d.tmp' % (path, os.getpid())
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump(entries, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, path)
+        except (OSError, IOError) as e:
+            logging.warning('can not save dns cache to %s: %s' % (path, e))
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+            return 0
+        return len(entries)
+
+    def load(self, path):
+        # entries whose TTL ran out while we were not running are skipped
+        try:
+            with open(path, 'r') as f:
+                entries = json.load(f)
+        except (OSError, IOError, ValueError) as e:
+            if os.path.exists(path):
+                logging.warning('can not load dns cache from %s: %s' %
+                                (path, e))
+            return 0
+        now = time.time()
+        count = 0
+        for hostname, (ips, expire) in entries.items():
+            if expire <= now or not ips:
+                continue
+            ttl = min(expire - now, self.max_ttl)
+            self._store[common.to_bytes(hostname)] = DNSCacheEntry(
+                ips, now + ttl, now + ttl + self.stale_ttl)
+            count += 1
+        return count
+
+
+class HostnameSuffixSet(object):
+    # a hostname is in the set if it or one of its parent domains was added,
+    # so a lookup costs one hash per label whatever the size of the set
+
+    def __init__(self, hostnames=()):
+        self._names = set()
+        for hostname in hostnames:
+            self.add(hostname)
+
+    @staticmethod
+    def _normalize(hostname):
+        if type(hostname) != bytes:
+            hostname = hostname.encode('utf8')
+        return hostname.strip().strip(b'.').lower()
+
+    def add(self, hostname):
+        hostname = self._normalize(hostname)
+        if hostname:
+            self._names.add(hostname)
+
+    def __contains__(self, hostname):
+        names = self._names
+        if not names:
+            return False
+        hostname = hostname.rstrip(b'.').lower()
+        if hostname in names:
+            return True
+        i = hostname.find(b'.')
+        while i >= 0:
+            if hostname[i + 1:] in names:
+                return True
+            i = hostname.find(b'.', i + 1)
+        return False
+
+    def __len__(self):
+        return len(self._names)
+
+    def memory_usage(self):
+        # bytes held by the set and its names
+        return sys.getsizeof(self._names) + \
+            sum(sys.getsizeof(name) for name in self._names)
+
+
+def get_hosts_path():
+    if 'WINDIR' in os.environ:
+        return os.environ['WINDIR'] + '/system32/drivers/etc/hosts'
+    return '/etc/hosts'
+
+
+class FileWatcher(object):
+    # check() stats the watched files, to be called from a loop periodic,
+    # and calls back for each one created, removed or changed since
+
+    def __init__(self):
+        self._files = {}
+
+    @staticmethod
+    def _stat(path):
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return st.st_mtime, st.st_size, st.st_ino
+
+    def watch(self, path, callback):
+        self._files[path] = [self._stat(path), callback]
+
+    def check(self):
+        for path, watched in list(self._files.items()):
+            state = self._stat(path)
+            if state != watched[0]:
+                watched[0] = state
+                logging.info('%s changed, reloading' % path)
+                watched[1]()
+
+
+def parse_hostname_file(path):
+    # one domain per line, or hosts format as used by ad block lists
+    hostnames = []
+    with open(path, 'rb') as f:
+        for line in f:
+            if b'#' in line:
+                line = line[:line.find(b'#')]
+            parts = line.split()
+            if not parts:
+                continue
+            if len(parts) >= 2 and common.is_ip(parts[0]):
+                hostnames.extend(parts[1:])
+            else:
+                hostnames.append(parts[0])
+    return hostnames
+
+
+class GetaddrinfoPool(object):
+    # runs the blocking socket.getaddrinfo() on worker threads; results
+    # come back to the event loop through a socketpair and the callbacks
+    # run on the loop
+
+    def __init__(self, workers=GETADDRINFO_WORKERS,
+                 max_pending=GETADDRINFO_MAX_PENDING):
+        self._workers = workers
+        self._max_pending = max_pending
+        self._pending = 0
+        self._executor = None
+        self._done = collections.deque()
+        self._loop = None
+        self._rsock = self._wsock = None
+
+    def add_to_loop(self, loop):
+        # the resolver is made before the workers are forked, each of them
+        # needs threads and a wakeup socket of its own
+        if self._loop:
+            raise Exception('already add to loop')
+        from concurrent.futures import ThreadPoolExecutor
+        self._loop = loop
+        self._executor = ThreadPoolExecutor(self._workers)
+        self._rsock, self._wsock = socket.socketpair()
+        self._rsock.setblocking(False)
+        self._wsock.setblocking(False)
+        loop.add(self._rsock, eventloop.POLL_IN, self)
+
+    def submit(self, callback, host, port, family=0, socktype=0, proto=0):
+        # callback(addrs, error) is called on the loop; returns False when
+        # too many lookups are waiting already, or not on a loop yet
+        if self._loop is None or self._pending >= self._max_pending:
+            return False
+        self._pending += 1
+        self._executor.submit(self._run, callback, host, port, family,
+                              socktype, proto)
+        return True
+
+    def _run(self, callback, host, port, family, socktype, proto):
+        # on a worker thread
+        try:
+            result = (socket.getaddrinfo(host, port, family, socktype, proto),
+                      None)
+        except Exception as e:
+            result = (None, e)
+        self._done.append((callback, result))
+        try:
+            self._wsock.send(b'\0')
+        except (OSError, IOError):
+            # full, the loop has been woken up already
+            pass
+
+    def handle_event(self, sock, fd, event):
+        if sock != self._rsock:
+            return False
+        try:
+            while self._rsock.recv(BUF_SIZE):
+                pass
+        except (OSError, IOError):
+            pass
+        while self._done:
+            callback, (addrs, error) = self._done.popleft()
+            self._pending -= 1
+            try:
+                callback(addrs, error)
+            except Exception as e:
+                shell.print_exception(e)
+        return True
+
+    def close(self):
+        if self._loop:
+            self._loop.remove(self._rsock)
+            self._loop = None
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+        if self._rsock is not None:
+            self._rsock.close()
+            self._wsock.close()
+            self._rsock = self._wsock = None
+
+
+class DNSServer(object):
+    # RTT estimation as in rfc6298, plus counters for get_server_stats()
+
+    def __init__(self, addr):
+        self.addr = addr
+        self.srtt = None
+        self.rttvar = 0
+        self.sent = 0
+        self.answered = 0
+        self.timeouts = 0
+
+    def rto(self):
+        if self.srtt is None:
+            return DNS_INITIAL_RTO
+        return min(max(self.srtt + 4 * self.rttvar, DNS_MIN_RTO), DNS_MAX_RTO)
+
+    def rank(self):
+        # servers never measured are tried first
+        return self.srtt or 0
+
+    def update_rtt(self, rtt):
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+
+    def back_off(self):
+        # no answer in time, rank it behind the servers that do answer
+        self.srtt = min(self.rto() * 2, DNS_MAX_RTO)
+
+
+class DNSQuery(object):
+    __slots__ = ('hostname', 'qtype', 'txid', 'key', 'request', 'tries',
+                 'tried', 'server', 'timeout', 'sent_time', 'timer', 'tcp')
+
+    def __init__(self, hostname, qtype, txid):
+        self.hostname = hostname
+        self.qtype = qtype
+        self.txid = txid
+        # a response must match all of it
+        self.key = (txid, hostname, qtype)
+        self.request = build_request(hostname, qtype,
+                                     struct.pack('!H', self.txid))
+        self.tries = 0
+        self.tried = []
+        self.server = None
+        self.timeout = 0
+        self.sent_time = 0
+        self.timer = None
+        self.tcp = None
+
+
+class DNSTCPConnection(object):
+    # a query asked again over TCP after a truncated UDP answer; messages
+    # are prefixed with their length (rfc1035 4.2.2)
+
+    def __init__(self, sock, query, server):
+        self.sock = sock
+        self.query = query
+        self.server = server
+        self.data_to_write = struct.pack('!H', len(query.request)) + \
+            query.request
+        self.data_read = b''
 
 
 class DNSResolver(object):
-    def __init__(self, black_hostname_list=None):
+    def __init__(self, black_hostname_list=None, min_ttl=DNS_MIN_TTL,
+                 max_ttl=DNS_MAX_TTL, stale_ttl=DNS_STALE_TTL,
+                 black_hostname_file=None, cache_file=None,
+                 system_resolver=False, shared_cache_slots=0):
         self._loop = None
         self._hosts = {}
-        self._hostname_status = {}
         self._hostname_to_cb = {}
         self._cb_to_hostname = {}
-        self._cache = lru_cache.LRUCache(timeout=300)
+        # (txid, hostname, qtype) -> DNSQuery, and hostname -> its queries
+        self._queries = {}
+        self._hostname_queries = {}
+        self._fd_to_tcp = {}
+        self._getaddrinfo_pool = None
+        self._getaddrinfo_hostnames = set()
+        # opt-in: ask getaddrinfo() about hostnames the DNS servers could
+        # not resolve
+        if system_resolver:
+            self._getaddrinfo_pool = GetaddrinfoPool()
+        self._cache = DNSCache(min_ttl, max_ttl, stale_ttl,
+                               shared_cache_slots)
+        self._cache_file = cache_file
+        self._cache_save_timer = None
+        if cache_file:
+            count = self._cache.load(cache_file)
+            logging.info('loaded %d dns cache entries from %s' %
+                         (count, cache_file))
         # read black_hostname_list from config
         if type(black_hostname_list) != list:
             self._black_hostname_list = []
@@ -287,15 +790,43 @@ class DNSResolver(object):
                 black_hostname_list
             ))
         logging.info('black_hostname_list init as : ' + str(self._black_hostname_list))
+        self._black_hostname_file = black_hostname_file
+        self._black_hostnames = HostnameSuffixSet(self._black_hostname_list)
+        self._watcher = FileWatcher()
+        if black_hostname_file:
+            self._load_black_hostname_file()
+            self._watcher.watch(black_hostname_file,
+                                self._load_black_hostname_file)
         self._sock = None
         self._servers = None
+        self._server_stats = {}
         self._parse_resolv()
         self._parse_hosts()
-        # TODO monitor hosts change and reload hosts
+        # the system may change them under a long running process, e.g. a
+        # VPN coming up; queries in flight are left alone
+        for path in ('dns.conf', '/etc/resolv.conf'):
+            self._watcher.watch(path, self._parse_resolv)
+        self._watcher.watch(get_hosts_path(), self._parse_hosts)
         # TODO parse /etc/gai.conf and follow its rules
 
+    def _load_black_hostname_file(self):
+        path = self._black_hostname_file
+        try:
+            hostnames = parse_hostname_file(path)
+        except (OSError, IOError) as e:
+            logging.error('can not load black hostname file %s: %s' %
+                          (path, e))
+            return
+        black_hostnames = HostnameSuffixSet(self._black_hostname_list)
+        for hostname in hostnames:
+            black_hostnames.add(hostname)
+        self._black_hostnames = black_hostnames
+        logging.info('black hostnames loaded from %s: %d names, %d KB' %
+                     (path, len(black_hostnames),
+                      black_hostnames.memory_usage() // 1024))
+
     def _parse_resolv(self):
-        self._servers = []
+        servers = []
         try:
             with open('dns.conf', 'rb') as f:
                 content = f.readlines()
@@ -312,10 +843,10 @@ class DNSResolver(object):
                         if common.is_ip(server) == socket.AF_INET:
                             if type(server) != str:
                                 server = server.decode('utf8')
-                            self._servers.append((server, port))
+                            servers.append((server, port))
         except IOError:
             pass
-        if not self._servers:
+        if not servers:
             try:
                 with open('/etc/resolv.conf', 'rb') as f:
                     content = f.readlines()
@@ -329,19 +860,26 @@ class DNSResolver(object):
                                     if common.is_ip(server) == socket.AF_INET:
                                         if type(server) != str:
                                             server = server.decode('utf8')
-                                        self._servers.append((server, 53))
+                                        servers.append((server, 53))
             except IOError:
                 pass
-        if not self._servers:
-            self._servers = [('8.8.4.4', 53), ('8.8.8.8', 53)]
+        if not servers:
+            servers = [('8.8.4.4', 53), ('8.8.8.8', 53)]
+        self._set_servers(servers)
+
+    def _set_servers(self, servers):
+        # queries in flight keep the DNSServer they were sent to, their
+        # answers are still taken if it is gone from here
+        self._servers = servers
         logging.info('dns server: %s' % (self._servers,))
+        self._server_stats = dict((addr, self._server_stats.get(addr) or
+                                   DNSServer(addr)) for addr in self._servers)
 
     def _parse_hosts(self):
-        etc_path = '/etc/hosts'
-        if 'WINDIR' in os.environ:
-            etc_path = os.environ['WINDIR'] + '/system32/drivers/etc/hosts'
+        # built aside and swapped in, for a reload
+        hosts = {}
         try:
-            with open(etc_path, 'rb') as f:
+            with open(get_hosts_path(), 'rb') as f:
                 for line in f.readlines():
                     line = line.strip()
                     if b"#" in line:
@@ -353,9 +891,10 @@ class DNSResolver(object):
                             for i in range(1, len(parts)):
                                 hostname = parts[i]
                                 if hostname:
-                                    self._hosts[hostname] = ip
+                                    hosts[hostname] = ip
         except IOError:
-            self._hosts['localhost'] = '127.0.0.1'
+            hosts['localhost'] = '127.0.0.1'
+        self._hosts = hosts
 
     def add_to_loop(self, loop):
         if self._loop:
@@ -366,8 +905,25 @@ class DNSResolver(object):
                                    socket.SOL_UDP)
         self._sock.setblocking(False)
         loop.add(self._sock, eventloop.POLL_IN, self)
+        self._cache.add_to_loop(loop)
+        if self._getaddrinfo_pool:
+            self._getaddrinfo_pool.add_to_loop(loop)
+        if self._cache_file:
+            self._cache_save_timer = loop.call_later(
+                DNS_CACHE_SAVE_INTERVAL, self._save_cache_periodic)
         loop.add_periodic(self.handle_periodic)
 
+    def save_cache(self):
+        if self._cache_file:
+            count = self._cache.save(self._cache_file)
+            logging.debug('saved %d dns cache entries to %s' %
+                          (count, self._cache_file))
+
+    def _save_cache_periodic(self):
+        self.save_cache()
+        self._cache_save_timer = self._loop.call_later(
+            DNS_CACHE_SAVE_INTERVAL, self._save_cache_periodic)
+
     def _call_callback(self, hostname, ip, error=None):
         callbacks = self._hostname_to_cb.get(hostname, [])
         for callback in callbacks:
@@ -380,51 +936,62 @@ class DNSResolver(object):
                          Exception('unable to parse hostname %s' % hostname))
         if hostname in self._hostname_to_cb:
             del self._hostname_to_cb[hostname]
-        if hostname in self._hostname_status:
-            del self._hostname_status[hostname]
 
-    def _handle_data(self, data):
+    def _handle_data(self, data, addr, tcp=False):
         response = parse_response(data)
-        if response and response.hostname:
+        if response and response.hostname and response.questions:
             hostname = response.hostname
-            ip = None
+            qtype = response.questions[0][1]
+            query = self._queries.get((response.id, hostname, qtype))
+            if query is None:
+                logging.debug('dropped an unexpected dns response for %s',
+                              hostname)
+                return
+            server = self._query_server(query, addr)
+            if server is None:
+                logging.warn('received a packet other than our dns')
+                return
+            if not tcp:
+                server.answered += 1
+                if query.tries == 1:
+                    # rtt of a retransmitted query is ambiguous, don't
+                    # sample it
+                    server.update_rtt(eventloop.monotonic() -
+                                      query.sent_time)
+                if response.truncated:
+                    logging.debug('truncated dns response for %s, retry '
+                                  'over tcp', hostname)
+                    self._send_tcp_query(query, server.addr)
+                    return
+            self._finish_query(query)
+            ips = []
+            ttl = None
             for answer in response.answers:
-                if answer[1] in (QTYPE_A, QTYPE_AAAA) and \
-                                answer[2] == QCLASS_IN:
-                    ip = answer[0]
-                    break
-            if IPV6_CONNECTION_SUPPORT:
-                if not ip and self._hostname_status.get(hostname, STATUS_IPV4) \
-                        == STATUS_IPV6:
-                    self._hostname_status[hostname] = STATUS_IPV4
-                    self._send_req(hostname, QTYPE_A)
-                else:
-                    if ip:
-                        self._cache[hostname] = ip
-                        self._call_callback(hostname, ip)
-                    elif self._hostname_status.get(hostname, None) == STATUS_IPV4:
-                        for question in response.questions:
-                            if question[1] == QTYPE_A:
-                                self._call_callback(hostname, None)
-                                break
+                if answer[1] == qtype and answer[2] == QCLASS_IN:
+                    if answer[0] not in ips:
+                        ips.append(answer[0])
+                    if ttl is None or answer[3] < ttl:
+                        ttl = answer[3]
+            if ips:
+                # first usable answer wins, the other family is not needed
+                ip = self._cache.set(hostname, ips, ttl).pick()
+                self._finish_hostname(hostname)
+                self._call_callback(hostname, ip)
+            elif hostname in self._hostname_queries:
+                # the other family may still have an answer
+                pass
+            elif qtype == QTYPE_A and not IPV6_CONNECTION_SUPPORT:
+                self._send_req(hostname, QTYPE_AAAA)
             else:
-                if not ip and self._hostname_status.get(hostname, STATUS_IPV6) \
-                        == STATUS_IPV4:
-                    self._hostname_status[hostname] = STATUS_IPV6
-                    self._send_req(hostname, QTYPE_AAAA)
-                else:
-                    if ip:
-                        self._cache[hostname] = ip
-                        self._call_callback(hostname, ip)
-                    elif self._hostname_status.get(hostname, None) == STATUS_IPV6:
-                        for question in response.questions:
-                            if question[1] == QTYPE_AAAA:
-                                self._call_callback(hostname, None)
-                                break
+                self._fail_hostname(hostname)
 
     def handle_event(self, sock, fd, event):
         if sock != self._sock:
-            return
+            conn = self._fd_to_tcp.get(fd)
+            if conn is None:
+                return False
+            self._handle_tcp_event(conn, event)
+            return True
         if event & eventloop.POLL_ERR:
             logging.error('dns socket err')
             self._loop.remove(self._sock)
@@ -435,14 +1002,23 @@ class DNSResolver(object):
             self._sock.setblocking(False)
             self._loop.add(self._sock, eventloop.POLL_IN, self)
         else:
-            data, addr = sock.recvfrom(1024)
-            if addr not in self._servers:
-                logging.warn('received a packet other than our dns')
-                return
-            self._handle_data(data)
+            data, addr = sock.recvfrom(BUF_SIZE)
+            self._handle_data(data, addr)
+        return True
+
+    def _query_server(self, query, addr):
+        # the DNSServer at addr if query was sent to it, a late answer to
+        # an earlier try is as good as one to the last
+        server = query.server
+        if server is not None and server.addr == addr:
+            return server
+        for server in query.tried:
+            if server.addr == addr:
+                return server
+        return None
 
     def handle_periodic(self):
-        self._cache.sweep()
+        self._watcher.check()
 
     def remove_callback(self, callback):
         hostname = self._cb_to_hostname.get(callback)
@@ -453,15 +1029,192 @@ class DNSResolver(object):
                 arr.remove(callback)
                 if not arr:
                     del self._hostname_to_cb[hostname]
-                    if hostname in self._hostname_status:
-                        del self._hostname_status[hostname]
+                    self._finish_hostname(hostname)
 
     def _send_req(self, hostname, qtype):
-        req = build_request(hostname, qtype)
-        for server in self._servers:
-            logging.debug('resolving %s with type %d using server %s',
-                          hostname, qtype, server)
-            self._sock.sendto(req, server)
+        for query in self._hostname_queries.get(hostname, ()):
+            if query.qtype == qtype:
+                self._finish_query(query)
+                break
+        while True:
+            txid = struct.unpack('!H', os.urandom(2))[0]
+            if (txid, hostname, qtype) not in self._queries:
+                break
+        query = DNSQuery(hostname, qtype, txid)
+        self._queries[query.key] = query
+        self._hostname_queries.setdefault(hostname, []).append(query)
+        self._send_query(query)
+
+    def _send_query(self, query):
+        # the servers tried least often for this query first, the best of
+        # them; tried is kept whole, a late answer to any try is taken
+        server = min(self._server_stats.values(),
+                     key=lambda server: (query.tried.count(server),
+                                         server.rank()))
+        if query.tries:
+            timeout = min(query.timeout * 2, DNS_MAX_RTO)
+        else:
+            timeout = server.rto()
+        query.tries += 1
+        query.tried.append(server)
+        query.server = server
+        query.timeout = timeout
+        # monotonic, a step of the wall clock would be a bogus rtt sample;
+        # wall time is only for the cache expiry that goes to disk
+        query.sent_time = eventloop.monotonic()
+        server.sent += 1
+        logging.debug('resolving %s with type %d using server %s',
+                      query.hostname, query.qtype, server.addr)
+        try:
+            self._sock.sendto(query.request, server.addr)
+        except (OSError, IOError) as e:
+            # the timeout moves on to the next server
+            shell.print_exception(e)
+        query.timer = self._loop.call_later(timeout, self._query_timeout,
+                                            query)
+
+    def _query_timeout(self, query):
+        query.timer = None
+        query.server.timeouts += 1
+        query.server.back_off()
+        if query.tries < DNS_MAX_TRIES:
+            self._send_query(query)
+            return
+        self._give_up(query, 'timed out')
+
+    def _give_up(self, query, reason):
+        self._finish_query(query)
+        hostname = query.hostname
+        if hostname in self._hostname_queries:
+            # the other family may still have an answer
+            return
+        logging.warning('dns query for %s %s', common.to_str(hostname), reason)
+        self._fail_hostname(hostname, Exception(
+            'dns query for %s %s' % (common.to_str(hostname), reason)))
+
+    def _fail_hostname(self, hostname, error=None):
+        # DNS has no answer, ask the system resolver before giving up
+        if self._getaddrinfo_pool and self._hostname_to_cb.get(hostname) \
+                and hostname not in self._getaddrinfo_hostnames:
+            if IPV6_CONNECTION_SUPPORT:
+                family = 0
+            else:
+                family = socket.AF_INET
+
+            def callback(addrs, gai_error):
+                # why the system resolver failed says more than DNS did
+                self._handle_getaddrinfo(hostname, addrs, gai_error or error)
+
+            if self._getaddrinfo_pool.submit(callback, hostname, 0, family,
+                                             socket.SOCK_STREAM,
+                                             socket.SOL_TCP):
+                self._getaddrinfo_hostnames.add(hostname)
+                return
+        self._call_callback(hostname, None, error)
+
+    def _handle_getaddrinfo(self, hostname, addrs, error):
+        self._getaddrinfo_hostnames.discard(hostname)
+        ips = []
+        for af, socktype, proto, canonname, sa in addrs or ():
+            if sa[0] not in ips:
+                ips.append(sa[0])
+        if ips:
+            logging.debug('system resolver: %s ==>> %s', hostname, ips)
+            ip = self._cache.set(hostname, ips, DNS_MIN_TTL).pick()
+            self._call_callback(hostname, ip)
+        else:
+            self._call_callback(hostname, None, error)
+
+    def _send_tcp_query(self, query, server):
+        if query.timer is not None:
+            query.timer.cancel()
+        query.timer = self._loop.call_later(DNS_TCP_TIMEOUT,
+                                            self._give_up, query,
+                                            'timed out over tcp')
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM,
+                             socket.SOL_TCP)
+        sock.setblocking(False)
+        conn = DNSTCPConnection(sock, query, server)
+        query.tcp = conn
+        self._fd_to_tcp[sock.fileno()] = conn
+        self._loop.add(sock, eventloop.POLL_OUT | eventloop.POLL_ERR, self)
+        try:
+            sock.connect(server)
+        except (OSError, IOError) as e:
+            if eventloop.errno_from_exception(e) not in \
+                    (errno.EINPROGRESS, errno.EWOULDBLOCK):
+                self._give_up(query, 'failed over tcp: %s' % e)
+
+    def _handle_tcp_event(self, conn, event):
+        if event & eventloop.POLL_ERR:
+            self._give_up(conn.query, 'failed over tcp')
+            return
+        try:
+            if event & eventloop.POLL_OUT and conn.data_to_write:
+                sent = conn.sock.send(conn.data_to_write)
+                conn.data_to_write = conn.data_to_write[sent:]
+                if not conn.data_to_write:
+                    self._loop.modify(conn.sock,
+                                      eventloop.POLL_IN | eventloop.POLL_ERR)
+            if event & (eventloop.POLL_IN | eventloop.POLL_HUP):
+                data = conn.sock.recv(BUF_SIZE)
+                if not data:
+                    self._give_up(conn.query, 'closed over tcp')
+                    return
+                conn.data_read += data
+        except (OSError, IOError) as e:
+            if eventloop.errno_from_exception(e) not in \
+                    (errno.EAGAIN, errno.EWOULDBLOCK):
+                self._give_up(conn.query, 'failed over tcp: %s' % e)
+            return
+        if len(conn.data_read) >= 2:
+            length = struct.unpack('!H', conn.data_read[:2])[0]
+            if len(conn.data_read) >= 2 + length:
+                query = conn.query
+                self._handle_data(conn.data_read[2:2 + length], conn.server,
+                                  tcp=True)
+                if query.tcp is conn:
+                    # the answer wasn't for this query
+                    self._give_up(query, 'failed over tcp')
+
+    def _close_tcp(self, conn):
+        conn.query.tcp = None
+        del self._fd_to_tcp[conn.sock.fileno()]
+        self._loop.remove(conn.sock)
+        conn.sock.close()
+
+    def _finish_query(self, query):
+        if self._queries.get(query.key) is query:
+            del self._queries[query.key]
+            queries = self._hostname_queries[query.hostname]
+            queries.remove(query)
+            if not queries:
+                del self._hostname_queries[query.hostname]
+        if query.timer is not None:
+            query.timer.cancel()
+            query.timer = None
+        if query.tcp is not None:
+            self._close_tcp(query.tcp)
+
+    def _finish_hostname(self, hostname):
+        for query in list(self._hostname_queries.get(hostname, ())):
+            self._finish_query(query)
+
+    def get_server_stats(self):
+        return [{'server': server.addr,
+                 'srtt': server.srtt,
+                 'rto': server.rto(),
+                 'sent': server.sent,
+                 'answered': server.answered,
+                 'timeouts': server.timeouts}
+                for server in self._server_stats.values()]
+
+    def _send_first_req(self, hostname):
+        if IPV6_CONNECTION_SUPPORT:
+            # A and AAAA in parallel, whichever usable answer comes first
+            # is used
+            self._send_req(hostname, QTYPE_AAAA)
+        self._send_req(hostname, QTYPE_A)
 
     def resolve(self, hostname, callback):
         if type(hostname) != bytes:
@@ -475,53 +1228,562 @@ class DNSResolver(object):
             ip = self._hosts[hostname]
             callback((hostname, ip), None)
         elif hostname in self._cache:
-            logging.debug('hit cache: %s ==>> %s', hostname, self._cache[hostname])
-            ip = self._cache[hostname]
+            ip, stale = self._cache.get(hostname)
+            logging.debug('hit cache: %s ==>> %s', hostname, ip)
+            if stale and hostname not in self._hostname_queries:
+                # answer now, refresh in the background
+                self._send_first_req(hostname)
             callback((hostname, ip), None)
-        elif any(hostname.endswith(t) for t in self._black_hostname_list):
+        elif hostname in self._black_hostnames:
             callback(None, Exception('hostname <%s> is block by the black hostname list' % hostname))
             return
         else:
             if not is_valid_hostname(hostname):
                 callback(None, Exception('invalid hostname: %s' % hostname))
                 return
-            if False:
-                addrs = socket.getaddrinfo(hostname, 0, 0,
-                                           socket.SOCK_DGRAM, socket.SOL_UDP)
-                if addrs:
-                    af, socktype, proto, canonname, sa = addrs[0]
-                    logging.debug('DNS resolve %s %s' % (hostname, sa[0]))
-                    self._cache[hostname] = sa[0]
-                    callback((hostname, sa[0]), None)
-                    return
             arr = self._hostname_to_cb.get(hostname, None)
             if not arr:
-                if IPV6_CONNECTION_SUPPORT:
-                    self._hostname_status[hostname] = STATUS_IPV6
-                    self._send_req(hostname, QTYPE_AAAA)
-                else:
-                    self._hostname_status[hostname] = STATUS_IPV4
-                    self._send_req(hostname, QTYPE_A)
+                if hostname not in self._hostname_queries:
+                    self._send_first_req(hostname)
                 self._hostname_to_cb[hostname] = [callback]
                 self._cb_to_hostname[callback] = hostname
             else:
+                # already being resolved, retransmission is up to the query
                 arr.append(callback)
-                # TODO send again only if waited too long
-                if IPV6_CONNECTION_SUPPORT:
-                    self._send_req(hostname, QTYPE_AAAA)
-                else:
-                    self._send_req(hostname, QTYPE_A)
 
     def close(self):
+        for query in list(self._queries.values()):
+            self._finish_query(query)
+        if self._loop and self._watcher:
+            self._loop.remove_periodic(self.handle_periodic)
+            self._watcher = None
+        if self._getaddrinfo_pool:
+            self._getaddrinfo_pool.close()
+            self._getaddrinfo_pool = None
+        if self._cache_file:
+            if self._cache_save_timer is not None:
+                self._cache_save_timer.cancel()
+                self._cache_save_timer = None
+            self.save_cache()
+            self._cache_file = None
+        self._cache.close()
         if self._sock:
             if self._loop:
-                self._loop.remove_periodic(self.handle_periodic)
                 self._loop.remove(self._sock)
             self._sock.close()
             self._sock = None
 
 
+def test_cache():
+    cache = DNSCache(min_ttl=0.2, max_ttl=0.4, stale_ttl=0.3)
+    assert b'a.com' not in cache
+    cache.set(b'a.com', ['1.1.1.1', '2.2.2.2'], 0)
+    assert b'a.com' in cache
+    assert cache.get(b'a.com') == ('1.1.1.1', False)
+    assert cache.get(b'a.com') == ('2.2.2.2', False)
+    assert cache.get(b'a.com') == ('1.1.1.1', False)
+    cache.set(b'b.com', ['3.3.3.3'], 3600)
+    time.sleep(0.25)
+    # min_ttl is over for a.com, max_ttl isn't for b.com
+    assert cache.get(b'a.com')[1]
+    assert not cache.get(b'b.com')[1]
+    time.sleep(0.2)
+    assert cache.get(b'b.com') == ('3.3.3.3', True)
+    time.sleep(0.1)
+    assert b'a.com' not in cache
+    assert b'b.com' in cache
+    assert len(cache) == 1
+
+    import tempfile
+    path = os.path.join(tempfile.mkdtemp(), 'dns-cache.json')
+    cache = DNSCache(min_ttl=0.2, max_ttl=3600)
+    cache.set(b'a.com', ['1.1.1.1', '2.2.2.2'], 60)
+    cache.set(b'b.com', ['3.3.3.3'], 0)
+    assert cache.save(path) == 2
+    time.sleep(0.25)
+    cache = DNSCache()
+    assert cache.load(path) == 1
+    assert cache.get(b'a.com') == ('1.1.1.1', False)
+    assert b'b.com' not in cache
+    os.unlink(path)
+    assert DNSCache().load(path) == 0
+
+
+def test_shared_cache():
+    cache = DNSCache(min_ttl=0.2, max_ttl=3600, shared_slots=4)
+    pid = os.fork()
+    if pid == 0:
+        cache.set(b'a.com', ['1.1.1.1', '2.2.2.2'], 60)
+        cache.set(b'b.com', ['3.3.3.3'], 0)
+        os._exit(0)
+    os.waitpid(pid, 0)
+    assert b'a.com' in cache
+    assert cache.get(b'a.com') == ('1.1.1.1', False)
+    time.sleep(0.25)
+    assert b'b.com' not in cache
+    # more hostnames than slots, the ones expiring first make room
+    for i in range(8):
+        cache.set(b'%d.com' % i, ['4.4.4.%d' % i], 60 + i)
+    expire = cache._store[b'7.com'].expire
+    assert cache._shared.get(b'7.com') == (['4.4.4.7'], expire)
+    assert cache._shared.get(b'0.com') is None
+    # a torn slot reads as a miss
+    shared = SharedDNSCache(1)
+    shared.set(b'a.com', ['1.1.1.1'], time.time() + 60)
+    shared._mem[20] ^= 1
+    assert shared.get(b'a.com') is None
+    shared.close()
+    cache.close()
+
+
+def test_rtt():
+    server = DNSServer(('127.0.0.1', 53))
+    assert server.rto() == DNS_INITIAL_RTO
+    server.update_rtt(0.1)
+    assert server.srtt == 0.1 and abs(server.rto() - 0.3) < 1e-9
+    for i in range(20):
+        server.update_rtt(0.01)
+    assert server.rto() == DNS_MIN_RTO
+    slow = DNSServer(('127.0.0.2', 53))
+    slow.update_rtt(0.5)
+    assert min([slow, server], key=DNSServer.rank) is server
+    server.back_off()
+    server.back_off()
+    assert min([slow, server], key=DNSServer.rank) is slow
+    assert server.rto() <= DNS_MAX_RTO
+
+
+def test_getaddrinfo_pool():
+    pool = GetaddrinfoPool()
+    # nothing made before add_to_loop, which runs in each worker
+    assert pool._rsock is None and pool._executor is None
+    assert not pool.submit(lambda addrs, error: None, 'localhost', 80)
+    loop = eventloop.EventLoop()
+    pool.add_to_loop(loop)
+    results = []
+
+    def callback(addrs, error):
+        results.append((addrs, error))
+        if len(results) == 2:
+            loop.stop()
+
+    assert pool.submit(callback, 'localhost', 80)
+    assert pool.submit(callback, 'a' * 300, 80)
+    timer = loop.call_later(5, loop.stop)
+    loop.run()
+    timer.cancel()
+    pool.close()
+    results.sort(key=lambda result: result[0] is None)
+    assert results[0][0] and results[0][1] is None
+    assert results[1][0] is None and results[1][1] is not None
+
+    # the resolver reports the error of getaddrinfo
+    class Pool(object):
+        def __init__(self):
+            self.callbacks = []
+
+        def submit(self, callback, *args):
+            self.callbacks.append(callback)
+            return True
+
+        def close(self):
+            pass
+
+    resolver = DNSResolver(system_resolver=False)
+    resolver._getaddrinfo_pool = pool = Pool()
+    errors = []
+    resolver._hostname_to_cb[b'a.example'] = \
+        [lambda result, error: errors.append(error)]
+    resolver._fail_hostname(b'a.example')
+    gai_error = socket.gaierror(socket.EAI_NONAME, 'Name or service not known')
+    pool.callbacks[0](None, gai_error)
+    assert errors == [gai_error]
+    resolver.close()
+
+
+def test_black_hostnames():
+    black = HostnameSuffixSet(['baidu.com', b'Yahoo.com.', ''])
+    assert len(black) == 2
+    assert b'baidu.com' in black
+    assert b'map.baidu.com' in black
+    assert b'a.b.yahoo.com.' in black
+    assert b'notbaidu.com' not in black
+    assert b'com' not in black
+    assert b'google.com' not in black
+    assert b'google.com' not in HostnameSuffixSet()
+
+
+def build_response(request, ips, ttl=60, truncated=False):
+    # an answer to request, for the tests
+    end = request.index(b'\0', 12) + 5
+    qtype = struct.unpack('!H', request[end - 4:end - 2])[0]
+    if qtype == QTYPE_AAAA:
+        family = socket.AF_INET6
+    else:
+        family = socket.AF_INET
+    flags = 0x81
+    if truncated:
+        flags |= 0x02
+    answers = []
+    for ip in ips:
+        rdata = socket.inet_pton(family, ip)
+        # the name is a pointer to the question
+        answers.append(struct.pack('!HHHiH', 0xC00C, qtype, QCLASS_IN, ttl,
+                                   len(rdata)) + rdata)
+    return request[:2] + struct.pack('!BBHHHH', flags, 0x80, 1, len(ips),
+                                     0, 0) + \
+        request[12:end] + b''.join(answers)
+
+
+class FakeDNSServer(object):
+    # a DNS server on the loopback for the tests, served from threads.
+    # answer(request) returns the datagrams to send back to a UDP request,
+    # tcp_answer(request) the pieces to write to a TCP one, a short pause
+    # between each; without tcp_answer nothing listens on TCP
+
+    def __init__(self, answer=None, tcp_answer=None):
+        import threading
+        self.requests = []
+        self.tcp_requests = []
+        self._answer = answer
+        self._tcp_answer = tcp_answer
+        self._running = True
+        self._tcp = None
+        self._udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        if tcp_answer:
+            self._tcp = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self._tcp.bind(('127.0.0.1', 0))
+            self._tcp.listen(4)
+            self._tcp.settimeout(0.1)
+            self._udp.bind(self._tcp.getsockname())
+        else:
+            self._udp.bind(('127.0.0.1', 0))
+        self._udp.settimeout(0.1)
+        self.addr = self._udp.getsockname()
+        self._threads = [threading.Thread(target=self._serve_udp)]
+        if self._tcp:
+            self._threads.append(threading.Thread(target=self._serve_tcp))
+        for thread in self._threads:
+            thread.daemon = True
+            thread.start()
+
+    def _serve_udp(self):
+        while self._running:
+            try:
+                data, addr = self._udp.recvfrom(BUF_SIZE)
+            except socket.timeout:
+                continue
+            self.requests.append(data)
+            if self._answer:
+                for response in self._answer(data):
+                    self._udp.sendto(response, addr)
+
+    def _serve_tcp(self):
+        while self._running:
+            try:
+                conn = self._tcp.accept()[0]
+            except socket.timeout:
+                continue
+            conn.settimeout(2)
+            data = b''
+            try:
+                while len(data) < 2 or \
+                        len(data) < 2 + struct.unpack('!H', data[:2])[0]:
+                    chunk = conn.recv(BUF_SIZE)
+                    if not chunk:
+                        break
+                    data += chunk
+                self.tcp_requests.append(data[2:])
+                for piece in self._tcp_answer(data[2:]):
+                    conn.sendall(piece)
+                    time.sleep(0.05)
+                # let the resolver close first
+                while self._running and conn.recv(BUF_SIZE):
+                    pass
+            except (OSError, IOError):
+                pass
+            conn.close()
+
+    def close(self):
+        self._running = False
+        for thread in self._threads:
+            thread.join()
+        self._udp.close()
+        if self._tcp:
+            self._tcp.close()
+
+
+def make_test_resolver(*servers):
+    # a resolver asking only the fake servers, on a loop of its own
+    resolver = DNSResolver(system_resolver=False)
+    resolver._set_servers([server.addr for server in servers])
+    loop = eventloop.EventLoop()
+    resolver.add_to_loop(loop)
+    return resolver, loop
+
+
+def resolve_all(resolver, loop, hostnames, timeout=5):
+    # runs the loop until every hostname has its callback called, returns
+    # {hostname: (ip, error)}
+    results = {}
+
+    def make_callback(hostname):
+        def callback(result, error):
+            results[hostname] = (result and result[1], error)
+            if len(results) == len(hostnames):
+                loop.stop()
+        return callback
+
+    for hostname in hostnames:
+        resolver.resolve(hostname, make_callback(hostname))
+    if len(results) < len(hostnames):
+        timer = loop.call_later(timeout, loop.stop)
+        loop.run()
+        timer.cancel()
+    return results
+
+
+def test_reload_servers():
+    # answers from a server removed by a reload are still taken
+    global IPV6_CONNECTION_SUPPORT
+    ipv6 = IPV6_CONNECTION_SUPPORT
+    IPV6_CONNECTION_SUPPORT = False
+
+    def slow_answer(request):
+        # tcp.example is left for the TCP answer below
+        if parse_response(request).hostname != b'udp.example':
+            return []
+        time.sleep(0.3)
+        return [build_response(request, ['1.2.3.4'])]
+
+    old = FakeDNSServer(slow_answer)
+    new = FakeDNSServer()
+    resolver, loop = make_test_resolver(old)
+    try:
+        removed = resolver._server_stats[old.addr]
+        resolver.resolve(b'tcp.example', lambda result, error: None)
+        loop.call_later(0.1, resolver._set_servers, [new.addr])
+        results = resolve_all(resolver, loop, [b'udp.example'])
+        assert results == {b'udp.example': ('1.2.3.4', None)}
+        assert old.addr not in resolver._server_stats
+        assert removed.answered == 1
+        # a TCP answer, as after a truncated one
+        query = resolver._hostname_queries[b'tcp.example'][0]
+        resolver._handle_data(build_response(query.request, ['5.6.7.8']),
+                              old.addr, tcp=True)
+        assert resolver._cache.get(b'tcp.example')[0] == '5.6.7.8'
+        assert not new.requests
+    finally:
+        IPV6_CONNECTION_SUPPORT = ipv6
+        resolver.close()
+        old.close()
+        new.close()
+
+
+def test_query_matching():
+    global IPV6_CONNECTION_SUPPORT
+    ipv6 = IPV6_CONNECTION_SUPPORT
+
+    def spoofed_answer(request):
+        # wrong txid, qname and qtype first, all to be dropped
+        txid = struct.unpack('!H', request[:2])[0]
+        wrong_txid = struct.pack('!H', (txid + 1) & 0xFFFF) + request[2:]
+        wrong_qname = build_request(b'other.example', QTYPE_A, request[:2])
+        wrong_qtype = build_request(b'a.example', QTYPE_AAAA, request[:2])
+        return [build_response(wrong_txid, ['6.6.6.6']),
+                build_response(wrong_qname, ['7.7.7.7']),
+                build_response(wrong_qtype, ['::8']),
+                build_response(request, ['1.2.3.4'])]
+
+    server = FakeDNSServer(spoofed_answer)
+    resolver, loop = make_test_resolver(server)
+    try:
+        IPV6_CONNECTION_SUPPORT = False
+        results = resolve_all(resolver, loop, [b'a.example'])
+        assert results == {b'a.example': ('1.2.3.4', None)}
+        assert b'other.example' not in resolver._cache
+        assert not resolver._queries
+    finally:
+        resolver.close()
+        server.close()
+
+    # A and AAAA of two hostnames in flight together, answered in reverse
+    # order; each answer goes to the query it is for
+    requests = []
+    ips = {(b'v4.example', QTYPE_A): ['1.2.3.4'],
+           (b'v6.example', QTYPE_AAAA): ['2001:db8::1']}
+
+    def batched_answer(request):
+        requests.append(request)
+        if len(requests) < 4:
+            return []
+        responses = []
+        for request in reversed(requests):
+            response = parse_response(request)
+            key = (response.hostname, response.questions[0][1])
+            responses.append(build_response(request, ips.get(key, [])))
+        return responses
+
+    server = FakeDNSServer(batched_answer)
+    resolver, loop = make_test_resolver(server)
+    try:
+        IPV6_CONNECTION_SUPPORT = True
+        results = resolve_all(resolver, loop, [b'v4.example', b'v6.example'])
+        assert results == {b'v4.example': ('1.2.3.4', None),
+                           b'v6.example': ('2001:db8::1', None)}
+        assert len(server.requests) == 4
+        assert not resolver._queries
+    finally:
+        IPV6_CONNECTION_SUPPORT = ipv6
+        resolver.close()
+        server.close()
+
+
+def test_tcp_fallback():
+    global IPV6_CONNECTION_SUPPORT, DNS_TCP_TIMEOUT
+    ipv6, tcp_timeout = IPV6_CONNECTION_SUPPORT, DNS_TCP_TIMEOUT
+    IPV6_CONNECTION_SUPPORT = False
+    DNS_TCP_TIMEOUT = 0.3
+
+    def truncated_answer(request):
+        return [build_response(request, [], truncated=True)]
+
+    def split_answer(request):
+        # the length prefix comes in two reads
+        response = build_response(request, ['1.2.3.4', '5.6.7.8'])
+        data = struct.pack('!H', len(response)) + response
+        return [data[:1], data[1:6], data[6:]]
+
+    def no_answer(request):
+        return []
+
+    try:
+        server = FakeDNSServer(truncated_answer, split_answer)
+        resolver, loop = make_test_resolver(server)
+        try:
+            results = resolve_all(resolver, loop, [b'a.example'])
+            assert results == {b'a.example': ('1.2.3.4', None)}
+            assert server.tcp_requests == server.requests
+            assert resolver._cache.get(b'a.example')[0] == '5.6.7.8'
+            assert not resolver._fd_to_tcp and not resolver._queries
+        finally:
+            resolver.close()
+            server.close()
+
+        # nothing listening on TCP
+        server = FakeDNSServer(truncated_answer)
+        resolver, loop = make_test_resolver(server)
+        try:
+            results = resolve_all(resolver, loop, [b'a.example'])
+            ip, error = results[b'a.example']
+            assert ip is None and 'failed over tcp' in str(error)
+            assert not resolver._fd_to_tcp and not resolver._queries
+        finally:
+            resolver.close()
+            server.close()
+
+        # connected, never answered
+        server = FakeDNSServer(truncated_answer, no_answer)
+        resolver, loop = make_test_resolver(server)
+        try:
+            results = resolve_all(resolver, loop, [b'a.example'])
+            ip, error = results[b'a.example']
+            assert ip is None and 'timed out over tcp' in str(error)
+            assert len(server.tcp_requests) == 1
+            assert not resolver._fd_to_tcp and not resolver._queries
+        finally:
+            resolver.close()
+            server.close()
+    finally:
+        IPV6_CONNECTION_SUPPORT, DNS_TCP_TIMEOUT = ipv6, tcp_timeout
+
+
+def test_retransmission():
+    global IPV6_CONNECTION_SUPPORT
+    ipv6 = IPV6_CONNECTION_SUPPORT
+    IPV6_CONNECTION_SUPPORT = False
+
+    def answer(request):
+        return [build_response(request, ['1.2.3.4'])]
+
+    dead = FakeDNSServer()
+    live = FakeDNSServer(answer)
+    resolver, loop = make_test_resolver(dead, live)
+    try:
+        # the dead one ranks first, with a short rto
+        dead_stats = resolver._server_stats[dead.addr]
+        live_stats = resolver._server_stats[live.addr]
+        dead_stats.srtt, dead_stats.rttvar = 0.05, 0
+        live_stats.srtt, live_stats.rttvar = 0.1, 0
+        results = resolve_all(resolver, loop, [b'a.example'])
+        assert results == {b'a.example': ('1.2.3.4', None)}
+        # the same query went on to the next server after the rto
+        assert len(dead.requests) == 1 and live.requests == dead.requests
+        assert dead_stats.timeouts == 1 and dead_stats.srtt > 0.1
+        # Karn: the answer to a retransmission isn't an rtt sample
+        assert live_stats.answered == 1 and live_stats.srtt == 0.1
+    finally:
+        resolver.close()
+
+    resolver, loop = make_test_resolver(dead, live)
+    try:
+        # the answer to a first try is
+        resolver._server_stats[dead.addr].srtt = 1
+        live_stats = resolver._server_stats[live.addr]
+        live_stats.srtt, live_stats.rttvar = 0.1, 0
+        results = resolve_all(resolver, loop, [b'b.example'])
+        assert results == {b'b.example': ('1.2.3.4', None)}
+        assert live_stats.srtt < 0.1
+    finally:
+        resolver.close()
+        live.close()
+
+    dead.requests = []
+    resolver, loop = make_test_resolver(dead)
+    try:
+        dead_stats = resolver._server_stats[dead.addr]
+        dead_stats.srtt, dead_stats.rttvar = 0.05, 0
+        results = resolve_all(resolver, loop, [b'a.example'])
+        ip, error = results[b'a.example']
+        assert ip is None and 'timed out' in str(error)
+        # retransmitted with a doubling timeout until DNS_MAX_TRIES
+        assert len(dead.requests) == DNS_MAX_TRIES
+        assert len(set(dead.requests)) == 1
+        assert dead_stats.timeouts == DNS_MAX_TRIES
+        assert not resolver._queries
+    finally:
+        IPV6_CONNECTION_SUPPORT = ipv6
+        resolver.close()
+        dead.close()
+
+
+def bench_black_hostnames(count=100000):
+    import random
+    import timeit
+    names = [b'%x.ads%d.example' % (random.getrandbits(32), i)
+             for i in range(count)]
+    black = HostnameSuffixSet(names)
+    hostname = b'www.static.cdn.google.com'
+    n = 100
+    linear = timeit.timeit(
+        lambda: any(hostname.endswith(t) for t in names), number=n) / n
+    n = 100000
+    suffix = timeit.timeit(lambda: hostname in black, number=n) / n
+    print('%d names, %d KB: linear scan %.1f us, suffix set %.3f us' %
+          (count, black.memory_usage() // 1024, linear * 1e6, suffix * 1e6))
+
+
 def test():
+    test_cache()
+    test_shared_cache()
+    test_rtt()
+    test_getaddrinfo_pool()
+    test_black_hostnames()
+    test_reload_servers()
+    test_query_matching()
+    test_tcp_fallback()
+    test_retransmission()
+
     black_hostname_list = [
         'baidu.com',
         'yahoo.com',
@@ -591,4 +1853,7 @@ def test():
 
 
 if __name__ == '__main__':
-    test()
+    if sys.argv[1:] == ['bench']:
+        bench_black_hostnames()
+    else:
+        test()
@@ -125,6 +125,24 @@ def is_ip(address):
     return False
 
 
+def getaddrinfo(host, port, socktype=0, proto=0):
+    # socket.getaddrinfo() for the relays, a numeric host is answered here
+    # without calling into libc, which may block the whole loop; DNSResolver
+    # results are always numeric
+    addr = to_str(host)
+    try:
+        socket.inet_pton(socket.AF_INET, addr)
+        return [(socket.AF_INET, socktype, proto, '', (addr, port))]
+    except (OSError, ValueError):
+        pass
+    try:
+        socket.inet_pton(socket.AF_INET6, addr)
+        return [(socket.AF_INET6, socktype, proto, '', (addr, port, 0, 0))]
+    except (OSError, ValueError):
+        pass
+    return socket.getaddrinfo(host, port, 0, socktype, proto)
+
+
 def sync_str_bytes(obj, target_example):
     """sync (obj)'s type to (target_example)'s type"""
     if type(obj) != type(target_example):
@@ -432,6 +450,14 @@ def test_ip_network():
     assert 'www.google.com' not in ip_network
 
 
+def test_getaddrinfo():
+    for host in ('8.8.4.4', b'8.8.4.4', '2404:6800:4005:805::1011', 'localhost'):
+        for socktype, proto in ((socket.SOCK_STREAM, socket.SOL_TCP),
+                                (socket.SOCK_DGRAM, socket.SOL_UDP)):
+            expect = socket.getaddrinfo(host, 53, 0, socktype, proto)[0]
+            assert getaddrinfo(host, 53, socktype, proto)[0] == expect
+
+
 def test_sync_str_bytes():
     assert sync_str_bytes(b'a\.b', b'a\.b') == b'a\.b'
     assert sync_str_bytes('a\.b', b'a\.b') == b'a\.b'
@@ -456,3 +482,4 @@ if __name__ == '__main__':
     test_parse_header()
     test_pack_header()
     test_ip_network()
+    test_getaddrinfo()
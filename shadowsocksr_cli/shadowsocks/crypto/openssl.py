@@ -17,24 +17,37 @@
 from __future__ import absolute_import, division, print_function, \
     with_statement
 
-from ctypes import c_char_p, c_int, c_long, byref, \
+from ctypes import c_char_p, c_int, byref, c_char, \
     create_string_buffer, c_void_p
 
 from shadowsocksr_cli.shadowsocks import common
-from shadowsocksr_cli.shadowsocks.crypto import util
+from shadowsocksr_cli.shadowsocks.crypto import util, aead
 
 __all__ = ['ciphers']
 
 libcrypto = None
 loaded = False
 
+# scratch output of update(), shared by every context since the result is
+# copied out before update() returns; grown to the largest input seen
 buf_size = 2048
 
 ctx_cleanup = None
+cipher_block_size = None
+
+# name -> (EVP_CIPHER*, block size), looked up once
+cached_ciphers = {}
+# contexts of cleaned up ciphers, reset and ready for the next one
+ctx_free_list = []
+CTX_FREE_LIST_SIZE = 256
+
+EVP_CTRL_AEAD_SET_IVLEN = 0x9
+EVP_CTRL_AEAD_GET_TAG = 0x10
+EVP_CTRL_AEAD_SET_TAG = 0x11
 
 
 def load_openssl():
-    global loaded, libcrypto, buf, ctx_cleanup
+    global loaded, libcrypto, buf, ctx_cleanup, cipher_block_size
 
     libcrypto = util.find_library(('crypto', 'eay32'),
                                   'EVP_get_cipherbyname',
@@ -49,7 +62,18 @@ def load_openssl():
                                             c_char_p, c_char_p, c_int)
 
     libcrypto.EVP_CipherUpdate.argtypes = (c_void_p, c_void_p, c_void_p,
-                                           c_char_p, c_int)
+                                           c_void_p, c_int)
+
+    libcrypto.EVP_CipherFinal_ex.argtypes = (c_void_p, c_void_p, c_void_p)
+    libcrypto.EVP_CIPHER_CTX_ctrl.argtypes = (c_void_p, c_int, c_int,
+                                              c_void_p)
+
+    # renamed in OpenSSL 3.0
+    cipher_block_size = getattr(libcrypto, 'EVP_CIPHER_get_block_size', None)
+    if cipher_block_size is None:
+        cipher_block_size = libcrypto.EVP_CIPHER_block_size
+    cipher_block_size.restype = c_int
+    cipher_block_size.argtypes = (c_void_p,)
 
     if hasattr(libcrypto, "EVP_CIPHER_CTX_cleanup"):
         libcrypto.EVP_CIPHER_CTX_cleanup.argtypes = (c_void_p,)
@@ -78,6 +102,49 @@ def load_cipher(cipher_name):
     return None
 
 
+def get_cipher(cipher_name):
+    cipher = cached_ciphers.get(cipher_name)
+    if cipher is None:
+        ptr = libcrypto.EVP_get_cipherbyname(common.to_bytes(cipher_name))
+        if not ptr:
+            ptr = load_cipher(common.to_str(cipher_name))
+        if not ptr:
+            raise Exception('cipher %s not found in libcrypto' % cipher_name)
+        cipher = cached_ciphers[cipher_name] = (ptr, cipher_block_size(ptr))
+    return cipher
+
+
+def new_ctx():
+    if ctx_free_list:
+        return ctx_free_list.pop()
+    ctx = libcrypto.EVP_CIPHER_CTX_new()
+    if not ctx:
+        raise Exception('can not create cipher context')
+    return ctx
+
+
+def free_ctx(ctx):
+    ctx_cleanup(ctx)
+    if len(ctx_free_list) < CTX_FREE_LIST_SIZE:
+        ctx_free_list.append(ctx)
+    else:
+        libcrypto.EVP_CIPHER_CTX_free(ctx)
+
+
+def buffer_ptr(data, writable=False):
+    # something EVP_CipherUpdate can read from or write to without a copy,
+    # for bytes, bytearray and memoryview; a read-only buffer other than
+    # bytes is copied
+    if not writable and type(data) is bytes:
+        return data
+    try:
+        return (c_char * len(data)).from_buffer(data)
+    except TypeError:
+        if writable:
+            raise
+        return bytes(data)
+
+
 def rand_bytes(length):
     if not loaded:
         load_openssl()
@@ -93,41 +160,121 @@ class OpenSSLCrypto(object):
         self._ctx = None
         if not loaded:
             load_openssl()
-        cipher = libcrypto.EVP_get_cipherbyname(common.to_bytes(cipher_name))
-        if not cipher:
-            cipher = load_cipher(cipher_name)
-        if not cipher:
-            raise Exception('cipher %s not found in libcrypto' % cipher_name)
+        # a block mode may output up to a block more than its input
+        cipher, self._block_size = get_cipher(cipher_name)
         key_ptr = c_char_p(key)
         iv_ptr = c_char_p(iv)
-        self._ctx = libcrypto.EVP_CIPHER_CTX_new()
-        if not self._ctx:
-            raise Exception('can not create cipher context')
+        self._ctx = new_ctx()
         r = libcrypto.EVP_CipherInit_ex(self._ctx, cipher, None,
                                         key_ptr, iv_ptr, c_int(op))
         if not r:
             self.clean()
             raise Exception('can not initialize cipher context')
+        self._out_len = c_int(0)
 
     def update(self, data):
+        # data may be bytes, bytearray or memoryview; returns bytes
         global buf_size, buf
-        cipher_out_len = c_long(0)
         l = len(data)
+        if buf_size < l + self._block_size:
+            buf_size = (l + self._block_size) * 2
+            buf = create_string_buffer(buf_size)
+        libcrypto.EVP_CipherUpdate(self._ctx, buf, byref(self._out_len),
+                                   buffer_ptr(data), l)
+        # only the output is copied, not the whole buffer
+        return buf[:self._out_len.value]
+
+    def update_into(self, data, out):
+        # writes into out, a bytearray or writable memoryview at least a
+        # block longer than data for a block mode; returns the length
+        l = len(data)
+        if len(out) < l + self._block_size - 1:
+            raise ValueError('output buffer too small')
+        libcrypto.EVP_CipherUpdate(self._ctx, buffer_ptr(out, True),
+                                   byref(self._out_len), buffer_ptr(data), l)
+        return self._out_len.value
+
+    def __del__(self):
+        self.clean()
+
+    def clean(self):
+        if self._ctx:
+            free_ctx(self._ctx)
+            self._ctx = None
+
+
+class OpenSSLAeadCrypto(aead.AeadCryptoBase):
+    def __init__(self, cipher_name, key, iv, op):
+        self._ctx = None
+        if not loaded:
+            load_openssl()
+        aead.AeadCryptoBase.__init__(self, cipher_name, key, iv, op)
+        # aead-aes-128-gcm is libcrypto's aes-128-gcm
+        cipher_name = common.to_str(cipher_name)
+        if cipher_name.startswith(aead.AEAD_PREFIX):
+            cipher_name = cipher_name[len(aead.AEAD_PREFIX):]
+        cipher = get_cipher(cipher_name)[0]
+        self._ctx = new_ctx()
+        # the key is set once, the nonce before every message
+        r = libcrypto.EVP_CipherInit_ex(self._ctx, cipher, None, None, None,
+                                        c_int(op))
+        if r:
+            r = libcrypto.EVP_CIPHER_CTX_ctrl(self._ctx,
+                                              EVP_CTRL_AEAD_SET_IVLEN,
+                                              aead.NONCE_SIZE, None)
+        if r:
+            r = libcrypto.EVP_CipherInit_ex(self._ctx, None, None,
+                                            self.subkey, None, c_int(op))
+        if not r:
+            self.clean()
+            raise Exception('can not initialize cipher context')
+        self._out_len = c_int(0)
+        self._tag = create_string_buffer(aead.TAG_SIZE)
+
+    def _start(self, nonce, ad):
+        libcrypto.EVP_CipherInit_ex(self._ctx, None, None, None, nonce, -1)
+        if ad:
+            libcrypto.EVP_CipherUpdate(self._ctx, None, byref(self._out_len),
+                                       ad, len(ad))
+
+    def aead_encrypt(self, nonce, data, ad=b''):
+        global buf_size, buf
+        l = len(data)
+        if buf_size < l + aead.TAG_SIZE:
+            buf_size = (l + aead.TAG_SIZE) * 2
+            buf = create_string_buffer(buf_size)
+        self._start(nonce, ad)
+        libcrypto.EVP_CipherUpdate(self._ctx, buf, byref(self._out_len),
+                                   buffer_ptr(data), l)
+        libcrypto.EVP_CipherFinal_ex(self._ctx, buf, byref(self._out_len))
+        libcrypto.EVP_CIPHER_CTX_ctrl(self._ctx, EVP_CTRL_AEAD_GET_TAG,
+                                      aead.TAG_SIZE, self._tag)
+        return buf[:l] + self._tag.raw
+
+    def aead_decrypt(self, nonce, data, ad=b''):
+        global buf_size, buf
+        l = len(data) - aead.TAG_SIZE
+        if l < 0:
+            raise Exception('AEAD message too short')
         if buf_size < l:
             buf_size = l * 2
             buf = create_string_buffer(buf_size)
-        libcrypto.EVP_CipherUpdate(self._ctx, byref(buf),
-                                   byref(cipher_out_len), c_char_p(data), l)
-        # buf is copied to a str object when we access buf.raw
-        return buf.raw[:cipher_out_len.value]
+        self._start(nonce, ad)
+        libcrypto.EVP_CipherUpdate(self._ctx, buf, byref(self._out_len),
+                                   buffer_ptr(data), l)
+        libcrypto.EVP_CIPHER_CTX_ctrl(self._ctx, EVP_CTRL_AEAD_SET_TAG,
+                                      aead.TAG_SIZE, bytes(data[l:]))
+        if libcrypto.EVP_CipherFinal_ex(self._ctx, None,
+                                        byref(self._out_len)) <= 0:
+            raise Exception('AEAD tag mismatch')
+        return buf[:l]
 
     def __del__(self):
         self.clean()
 
     def clean(self):
         if self._ctx:
-            ctx_cleanup(self._ctx)
-            libcrypto.EVP_CIPHER_CTX_free(self._ctx)
+            free_ctx(self._ctx)
             self._ctx = None
 
 
@@ -140,6 +287,11 @@ ciphers = {
     'aes-128-gcm': (16, 16, OpenSSLCrypto),
     'aes-192-gcm': (24, 16, OpenSSLCrypto),
     'aes-256-gcm': (32, 16, OpenSSLCrypto),
+    # AEAD, the salt is as long as the key. Named apart from the stream
+    # use of gcm above, which existing configs and peers rely on
+    aead.AEAD_PREFIX + 'aes-128-gcm': (16, 16, OpenSSLAeadCrypto),
+    aead.AEAD_PREFIX + 'aes-192-gcm': (24, 24, OpenSSLAeadCrypto),
+    aead.AEAD_PREFIX + 'aes-256-gcm': (32, 32, OpenSSLAeadCrypto),
     'aes-128-cfb': (16, 16, OpenSSLCrypto),
     'aes-192-cfb': (24, 16, OpenSSLCrypto),
     'aes-256-cfb': (32, 16, OpenSSLCrypto),
@@ -203,6 +355,78 @@ def test_rc4():
     run_method('rc4')
 
 
+def test_aes_gcm():
+    # gcm spec test case 4, with associated data
+    key = bytes(bytearray.fromhex('feffe9928665731c6d6a8f9467308308'))
+    nonce = bytes(bytearray.fromhex('cafebabefacedbaddecaf888'))
+    plain = bytes(bytearray.fromhex(
+        'd9313225f88406e5a55909c5aff5269a86a7a9531534f7da2e4c303d8a318a72'
+        '1c3c0c95956809532fcf0e2449a6b525b16aedf5aa0de657ba637b39'))
+    ad = bytes(bytearray.fromhex('feedfacedeadbeeffeedfacedeadbeefabaddad2'))
+    expected = bytes(bytearray.fromhex(
+        '42831ec2217774244b7221b784d0d49ce3aa212f2c02a4e035c17e2329aca12e'
+        '21d514b25466931c7d8f6a5aac84aa051ba30b396a0aac973d58e091'
+        '5bc94fbc3221a5db94fae95ae7121a47'))
+    for op, data, result in ((1, plain, expected), (0, expected, plain)):
+        cipher = OpenSSLAeadCrypto('aead-aes-128-gcm', key, b's' * 16, op)
+        # the test vector's key instead of the derived subkey
+        libcrypto.EVP_CipherInit_ex(cipher._ctx, None, None, key, None, -1)
+        if op:
+            assert cipher.aead_encrypt(nonce, data, ad) == result
+        else:
+            assert cipher.aead_decrypt(nonce, data, ad) == result
+
+    for method in ('aead-aes-128-gcm', 'aead-aes-256-gcm'):
+        key_len = ciphers[method][0]
+        aead.run_aead(OpenSSLAeadCrypto(method, b'k' * key_len,
+                                        b's' * key_len, 1),
+                      OpenSSLAeadCrypto(method, b'k' * key_len,
+                                        b's' * key_len, 0))
+
+
+def test_buffers():
+    cipher = OpenSSLCrypto('aes-128-cfb', b'k' * 32, b'i' * 16, 1)
+    decipher = OpenSSLCrypto('aes-128-cfb', b'k' * 32, b'i' * 16, 0)
+    plain = b'0123456789' * 100
+    encrypted = cipher.update(plain[:300])
+    encrypted += cipher.update(bytearray(plain[300:600]))
+    encrypted += cipher.update(memoryview(plain)[600:])
+    assert len(encrypted) == len(plain)
+    out = bytearray(len(plain))
+    view = memoryview(out)
+    n = decipher.update_into(encrypted[:500], view)
+    n += decipher.update_into(memoryview(encrypted)[500:], view[n:])
+    assert n == len(plain) and bytes(out) == plain
+
+
+def bench(methods=('aes-128-cfb', 'aes-256-cfb', 'aes-128-ctr',
+                   'aes-256-ctr', 'rc4-md5'), sizes=(1500, 16384)):
+    # MB/s of update() on one core, for a packet and a full TCP read
+    import time
+    from shadowsocksr_cli.shadowsocks.crypto import rc4_md5
+    for method in methods:
+        result = []
+        for size in sizes:
+            try:
+                if method == 'rc4-md5':
+                    cipher = rc4_md5.create_cipher(method, b'k' * 32,
+                                                   b'i' * 16, 1)
+                else:
+                    cipher = OpenSSLCrypto(method, b'k' * 32, b'i' * 16, 1)
+            except Exception as e:
+                # e.g. rc4 without the legacy provider of OpenSSL 3
+                result.append(str(e))
+                break
+            data = b'x' * size
+            rounds = (64 * 1024 * 1024) // size
+            start = time.time()
+            for i in range(rounds):
+                cipher.update(data)
+            result.append('%d bytes %.0f MB/s' % (
+                size, size * rounds / (time.time() - start) / 1e6))
+        print('%-12s %s' % (method, ', '.join(result)))
+
+
 def test_all():
     for k, v in ciphers.items():
         print(k)
@@ -219,4 +443,10 @@ def eprint(*args, **kwargs):
 
 
 if __name__ == '__main__':
-    test_all()
+    import sys
+    if sys.argv[1:] == ['bench']:
+        bench()
+    else:
+        test_buffers()
+        test_aes_gcm()
+        test_all()
@@ -17,15 +17,23 @@
 from __future__ import absolute_import, division, print_function, \
     with_statement
 
+import os
+import json
 import string
 import struct
 import hashlib
 
+from shadowsocksr_cli.shadowsocks.common import logging
 
 __all__ = ['ciphers']
 
 cached_tables = {}
 
+# when set, built tables are kept in this file, so a server with many
+# table ports doesn't build them all again when it restarts
+cache_file = None
+file_tables = None
+
 if hasattr(string, 'maketrans'):
     maketrans = string.maketrans
     translate = string.translate
@@ -34,7 +42,7 @@ else:
     translate = bytes.translate
 
 
-def get_table(key):
+def get_table_reference(key):
     m = hashlib.md5()
     m.update(key)
     s = m.digest()
@@ -46,9 +54,83 @@ def get_table(key):
     return table
 
 
+def get_table(key):
+    # same result as get_table_reference(): the sort key of byte x in
+    # round i is a % (x + i), so all of them are computed up front and
+    # every round sorts by a slice of that list, without a Python call
+    # per byte
+    a, b = struct.unpack('<QQ', hashlib.md5(key).digest())
+    mods = [a % n for n in range(1, 256 + 1023)]
+    table = list(range(256))
+    for i in range(1, 1024):
+        table.sort(key=mods[i - 1:i + 255].__getitem__)
+    return [struct.pack('B', x) for x in table]
+
+
+def _table_id(key):
+    return hashlib.sha256(key).hexdigest()
+
+
+def load_table(key):
+    # the encrypt table of key from cache_file, None if it isn't there
+    global file_tables
+    if file_tables is None:
+        file_tables = {}
+        try:
+            with open(cache_file, 'r') as f:
+                file_tables = json.load(f)
+        except (OSError, IOError, ValueError) as e:
+            if os.path.exists(cache_file):
+                logging.warning('can not load tables from %s: %s' %
+                                (cache_file, e))
+    table = file_tables.get(_table_id(key))
+    if table is None:
+        return None
+    try:
+        table = bytes(bytearray.fromhex(table))
+    except (TypeError, ValueError):
+        return None
+    if sorted(bytearray(table)) != list(range(256)):
+        return None
+    return table
+
+
+def save_table(key, encrypt_table):
+    # merged with what other processes may have saved meanwhile, written
+    # to a temporary file which then replaces cache_file
+    tables = {}
+    try:
+        with open(cache_file, 'r') as f:
+            tables = json.load(f)
+    except (OSError, IOError, ValueError):
+        pass
+    tables[_table_id(key)] = ''.join('%02x' % x
+                                     for x in bytearray(encrypt_table))
+    file_tables.update(tables)
+    tmp_path = '%s.%d.tmp' % (cache_file, os.getpid())
+    try:
+        # a table is as good as the password
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(tables, f)
+        os.replace(tmp_path, cache_file)
+    except (OSError, IOError) as e:
+        logging.warning('can not save tables to %s: %s' % (cache_file, e))
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+
+
 def init_table(key):
     if key not in cached_tables:
-        encrypt_table = b''.join(get_table(key))
+        encrypt_table = None
+        if cache_file:
+            encrypt_table = load_table(key)
+        if encrypt_table is None:
+            encrypt_table = b''.join(get_table(key))
+            if cache_file:
+                save_table(key, encrypt_table)
         decrypt_table = maketrans(encrypt_table, maketrans(b'', b''))
         cached_tables[key] = [encrypt_table, decrypt_table]
     return cached_tables[key]
@@ -85,7 +167,7 @@ ciphers = {
 
 
 def test_table_result():
-    from shadowsocks.common import ord
+    from shadowsocksr_cli.shadowsocks.common import ord
     target1 = [
         [60, 53, 84, 138, 217, 94, 88, 23, 39, 242, 219, 35, 12, 157, 165, 181,
          255, 143, 83, 247, 162, 16, 31, 209, 190, 171, 115, 65, 38, 41, 21,
@@ -173,8 +255,45 @@ def test_table_result():
         assert (target2[1][i] == ord(decrypt_table[i]))
 
 
+def test_reference():
+    for key in (b'', b'foobar!', b'\xff' * 16, os.urandom(16)):
+        assert get_table(key) == get_table_reference(key)
+
+
+def test_cache_file():
+    global cache_file, file_tables
+    import tempfile
+    cache_file = os.path.join(tempfile.mkdtemp(), 'tables.json')
+    try:
+        encrypt_table = init_table(b'cached!')[0]
+        assert os.stat(cache_file).st_mode & 0o777 == 0o600
+        cached_tables.clear()
+        file_tables = None
+        assert load_table(b'cached!') == encrypt_table
+        assert init_table(b'cached!')[0] == encrypt_table
+        assert load_table(b'other') is None
+        os.unlink(cache_file)
+    finally:
+        cache_file = None
+        file_tables = None
+
+
+def bench(count=10):
+    import time
+    start = time.time()
+    for i in range(count):
+        get_table_reference(struct.pack('>I', i))
+    reference = (time.time() - start) / count
+    start = time.time()
+    for i in range(count):
+        get_table(struct.pack('>I', i))
+    fast = (time.time() - start) / count
+    print('get_table: reference %.1f ms, now %.1f ms' %
+          (reference * 1000, fast * 1000))
+
+
 def test_encryption():
-    from shadowsocks.crypto import util
+    from shadowsocksr_cli.shadowsocks.crypto import util
 
     cipher = TableCipher('table', b'test', b'', 1)
     decipher = TableCipher('table', b'test', b'', 0)
@@ -183,5 +302,11 @@ def test_encryption():
 
 
 if __name__ == '__main__':
-    test_table_result()
-    test_encryption()
+    import sys
+    if sys.argv[1:] == ['bench']:
+        bench()
+    else:
+        test_table_result()
+        test_reference()
+        test_cache_file()
+        test_encryption()
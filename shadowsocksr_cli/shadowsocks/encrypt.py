@@ -22,7 +22,8 @@ import sys
 import hashlib
 
 from shadowsocksr_cli.shadowsocks import common, lru_cache
-from shadowsocksr_cli.shadowsocks.crypto import rc4_md5, openssl, sodium, table
+from shadowsocksr_cli.shadowsocks.crypto import rc4_md5, openssl, sodium, \
+    table, aead
 
 logging = common.logging
 
@@ -39,7 +40,10 @@ def random_string(length):
     except NotImplementedError as e:
         return openssl.rand_bytes(length)
 
-cached_keys = lru_cache.LRUCache(timeout=180)
+# (password, key_len, iv_len) -> (key, iv) derived by EVP_BytesToKey(),
+# dropped once unused for this long
+KEY_CACHE_TIMEOUT = 180
+cached_keys = lru_cache.LRUCache(timeout=KEY_CACHE_TIMEOUT)
 
 
 def try_cipher(key, method=None):
@@ -49,10 +53,9 @@ def try_cipher(key, method=None):
 def EVP_BytesToKey(password, key_len, iv_len, cache):
     # equivalent to OpenSSL's EVP_BytesToKey() with count 1
     # so that we make the same key and iv as nodejs version
-    cached_key = '%s-%d-%d' % (password, key_len, iv_len)
-    r = cached_keys.get(cached_key, None)
-    if r:
-        return r
+    cached_key = (password, key_len, iv_len)
+    if cached_key in cached_keys:
+        return cached_keys[cached_key]
     m = []
     i = 0
     while len(b''.join(m)) < (key_len + iv_len):
@@ -67,8 +70,9 @@ def EVP_BytesToKey(password, key_len, iv_len, cache):
     key = ms[:key_len]
     iv = ms[key_len:key_len + iv_len]
     if cache:
-        cached_keys[cached_key] = (key, iv)
+        # only the stale keys at the head of the LRU list are looked at
         cached_keys.sweep()
+        cached_keys[cached_key] = (key, iv)
     return key, iv
 
 
@@ -151,9 +155,26 @@ class Encryptor(object):
             return b''
 
     def dispose(self):
+        # hands the cipher contexts back for the next connection
         if self.decipher is not None:
             self.decipher.clean()
             self.decipher = None
+        if self.cipher is not None:
+            self.cipher.clean()
+            self.cipher = None
+
+def crypt_packet(cipher, op, data):
+    # a whole UDP packet; an AEAD one that fails authentication is dropped
+    if not isinstance(cipher, aead.AeadCryptoBase):
+        return cipher.update(data)
+    if op:
+        return cipher.encrypt_once(data)
+    try:
+        return cipher.decrypt_once(data)
+    except Exception as e:
+        logging.debug('drop a packet: %s' % e)
+        return b''
+
 
 def encrypt_all(password, method, op, data):
     result = []
@@ -170,7 +191,7 @@ def encrypt_all(password, method, op, data):
         iv = data[:iv_len]
         data = data[iv_len:]
     cipher = m(method, key, iv, op)
-    result.append(cipher.update(data))
+    result.append(crypt_packet(cipher, op, data))
     return b''.join(result)
 
 def encrypt_key(password, method):
@@ -204,7 +225,7 @@ def encrypt_all_iv(key, method, op, data, ref_iv):
         data = data[iv_len:]
         ref_iv[0] = iv
     cipher = m(method, key, iv, op)
-    result.append(cipher.update(data))
+    result.append(crypt_packet(cipher, op, data))
     return b''.join(result)
 
 
@@ -215,6 +236,10 @@ CIPHERS_TO_TEST = [
     'salsa20',
     'chacha20',
     'table',
+    'aes-128-gcm',
+    'aead-aes-128-gcm',
+    'aead-aes-256-gcm',
+    'chacha20-ietf-poly1305',
 ]
 
 
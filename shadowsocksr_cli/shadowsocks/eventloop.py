@@ -22,6 +22,7 @@ from __future__ import absolute_import, division, print_function, \
     with_statement
 
 import os
+import math
 import time
 import socket
 import select
@@ -31,8 +32,8 @@ from collections import defaultdict
 from shadowsocksr_cli.shadowsocks import shell
 from shadowsocksr_cli.shadowsocks.common import logging
 
-__all__ = ['EventLoop', 'POLL_NULL', 'POLL_IN', 'POLL_OUT', 'POLL_ERR',
-           'POLL_HUP', 'POLL_NVAL', 'EVENT_NAMES']
+__all__ = ['EventLoop', 'TimerWheel', 'POLL_NULL', 'POLL_IN', 'POLL_OUT', 'POLL_ERR',
+           'POLL_HUP', 'POLL_NVAL', 'POLL_ET', 'EVENT_NAMES']
 
 POLL_NULL = 0x00
 POLL_IN = 0x01
@@ -40,6 +41,8 @@ POLL_OUT = 0x04
 POLL_ERR = 0x08
 POLL_HUP = 0x10
 POLL_NVAL = 0x20
+# edge triggered registration, epoll only
+POLL_ET = getattr(select, 'EPOLLET', 1 << 31)
 
 
 EVENT_NAMES = {
@@ -54,6 +57,21 @@ EVENT_NAMES = {
 # we check timeouts every TIMEOUT_PRECISION seconds
 TIMEOUT_PRECISION = 2
 
+# when poll() returns a full batch, more fds are probably ready; poll again
+# without blocking, at most MAX_DISPATCH_ROUNDS times, before running timers
+MAX_DISPATCH_ROUNDS = 8
+
+# timers registered with call_later() fire with TIMER_TICK resolution
+TIMER_TICK = 0.1
+TIMER_WHEEL_BITS = 6
+TIMER_WHEEL_SIZE = 1 << TIMER_WHEEL_BITS
+TIMER_WHEEL_MASK = TIMER_WHEEL_SIZE - 1
+# 4 levels of 64 slots cover 2 ** 24 ticks, about 19 days
+TIMER_WHEEL_LEVELS = 4
+TIMER_WHEEL_RANGE = 1 << (TIMER_WHEEL_BITS * TIMER_WHEEL_LEVELS)
+
+monotonic = getattr(time, 'monotonic', time.time)
+
 
 class KqueueLoop(object):
 
@@ -141,42 +159,212 @@ class SelectLoop(object):
         pass
 
 
+class TimerHandle(object):
+    __slots__ = ('expires', 'callback', 'args', '_wheel', '_bucket', '_level')
+
+    def __init__(self, wheel, expires, callback, args):
+        self.expires = expires
+        self.callback = callback
+        self.args = args
+        self._wheel = wheel
+        self._bucket = None
+        self._level = 0
+
+    def active(self):
+        return self._bucket is not None
+
+    def cancel(self):
+        # O(1), safe to call more than once or after the timer fired
+        bucket = self._bucket
+        if bucket is not None:
+            bucket.remove(self)
+            self._bucket = None
+            self._wheel._counts[self._level] -= 1
+            self._wheel._count -= 1
+
+
+class TimerWheel(object):
+    # hierarchical timing wheel, the same scheme as the classic Linux kernel
+    # timers: level 0 holds timers due in the next TIMER_WHEEL_SIZE ticks,
+    # every higher level covers TIMER_WHEEL_SIZE times the range of the one
+    # below and is cascaded down whenever the lower level wraps around.
+    # add & cancel are O(1), running a tick is O(timers due in it)
+
+    def __init__(self, now, tick=TIMER_TICK):
+        self._tick = tick
+        # the next tick to be processed
+        self._jiffies = int(math.floor(now / tick))
+        self._wheels = [[set() for i in range(TIMER_WHEEL_SIZE)]
+                        for l in range(TIMER_WHEEL_LEVELS)]
+        self._counts = [0] * TIMER_WHEEL_LEVELS
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def add(self, deadline, callback, args=()):
+        expires = int(math.ceil(deadline / self._tick))
+        handle = TimerHandle(self, expires, callback, args)
+        self._insert(handle)
+        self._count += 1
+        return handle
+
+    def _insert(self, handle):
+        expires = handle.expires
+        idx = expires - self._jiffies
+        if idx < 0:
+            # already due, run it on the next tick
+            expires = self._jiffies
+            idx = 0
+        elif idx >= TIMER_WHEEL_RANGE:
+            # too far away, park it at the end and re-insert on cascade
+            expires = self._jiffies + TIMER_WHEEL_RANGE - 1
+            idx = TIMER_WHEEL_RANGE - 1
+        level = 0
+        while idx >= 1 << (TIMER_WHEEL_BITS * (level + 1)):
+            level += 1
+        bucket = self._wheels[level][
+            (expires >> (TIMER_WHEEL_BITS * level)) & TIMER_WHEEL_MASK]
+        bucket.add(handle)
+        handle._bucket = bucket
+        handle._level = level
+        self._counts[level] += 1
+
+    def _cascade(self, level):
+        index = (self._jiffies >> (TIMER_WHEEL_BITS * level)) & \
+            TIMER_WHEEL_MASK
+        bucket = self._wheels[level][index]
+        handles = list(bucket)
+        bucket.clear()
+        self._counts[level] -= len(handles)
+        for handle in handles:
+            self._insert(handle)
+        return index
+
+    def next_timeout(self, now, max_timeout):
+        # how long poll() may sleep before the next tick with work to do
+        if not self._count:
+            return max_timeout
+        jiffies = self._jiffies
+        wheel = self._wheels[0]
+        # the next cascade is due when level 0 wraps around
+        if jiffies & TIMER_WHEEL_MASK:
+            stop = (jiffies | TIMER_WHEEL_MASK) + 1
+        else:
+            stop = jiffies
+        while jiffies < stop:
+            if wheel[jiffies & TIMER_WHEEL_MASK]:
+                break
+            jiffies += 1
+        timeout = jiffies * self._tick - now
+        if timeout < 0:
+            return 0
+        return min(timeout, max_timeout)
+
+    def run(self, now):
+        # tolerate float rounding, 0.3 / 0.1 is 2.9999999999999996
+        target = int(math.floor(now / self._tick + 1e-6))
+        if not self._count:
+            # nothing scheduled, just catch up with the clock
+            if target >= self._jiffies:
+                self._jiffies = target + 1
+            return
+        wheel = self._wheels[0]
+        counts = self._counts
+        while self._jiffies <= target:
+            index = self._jiffies & TIMER_WHEEL_MASK
+            if index and not counts[0]:
+                # level 0 is empty, skip ahead to where it wraps around
+                self._jiffies = min((self._jiffies | TIMER_WHEEL_MASK) + 1,
+                                    target + 1)
+                continue
+            level = 1
+            while index == 0 and level < TIMER_WHEEL_LEVELS:
+                index = self._cascade(level)
+                level += 1
+            bucket = wheel[self._jiffies & TIMER_WHEEL_MASK]
+            self._jiffies += 1
+            while bucket:
+                handle = bucket.pop()
+                handle._bucket = None
+                counts[0] -= 1
+                self._count -= 1
+                try:
+                    handle.callback(*handle.args)
+                except Exception as e:
+                    shell.print_exception(e)
+            if not self._count:
+                self._jiffies = target + 1
+                break
+
+
 class EventLoop(object):
-    def __init__(self):
+    def __init__(self, edge_triggered=False):
+        # edge_triggered: fds added with edge=True are registered with
+        # EPOLLET; their handlers must read them until EAGAIN. Ignored by
+        # the kqueue and select backends
+        self.edge_triggered = False
         if hasattr(select, 'epoll'):
             self._impl = select.epoll()
+            self.edge_triggered = bool(edge_triggered)
+            # epoll.poll() returns at most FD_SETSIZE - 1 events by default
+            self._max_events = 1023
             model = 'epoll'
         elif hasattr(select, 'kqueue'):
             self._impl = KqueueLoop()
+            self._max_events = KqueueLoop.MAX_EVENTS
             model = 'kqueue'
         elif hasattr(select, 'select'):
             self._impl = SelectLoop()
+            self._max_events = 0
             model = 'select'
         else:
             raise Exception('can not find any available functions in select '
                             'package')
         self._fdmap = {}  # (f, handler)
-        self._last_time = time.time()
+        self._fdmode = {}  # registered mode, to skip no-op modify()
         self._periodic_callbacks = []
+        self._now = monotonic()
+        # periodic callbacks run on the same clock as the timers
+        self._last_time = self._now
+        self._timers = TimerWheel(self._now)
         self._stopping = False
+        self._stats = {
+            'iterations': 0,
+            'events': 0,
+            'handled': 0,
+            'last_events': 0,
+            'last_handled': 0,
+            'lag': 0.0,
+            'max_lag': 0.0,
+            'modify': 0,
+            'modify_skipped': 0,
+        }
+        if self.edge_triggered:
+            model += ' (edge triggered)'
         logging.debug('using event model: %s', model)
 
     def poll(self, timeout=None):
         events = self._impl.poll(timeout)
         return [(self._fdmap[fd][0], fd, event) for fd, event in events]
 
-    def add(self, f, mode, handler):
+    def add(self, f, mode, handler, edge=False):
         fd = f.fileno()
+        if edge and self.edge_triggered:
+            mode |= POLL_ET
         self._fdmap[fd] = (f, handler)
+        self._fdmode[fd] = mode
         self._impl.register(fd, mode)
 
     def remove(self, f):
         fd = f.fileno()
         del self._fdmap[fd]
+        self._fdmode.pop(fd, None)
         self._impl.unregister(fd)
 
     def removefd(self, fd):
         del self._fdmap[fd]
+        self._fdmode.pop(fd, None)
         self._impl.unregister(fd)
 
     def add_periodic(self, callback):
@@ -185,19 +373,71 @@ class EventLoop(object):
     def remove_periodic(self, callback):
         self._periodic_callbacks.remove(callback)
 
+    def time(self):
+        # monotonic time of the current iteration, read once after poll()
+        # returns; for per event bookkeeping that doesn't need precision
+        return self._now
+
+    def call_later(self, delay, callback, *args):
+        # run callback(*args) once, delay seconds from now; returns a
+        # TimerHandle that can be cancelled
+        return self._timers.add(monotonic() + delay, callback, args)
+
     def modify(self, f, mode):
         fd = f.fileno()
+        registered = self._fdmode.get(fd)
+        if registered is not None:
+            mode |= registered & POLL_ET
+            if registered == mode:
+                self._stats['modify_skipped'] += 1
+                return
         self._impl.modify(fd, mode)
+        self._fdmode[fd] = mode
+        self._stats['modify'] += 1
+
+    def rearm(self, f):
+        # re-register an edge triggered fd with the same mode, epoll then
+        # reports it again if it is still ready. Used by handlers that stop
+        # reading before EAGAIN to let other fds run
+        fd = f.fileno()
+        mode = self._fdmode.get(fd)
+        if mode is not None and mode & POLL_ET:
+            self._impl.modify(fd, mode)
 
     def stop(self):
         self._stopping = True
 
+    def get_stats(self):
+        # events / handled: totals since start
+        # last_events / last_handled: in the last iteration
+        # lag: seconds the last iteration spent outside poll(), a saturated
+        # loop has a high lag and full batches, an idle one neither
+        # modify / modify_skipped: mode changes passed to the backend and
+        # those dropped because the fd already had that mode
+        return self._stats.copy()
+
+    def _dispatch(self, events):
+        handled = 0
+        for sock, fd, event in events:
+            handler = self._fdmap.get(fd, None)
+            if handler is not None:
+                handler = handler[1]
+                try:
+                    if handler.handle_event(sock, fd, event):
+                        handled += 1
+                except (OSError, IOError) as e:
+                    shell.print_exception(e)
+        return handled
+
     def run(self):
-        events = []
+        stats = self._stats
         while not self._stopping:
             asap = False
+            events = []
+            timeout = self._timers.next_timeout(monotonic(),
+                                                TIMEOUT_PRECISION)
             try:
-                events = self.poll(TIMEOUT_PRECISION)
+                events = self.poll(timeout)
             except (OSError, IOError) as e:
                 if errno_from_exception(e) in (errno.EPIPE, errno.EINTR):
                     # EPIPE: Happens when the client closes the connection
@@ -211,22 +451,38 @@ class EventLoop(object):
                     traceback.print_exc()
                     continue
 
-            handle = False
-            for sock, fd, event in events:
-                handler = self._fdmap.get(fd, None)
-                if handler is not None:
-                    handler = handler[1]
-                    try:
-                        handle = handler.handle_event(sock, fd, event) or handle
-                    except (OSError, IOError) as e:
-                        shell.print_exception(e)
-            now = time.time()
+            start = self._now = monotonic()
+            event_count = len(events)
+            handled = self._dispatch(events)
+            rounds = 1
+            # there is no sleep here: handlers that can not make progress
+            # (e.g. over the speed limit) drop the fd from the poll mask
+            while self._max_events and len(events) >= self._max_events \
+                    and rounds < MAX_DISPATCH_ROUNDS and not self._stopping:
+                try:
+                    events = self.poll(0)
+                except (OSError, IOError) as e:
+                    logging.debug('poll:%s', e)
+                    break
+                event_count += len(events)
+                handled += self._dispatch(events)
+                rounds += 1
+            self._timers.run(monotonic())
+            now = self.time()
             if asap or now - self._last_time >= TIMEOUT_PRECISION:
                 for callback in self._periodic_callbacks:
                     callback()
                 self._last_time = now
-            if events and not handle:
-                time.sleep(0.001)
+
+            lag = monotonic() - start
+            stats['iterations'] += 1
+            stats['events'] += event_count
+            stats['handled'] += handled
+            stats['last_events'] = event_count
+            stats['last_handled'] = handled
+            stats['lag'] = lag
+            if lag > stats['max_lag']:
+                stats['max_lag'] = lag
 
     def __del__(self):
         self._impl.close()
@@ -255,3 +511,105 @@ def errno_from_exception(e):
 def get_sock_error(sock):
     error_number = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
     return socket.error(error_number, os.strerror(error_number))
+
+
+def test_timer_wheel():
+    fired = []
+    wheel = TimerWheel(0)
+    wheel.add(0.25, fired.append, ('a',))
+    wheel.add(30, fired.append, ('b',))
+    wheel.add(3600, fired.append, ('c',))
+    wheel.add(86400 * 30, fired.append, ('d',))
+    cancelled = wheel.add(0.5, fired.append, ('x',))
+    assert len(wheel) == 5
+    cancelled.cancel()
+    cancelled.cancel()
+    assert len(wheel) == 4
+    assert wheel.next_timeout(0, TIMEOUT_PRECISION) <= 0.3
+
+    wheel.run(0.2)
+    assert fired == []
+    wheel.run(0.3)
+    assert fired == ['a']
+    t = 0.3
+    while t < 3599:
+        t += 0.7
+        wheel.run(t)
+    assert fired == ['a', 'b']
+    wheel.run(3600)
+    assert fired == ['a', 'b', 'c']
+    wheel.run(86400 * 30)
+    assert fired == ['a', 'b', 'c', 'd']
+    assert len(wheel) == 0
+
+
+def test():
+    test_timer_wheel()
+
+    loop = EventLoop()
+    fired = []
+
+    def callback(name):
+        fired.append(name)
+        if name == 'stop':
+            loop.stop()
+
+    loop.call_later(0.2, callback, 'second')
+    loop.call_later(0.1, callback, 'first')
+    loop.call_later(0.15, callback, 'cancelled').cancel()
+    loop.call_later(0.3, callback, 'stop')
+    loop.run()
+    assert fired == ['first', 'second', 'stop']
+
+    # a pending datagram is dispatched once, without any sleeping
+    class Handler(object):
+        def handle_event(self, sock, fd, event):
+            sock.recv(1024)
+            return True
+
+    r = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    r.bind(('127.0.0.1', 0))
+    w = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    w.sendto(b'ping', r.getsockname())
+    loop = EventLoop()
+    loop.add(r, POLL_IN, Handler())
+    loop.call_later(0.1, loop.stop)
+    loop.run()
+    stats = loop.get_stats()
+    assert stats['events'] == 1 and stats['handled'] == 1
+    assert stats['iterations'] >= 2
+    loop.modify(r, POLL_IN)
+    assert loop.get_stats()['modify_skipped'] == 1
+    loop.remove(r)
+    r.close()
+    w.close()
+
+    if not hasattr(select, 'epoll'):
+        return
+    # edge triggered: one event per arrival, rearm() reports it again
+    class Counter(object):
+        def __init__(self):
+            self.count = 0
+
+        def handle_event(self, sock, fd, event):
+            self.count += 1
+            return True
+
+    r = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    r.bind(('127.0.0.1', 0))
+    w = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    w.sendto(b'ping', r.getsockname())
+    counter = Counter()
+    loop = EventLoop(edge_triggered=True)
+    loop.add(r, POLL_IN, counter, edge=True)
+    loop.call_later(0.1, loop.rearm, r)
+    loop.call_later(0.3, loop.stop)
+    loop.run()
+    assert counter.count == 2
+    loop.remove(r)
+    r.close()
+    w.close()
+
+
+if __name__ == '__main__':
+    test()
@@ -28,102 +28,161 @@ if __name__ == '__main__':
     file_path = os.path.dirname(os.path.realpath(inspect.getfile(inspect.currentframe())))
     sys.path.insert(0, os.path.join(file_path, '../'))
 
-try:
-    from collections import OrderedDict
-except:
-    from shadowsocks.ordereddict import OrderedDict
-
 # this LRUCache is optimized for concurrency, not QPS
 # n: concurrency, keys stored in the cache
 # m: visits not timed out, proportional to QPS * timeout
 # get & set is O(1), not O(n). thus we can support very large n
 # sweep is O((n - m)) or O(1024) at most,
 # no metter how large the cache or timeout value is
+# once added to an event loop, every key gets a timer and expires on its own,
+# there is no need to call sweep() any more
+#
+# keys live in a single dict of nodes which are also linked in a circular
+# list, least recently used first, so a visit is a few pointer swaps and a
+# read of the clock. Once added to an event loop the clock is the loop's,
+# read once per iteration instead of once per visit
 
 SWEEP_MAX_ITEMS = 1024
 
+monotonic = getattr(time, 'monotonic', time.time)
+
+
+class _Node(object):
+    __slots__ = ('prev', 'next', 'key', 'value', 'last_time', 'timer')
+
+    def __init__(self, key=None, value=None, last_time=0):
+        self.prev = self.next = self
+        self.key = key
+        self.value = value
+        self.last_time = last_time
+        self.timer = None
+
+
 class LRUCache(collections.MutableMapping):
     """This class is not thread safe"""
 
     def __init__(self, timeout=60, close_callback=None, *args, **kwargs):
         self.timeout = timeout
         self.close_callback = close_callback
-        self._store = {}
-        self._keys_to_last_time = OrderedDict()
+        self._map = {}
+        # root.next is the least recently used node, root.prev the most
+        self._root = _Node()
+        self._loop = None
+        self._clock = monotonic
         self.update(dict(*args, **kwargs))  # use the free update to set keys
 
+    def add_to_loop(self, loop):
+        if self._loop:
+            raise Exception('already add to loop')
+        self._loop = loop
+        self._clock = loop.time
+        for node in self._map.values():
+            node.timer = loop.call_later(self.timeout, self._expire, node)
+
+    def _remove(self, node):
+        del self._map[node.key]
+        node.prev.next = node.next
+        node.next.prev = node.prev
+        if node.timer is not None:
+            node.timer.cancel()
+            node.timer = None
+
+    def _expire(self, node):
+        # timer callback, the key may have been visited since it was set
+        node.timer = None
+        idle = self._clock() - node.last_time
+        if idle <= self.timeout:
+            node.timer = self._loop.call_later(self.timeout - idle,
+                                               self._expire, node)
+            return
+        self._remove(node)
+        if self.close_callback is not None:
+            self.close_callback(node.value)
+
     def __getitem__(self, key):
         # O(1)
-        t = time.time()
-        last_t = self._keys_to_last_time[key]
-        del self._keys_to_last_time[key]
-        self._keys_to_last_time[key] = t
-        return self._store[key]
+        node = self._map[key]
+        node.last_time = self._clock()
+        root = self._root
+        if node.next is not root:
+            node.prev.next = node.next
+            node.next.prev = node.prev
+            last = root.prev
+            node.prev = last
+            node.next = root
+            last.next = root.prev = node
+        return node.value
 
     def __setitem__(self, key, value):
         # O(1)
-        t = time.time()
-        if key in self._keys_to_last_time:
-            del self._keys_to_last_time[key]
-        self._keys_to_last_time[key] = t
-        self._store[key] = value
+        node = self._map.get(key)
+        root = self._root
+        if node is None:
+            node = self._map[key] = _Node(key, value, self._clock())
+            if self._loop is not None:
+                node.timer = self._loop.call_later(self.timeout,
+                                                   self._expire, node)
+        else:
+            node.value = value
+            node.last_time = self._clock()
+            if node.next is root:
+                return
+            node.prev.next = node.next
+            node.next.prev = node.prev
+        last = root.prev
+        node.prev = last
+        node.next = root
+        last.next = root.prev = node
 
     def __delitem__(self, key):
         # O(1)
-        last_t = self._keys_to_last_time[key]
-        del self._store[key]
-        del self._keys_to_last_time[key]
+        self._remove(self._map[key])
 
     def __contains__(self, key):
-        return key in self._store
+        return key in self._map
+
+    def peek(self, key, default=None):
+        # get without counting as a visit
+        node = self._map.get(key)
+        if node is None:
+            return default
+        return node.value
 
     def __iter__(self):
-        return iter(self._store)
+        return iter(self._map)
 
     def __len__(self):
-        return len(self._store)
+        return len(self._map)
 
     def first(self):
-        if len(self._keys_to_last_time) > 0:
-            for key in self._keys_to_last_time:
-                return key
+        node = self._root.next
+        if node is not self._root:
+            return node.key
 
     def sweep(self, sweep_item_cnt = SWEEP_MAX_ITEMS):
         # O(n - m)
-        now = time.time()
+        now = self._clock()
+        root = self._root
         c = 0
         while c < sweep_item_cnt:
-            if len(self._keys_to_last_time) == 0:
-                break
-            for key in self._keys_to_last_time:
+            node = root.next
+            if node is root or now - node.last_time <= self.timeout:
                 break
-            last_t = self._keys_to_last_time[key]
-            if now - last_t <= self.timeout:
-                break
-            value = self._store[key]
-            del self._store[key]
-            del self._keys_to_last_time[key]
+            self._remove(node)
             if self.close_callback is not None:
-                self.close_callback(value)
+                self.close_callback(node.value)
             c += 1
         if c:
             logging.debug('%d keys swept' % c)
         return c < SWEEP_MAX_ITEMS
 
     def clear(self, keep):
-        now = time.time()
         c = 0
-        while len(self._keys_to_last_time) > keep:
-            if len(self._keys_to_last_time) == 0:
-                break
-            for key in self._keys_to_last_time:
-                break
-            last_t = self._keys_to_last_time[key]
-            value = self._store[key]
+        while len(self._map) > keep:
+            node = self._root.next
             if self.close_callback is not None:
-                self.close_callback(value)
-            del self._store[key]
-            del self._keys_to_last_time[key]
+                self.close_callback(node.value)
+            self._remove(node)
             c += 1
         if c:
             logging.debug('%d keys swept' % c)
@@ -176,5 +235,67 @@ def test():
     time.sleep(0.3)
     c.sweep()
 
+    c = LRUCache()
+    for key in 'abcd':
+        c[key] = key
+    c['b']
+    c['a'] = 'A'
+    del c['c']
+    assert c.first() == 'd'
+    c.clear(1)
+    assert list(c.items()) == [('a', 'A')]
+    assert c.first() == 'a' and c.peek('b') is None
+
+    from shadowsocksr_cli.shadowsocks import eventloop
+    loop = eventloop.EventLoop()
+    closed = []
+    c = LRUCache(timeout=0.3, close_callback=closed.append)
+    c.add_to_loop(loop)
+    c['a'] = 1
+    c['b'] = 2
+    c['c'] = 3
+    del c['c']
+
+    def visit():
+        c['b']
+
+    loop.call_later(0.2, visit)
+    loop.call_later(0.45, lambda: closed.append(sorted(c.keys())))
+    loop.call_later(0.7, loop.stop)
+    loop.run()
+    assert closed == [1, ['b'], 2]
+    assert len(c) == 0 and c.first() is None
+
+
+def bench(sizes=(1000, 100000, 1000000)):
+    # visits, updates and sweeps per second with n keys in the cache
+    import random
+    for n in sizes:
+        keys = list(range(n))
+        c = LRUCache(timeout=60)
+        for key in keys:
+            c[key] = key
+        random.shuffle(keys)
+        visits = keys[:100000]
+        start = time.time()
+        for key in visits:
+            c[key]
+        get_rate = len(visits) / (time.time() - start)
+        start = time.time()
+        for key in visits:
+            c[key] = key
+        set_rate = len(visits) / (time.time() - start)
+        c.timeout = -1
+        start = time.time()
+        while len(c):
+            c.sweep()
+        sweep_rate = n / (time.time() - start)
+        print('%8d keys: get %.2fM/s, set %.2fM/s, sweep %.2fM/s' %
+              (n, get_rate / 1e6, set_rate / 1e6, sweep_rate / 1e6))
+
+
 if __name__ == '__main__':
-    test()
+    if sys.argv[1:] == ['bench']:
+        bench()
+    else:
+        test()
@@ -0,0 +1,328 @@
+#!/usr/bin/env python
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+# recvmmsg / sendmmsg for UDP sockets through ctypes, Linux only
+
+from __future__ import absolute_import, division, print_function, \
+    with_statement
+
+import os
+import errno
+import sys
+import socket
+import struct
+import ctypes
+from ctypes import c_void_p, c_int, c_uint, c_size_t, c_char, \
+    Structure, POINTER, addressof, string_at
+
+__all__ = ['available', 'MessageBatch']
+
+# datagrams per syscall
+BATCH_SIZE = 16
+BUF_SIZE = 65536
+# remembered sockaddr <-> address tuple conversions
+ADDR_CACHE_SIZE = 1024
+
+libc = None
+loaded = False
+
+
+class iovec(Structure):
+    _fields_ = [('iov_base', c_void_p),
+                ('iov_len', c_size_t)]
+
+
+class msghdr(Structure):
+    _fields_ = [('msg_name', c_void_p),
+                ('msg_namelen', c_uint),
+                ('msg_iov', POINTER(iovec)),
+                ('msg_iovlen', c_size_t),
+                ('msg_control', c_void_p),
+                ('msg_controllen', c_size_t),
+                ('msg_flags', c_int)]
+
+
+class mmsghdr(Structure):
+    _fields_ = [('msg_hdr', msghdr),
+                ('msg_len', c_uint)]
+
+
+# struct sockaddr_storage
+SOCKADDR_SIZE = 128
+
+
+def load_libc():
+    global libc, loaded
+    loaded = True
+    if not sys.platform.startswith('linux'):
+        return
+    try:
+        lib = ctypes.CDLL(None, use_errno=True)
+    except OSError:
+        return
+    if not hasattr(lib, 'recvmmsg') or not hasattr(lib, 'sendmmsg'):
+        return
+    lib.recvmmsg.argtypes = (c_int, POINTER(mmsghdr), c_uint, c_int,
+                             c_void_p)
+    lib.recvmmsg.restype = c_int
+    lib.sendmmsg.argtypes = (c_int, POINTER(mmsghdr), c_uint, c_int)
+    lib.sendmmsg.restype = c_int
+    libc = lib
+
+
+def available():
+    if not loaded:
+        load_libc()
+    return libc is not None
+
+
+def _raise_errno():
+    err = ctypes.get_errno()
+    raise socket.error(err, os.strerror(err))
+
+
+def parse_sockaddr(raw):
+    # same tuples as socket.recvfrom() returns
+    family = struct.unpack('=H', raw[:2])[0]
+    if family == socket.AF_INET:
+        return (socket.inet_ntop(socket.AF_INET, raw[4:8]),
+                struct.unpack('>H', raw[2:4])[0])
+    if family == socket.AF_INET6:
+        return (socket.inet_ntop(socket.AF_INET6, raw[8:24]),
+                struct.unpack('>H', raw[2:4])[0],
+                struct.unpack('>I', raw[4:8])[0],
+                struct.unpack('=I', raw[24:28])[0])
+    raise socket.error('unsupported address family %d' % family)
+
+
+def build_sockaddr(addr):
+    if ':' in addr[0]:
+        flowinfo = addr[2] if len(addr) > 2 else 0
+        scope_id = addr[3] if len(addr) > 3 else 0
+        return struct.pack('=H', socket.AF_INET6) + \
+            struct.pack('>HI', addr[1], flowinfo) + \
+            socket.inet_pton(socket.AF_INET6, addr[0]) + \
+            struct.pack('=I', scope_id)
+    return struct.pack('=H', socket.AF_INET) + struct.pack('>H', addr[1]) + \
+        socket.inet_pton(socket.AF_INET, addr[0]) + b'\x00' * 8
+
+
+def _sockaddr_len(addr):
+    if ':' in addr[0]:
+        return 28
+    return 16
+
+
+class MessageBatch(object):
+    # buffers for up to BATCH_SIZE datagrams, reused by every call; one
+    # instance serves any number of sockets of the same event loop
+
+    def __init__(self, count=BATCH_SIZE, buf_size=BUF_SIZE):
+        if not available():
+            raise Exception('recvmmsg/sendmmsg not available')
+        self._count = count
+        self._buf_size = buf_size
+        self._bufs = (c_char * (buf_size * count))()
+        self._names = (c_char * (SOCKADDR_SIZE * count))()
+        self._iovs = (iovec * count)()
+        self._msgs = (mmsghdr * count)()
+        bufs = addressof(self._bufs)
+        names = addressof(self._names)
+        for i in range(count):
+            self._iovs[i].iov_base = bufs + i * buf_size
+            self._iovs[i].iov_len = buf_size
+            hdr = self._msgs[i].msg_hdr
+            hdr.msg_name = names + i * SOCKADDR_SIZE
+            hdr.msg_iov = ctypes.pointer(self._iovs[i])
+            hdr.msg_iovlen = 1
+        self._parsed = {}
+        self._built = {}
+
+    def recv(self, sock):
+        # list of (data, addr), empty when nothing is waiting
+        msgs = self._msgs
+        for i in range(self._count):
+            msgs[i].msg_hdr.msg_namelen = SOCKADDR_SIZE
+        r = libc.recvmmsg(sock.fileno(), msgs, self._count, 0, None)
+        if r < 0:
+            if ctypes.get_errno() in (errno.EAGAIN,
+                                      errno.EWOULDBLOCK):
+                return []
+            _raise_errno()
+        bufs = addressof(self._bufs)
+        names = addressof(self._names)
+        parsed = self._parsed
+        result = []
+        for i in range(r):
+            hdr = msgs[i].msg_hdr
+            raw = string_at(names + i * SOCKADDR_SIZE, hdr.msg_namelen)
+            addr = parsed.get(raw)
+            if addr is None:
+                if len(parsed) >= ADDR_CACHE_SIZE:
+                    parsed.clear()
+                addr = parsed[raw] = parse_sockaddr(raw)
+            result.append((string_at(bufs + i * self._buf_size,
+                                     msgs[i].msg_len), addr))
+        return result
+
+    def send(self, sock, packets):
+        # sends a prefix of packets [(data, addr), ...], returns its length;
+        # raises if the first one fails
+        count = min(len(packets), self._count)
+        msgs = self._msgs
+        built = self._built
+        keep = []
+        for i in range(count):
+            data, addr = packets[i]
+            name = built.get(addr)
+            if name is None:
+                if len(built) >= ADDR_CACHE_SIZE:
+                    built.clear()
+                name = built[addr] = ctypes.create_string_buffer(
+                    build_sockaddr(addr), SOCKADDR_SIZE)
+            data = ctypes.create_string_buffer(data, len(data))
+            keep.append(data)
+            self._iovs[i].iov_base = addressof(data)
+            self._iovs[i].iov_len = len(data)
+            hdr = msgs[i].msg_hdr
+            hdr.msg_name = addressof(name)
+            hdr.msg_namelen = _sockaddr_len(addr)
+        r = libc.sendmmsg(sock.fileno(), msgs, count, 0)
+        self._reset()
+        if r < 0:
+            _raise_errno()
+        return r
+
+    def _reset(self):
+        # point the headers back at the receive buffers
+        bufs = addressof(self._bufs)
+        names = addressof(self._names)
+        for i in range(self._count):
+            self._iovs[i].iov_base = bufs + i * self._buf_size
+            self._iovs[i].iov_len = self._buf_size
+            self._msgs[i].msg_hdr.msg_name = names + i * SOCKADDR_SIZE
+
+
+def test_sockaddr():
+    for addr in (('127.0.0.1', 8388), ('10.1.2.3', 0),
+                 ('::1', 8388, 0, 0), ('fe80::1', 53, 7, 2)):
+        raw = build_sockaddr(addr)
+        assert len(raw) >= _sockaddr_len(addr)
+        assert parse_sockaddr(raw[:_sockaddr_len(addr)]) == addr
+    # flowinfo and scope id default to 0
+    assert parse_sockaddr(build_sockaddr(('::1', 53))) == ('::1', 53, 0, 0)
+
+
+def _recv_all(batch, sock, count):
+    import select
+    result = []
+    while len(result) < count:
+        if not select.select([sock], [], [], 1)[0]:
+            break
+        result.extend(batch.recv(sock))
+    return result
+
+
+def run_loopback(family, host):
+    # datagrams and source addresses as sendto() / recvfrom() see them
+    a = socket.socket(family, socket.SOCK_DGRAM)
+    b = socket.socket(family, socket.SOCK_DGRAM)
+    try:
+        for sock in (a, b):
+            sock.bind((host, 0))
+            sock.setblocking(False)
+        batch = MessageBatch(count=4, buf_size=2048)
+        assert batch.recv(a) == []
+        packets = [(struct.pack('B', i) * (i * 100 + 1), a.getsockname())
+                   for i in range(6)]
+        # at most count datagrams a call
+        assert batch.send(b, packets) == 4
+        assert batch.send(b, packets[4:]) == 2
+        assert _recv_all(batch, a, 6) == \
+            [(data, b.getsockname()) for data, addr in packets]
+        # longer than a buffer: cut, as recvfrom(buf_size) would
+        b.sendto(b'x' * 3000, a.getsockname())
+        assert _recv_all(batch, a, 1) == [(b'x' * 2048, b.getsockname())]
+        # a send doesn't leave the receive buffers pointing elsewhere
+        a.sendto(b'pong', b.getsockname())
+        assert _recv_all(batch, b, 1) == [(b'pong', a.getsockname())]
+    finally:
+        a.close()
+        b.close()
+
+
+def test_loopback():
+    run_loopback(socket.AF_INET, '127.0.0.1')
+    try:
+        socket.socket(socket.AF_INET6, socket.SOCK_DGRAM).bind(('::1', 0))
+    except (OSError, IOError, AttributeError):
+        print('IPv6 not available, skipped')
+        return
+    run_loopback(socket.AF_INET6, '::1')
+
+
+def test_fallback():
+    # without the syscalls UDPRelay reads and writes one datagram at a time
+    from shadowsocksr_cli.shadowsocks import udprelay
+    # this module as udprelay sees it, not __main__
+    mmsg = udprelay.mmsg
+    saved = mmsg.libc, mmsg.loaded
+    mmsg.libc, mmsg.loaded = None, True
+    relay = None
+    client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        assert not mmsg.available()
+        try:
+            mmsg.MessageBatch()
+        except Exception:
+            pass
+        else:
+            assert False, 'MessageBatch made without recvmmsg'
+        relay = udprelay.UDPRelay({
+            'server': '127.0.0.1', 'server_port': 0, 'password': 'k',
+            'method': 'table', 'timeout': 60, 'udp_timeout': 60,
+            'udp_cache': 8, 'protocol': 'origin', 'protocol_param': '',
+        }, None, False)
+        assert relay._mmsg is None
+        server_addr = relay._server_socket.getsockname()
+        client.bind(('127.0.0.1', 0))
+        for i in range(3):
+            client.sendto(b'%d' % i, server_addr)
+        import select
+        select.select([relay._server_socket], [], [], 1)
+        assert relay._recv_batch(relay._server_socket) == \
+            [(b'%d' % i, client.getsockname()) for i in range(3)]
+        relay.write_to_server_socket(b'a', client.getsockname())
+        relay.write_to_server_socket(b'b', client.getsockname())
+        relay._flush_server_socket()
+        assert client.recv(BUF_SIZE) == b'a'
+        assert client.recv(BUF_SIZE) == b'b'
+    finally:
+        mmsg.libc, mmsg.loaded = saved
+        if relay is not None:
+            relay.close()
+        client.close()
+
+
+def test():
+    test_sockaddr()
+    if not available():
+        print('recvmmsg/sendmmsg not available, skipped')
+    else:
+        test_loopback()
+    test_fallback()
+
+
+if __name__ == '__main__':
+    test()
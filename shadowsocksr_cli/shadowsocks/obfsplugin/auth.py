@@ -551,7 +551,7 @@ class auth_aes128_sha1(auth_base):
                 pass
         if self.user_key is None:
             self.user_key = self.server_info.key
-        encryptor = encrypt.Encryptor(to_bytes(base64.b64encode(self.user_key)) + self.salt, 'aes-128-cbc', b'\x00' * 16)
+        encryptor = encrypt.Encryptor(to_bytes(base64.b64encode(self.user_key)) + self.salt, 'aes-128-cbc', b'\x00' * 16, True)
         data = uid + encryptor.encrypt(data)[16:]
         data += hmac.new(mac_key, data, self.hashfunc).digest()[:4]
         check_head = os.urandom(1)
@@ -660,6 +660,8 @@ class auth_aes128_sha1(auth_base):
                 return self.not_match_return(self.recv_buf)
 
             uid = self.recv_buf[7:11]
+            # recv_iv differs on every connection, keys from it aren't cached
+            cache_key = True
             if uid in self.server_info.users:
                 self.user_id = uid
                 self.user_key = self.hashfunc(self.server_info.users[uid]).digest()
@@ -669,7 +671,8 @@ class auth_aes128_sha1(auth_base):
                     self.user_key = self.server_info.key
                 else:
                     self.user_key = self.server_info.recv_iv
-            encryptor = encrypt.Encryptor(to_bytes(base64.b64encode(self.user_key)) + self.salt, 'aes-128-cbc')
+                    cache_key = False
+            encryptor = encrypt.Encryptor(to_bytes(base64.b64encode(self.user_key)) + self.salt, 'aes-128-cbc', None, cache_key)
             head = encryptor.decrypt(b'\x00' * 16 + self.recv_buf[11:27] + b'\x00') # need an extra byte or recv empty
             length = struct.unpack('<H', head[12:14])[0]
             if len(self.recv_buf) < length:
@@ -387,7 +387,7 @@ class auth_chain_a(auth_base):
             self.user_key = self.server_info.key
 
         encryptor = encrypt.Encryptor(
-            to_bytes(base64.b64encode(self.user_key)) + self.salt, 'aes-128-cbc', b'\x00' * 16)
+            to_bytes(base64.b64encode(self.user_key)) + self.salt, 'aes-128-cbc', b'\x00' * 16, True)
 
         uid = struct.unpack('<I', uid)[0] ^ struct.unpack('<I', self.last_client_hash[8:12])[0]
         uid = struct.pack('<I', uid)
@@ -505,6 +505,8 @@ class auth_chain_a(auth_base):
             uid = struct.unpack('<I', self.recv_buf[12:16])[0] ^ struct.unpack('<I', md5data[8:12])[0]
             self.user_id_num = uid
             uid = struct.pack('<I', uid)
+            # recv_iv differs on every connection, keys from it aren't cached
+            cache_key = True
             if uid in self.server_info.users:
                 self.user_id = uid
                 self.user_key = self.server_info.users[uid]
@@ -515,6 +517,7 @@ class auth_chain_a(auth_base):
                     self.user_key = self.server_info.key
                 else:
                     self.user_key = self.server_info.recv_iv
+                    cache_key = False
 
             md5data = hmac.new(self.user_key, self.recv_buf[12: 12 + 20], self.hashfunc).digest()
             if md5data[:4] != self.recv_buf[32:36]:
@@ -527,7 +530,7 @@ class auth_chain_a(auth_base):
                 return self.not_match_return(self.recv_buf)
 
             self.last_server_hash = md5data
-            encryptor = encrypt.Encryptor(to_bytes(base64.b64encode(self.user_key)) + self.salt, 'aes-128-cbc')
+            encryptor = encrypt.Encryptor(to_bytes(base64.b64encode(self.user_key)) + self.salt, 'aes-128-cbc', None, cache_key)
             head = encryptor.decrypt(b'\x00' * 16 + self.recv_buf[16:32] + b'\x00')  # need an extra byte or recv empty
             self.client_over_head = struct.unpack('<H', head[12:14])[0]
 
@@ -70,7 +70,17 @@ def main():
 
     tcp_servers = []
     udp_servers = []
-    dns_resolver = asyncdns.DNSResolver(config['black_hostname_list'])
+    shared_cache_slots = 0
+    if int(config['workers']) > 1 and os.name == 'posix':
+        shared_cache_slots = config['dns_shared_cache']
+    dns_resolver = asyncdns.DNSResolver(config['black_hostname_list'],
+                                        config['dns_min_ttl'],
+                                        config['dns_max_ttl'],
+                                        config['dns_stale_ttl'],
+                                        config['black_hostname_file'],
+                                        config['dns_cache_file'],
+                                        config['dns_system_resolver'],
+                                        shared_cache_slots=shared_cache_slots)
     if int(config['workers']) > 1:
         stat_counter_dict = None
     else:
@@ -159,12 +169,13 @@ def main():
                       child_handler)
 
         def int_handler(signum, _):
+            dns_resolver.save_cache()
             sys.exit(1)
 
         signal.signal(signal.SIGINT, int_handler)
 
         try:
-            loop = eventloop.EventLoop()
+            loop = eventloop.EventLoop(config.get('edge_triggered', False))
             dns_resolver.add_to_loop(loop)
             list(map(lambda s: s.add_to_loop(loop), tcp_servers + udp_servers))
 
@@ -23,6 +23,7 @@ import json
 import sys
 import getopt
 from shadowsocksr_cli.shadowsocks import encrypt
+from shadowsocksr_cli.shadowsocks.crypto import table
 from shadowsocksr_cli.shadowsocks.common import to_bytes, to_str, IPNetwork, PortRange, logging
 
 VERBOSE_LEVEL = 5
@@ -119,6 +120,11 @@ def check_config(config, is_local):
     if config.get('timeout', 300) > 600:
         logging.warning('warning: your timeout %d seems too long' %
                         int(config.get('timeout')))
+    if to_str(config.get('method', '')).lower().endswith('-gcm') and \
+            not to_str(config['method']).lower().startswith('aead-'):
+        logging.warning('warning: %s is the stream mode of shadowsocksr, '
+                        'for shadowsocks AEAD use aead-%s' %
+                        (to_str(config['method']), to_str(config['method'])))
     if config.get('password') in [b'mypassword']:
         logging.error('DON\'T USE DEFAULT PASSWORD! Please change it in your '
                       'config.json!')
@@ -128,6 +134,8 @@ def check_config(config, is_local):
             logging.error('user can be used only on Unix')
             sys.exit(1)
 
+    # before the first table is built
+    table.cache_file = config.get('table_cache_file', None)
     encrypt.try_cipher(config['password'], config['method'])
 
 
@@ -244,6 +252,14 @@ def get_config(is_local):
     config['udp_timeout'] = int(config.get('udp_timeout', 120))
     config['udp_cache'] = int(config.get('udp_cache', 64))
     config['fast_open'] = config.get('fast_open', False)
+    config['edge_triggered'] = config.get('edge_triggered', False)
+    config['dns_min_ttl'] = int(config.get('dns_min_ttl', 30))
+    config['dns_max_ttl'] = int(config.get('dns_max_ttl', 3600))
+    config['dns_stale_ttl'] = int(config.get('dns_stale_ttl', 300))
+    # slots of the DNS cache shared by the workers, 0 to disable
+    config['dns_shared_cache'] = int(config.get('dns_shared_cache', 4096))
+    # fall back to the system resolver when the DNS servers fail
+    config['dns_system_resolver'] = config.get('dns_system_resolver', False)
     config['workers'] = config.get('workers', 1)
     config['pid-file'] = config.get('pid-file', '/var/run/shadowsocksr.pid')
     config['log-file'] = config.get('log-file', '/var/log/shadowsocksr.log')
@@ -263,6 +279,9 @@ def get_config(is_local):
         config['black_hostname_list'] = to_str(config.get('black_hostname_list', '')).split(',')
         if len(config['black_hostname_list']) == 1 and config['black_hostname_list'][0] == '':
             config['black_hostname_list'] = []
+        config['black_hostname_file'] = config.get('black_hostname_file', None)
+        config['dns_cache_file'] = config.get('dns_cache_file', None)
+        config['table_cache_file'] = config.get('table_cache_file', None)
         try:
             config['forbidden_ip'] = \
                 IPNetwork(config.get('forbidden_ip', '127.0.0.0/8,::1/128'))
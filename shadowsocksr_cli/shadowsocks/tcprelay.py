@@ -18,6 +18,7 @@
 from __future__ import absolute_import, division, print_function, \
     with_statement
 
+import os
 import time
 import socket
 import errno
@@ -27,6 +28,8 @@ import traceback
 import random
 import platform
 import threading
+import itertools
+from collections import deque
 
 from shadowsocksr_cli.shadowsocks import encrypt, obfs, eventloop, shell, common, lru_cache, version
 from shadowsocksr_cli.shadowsocks.common import pre_parse_header, parse_header, logging
@@ -36,6 +39,10 @@ TIMEOUTS_CLEAN_SIZE = 512
 
 MSG_FASTOPEN = 0x20000000
 
+# buffers passed to a single sendmsg() call, well below IOV_MAX
+MAX_IOV = 64
+HAS_SENDMSG = hasattr(socket.socket, 'sendmsg')
+
 # SOCKS command definition
 CMD_CONNECT = 1
 CMD_BIND = 2
@@ -92,6 +99,17 @@ WAIT_STATUS_READWRITING = WAIT_STATUS_READING | WAIT_STATUS_WRITING
 NETWORK_MTU = 1500
 TCP_MSS = NETWORK_MTU - 40
 BUF_SIZE = 32 * 1024
+# edge triggered mode: reads per event before yielding to other sockets
+MAX_DRAIN_READS = 16
+# bytes queued for one socket above which the opposite socket is no longer
+# read, and below which reading resumes
+WRITE_HIGH_WATER = 64 * 1024
+WRITE_LOW_WATER = 16 * 1024
+# method none, protocol origin and obfs plain leave the stream unchanged,
+# such connections are forwarded with splice() through a pipe
+HAS_SPLICE = hasattr(os, 'splice')
+SPLICE_SIZE = 64 * 1024
+SPLICE_FLAGS = getattr(os, 'SPLICE_F_MOVE', 1) | getattr(os, 'SPLICE_F_NONBLOCK', 2)
 UDP_MAX_BUF_SIZE = 65536
 
 class SpeedTester(object):
@@ -122,6 +140,12 @@ class SpeedTester(object):
             return self.sum_len >= self.max_speed
         return False
 
+    def wait_time(self):
+        # seconds until isExceed() turns False again
+        if self.max_speed > 0:
+            return max(self.sum_len - self.max_speed, 0) / self.max_speed
+        return 0
+
 class TCPRelayHandler(object):
     def __init__(self, server, fd_to_handlers, loop, local_sock, config,
                  dns_resolver, is_local):
@@ -201,8 +225,15 @@ class TCPRelayHandler(object):
         self._ignore_bind_list = config.get('ignore_bind', [])
 
         self._fastopen_connected = False
-        self._data_to_write_to_local = []
-        self._data_to_write_to_remote = []
+        # queues of memoryviews waiting for the socket to become writable
+        self._data_to_write_to_local = deque()
+        self._data_to_write_to_remote = deque()
+        # bytes queued and paused-by-water-mark flags, indexed by stream
+        self._write_buffered = [0, 0]
+        self._write_paused = [False, False]
+        self._write_high_water = config.get('write_high_water', WRITE_HIGH_WATER)
+        self._write_low_water = min(config.get('write_low_water', WRITE_LOW_WATER),
+                                    self._write_high_water)
         self._udp_data_send_buffer = b''
         self._upstream_status = WAIT_STATUS_READING
         self._downstream_status = WAIT_STATUS_INIT
@@ -222,6 +253,14 @@ class TCPRelayHandler(object):
         self.speed_tester_d = SpeedTester(config.get("speed_limit_per_con", 0))
         self._recv_u_max_size = BUF_SIZE
         self._recv_d_max_size = BUF_SIZE
+        # timers resuming a stream paused by the speed limit
+        self._resume_timers = {}
+        # set when the last read hit EAGAIN
+        self._read_blocked = False
+        # None: not decided yet, False: not used, else one (r, w) pipe per
+        # stream, and the bytes waiting in each pipe
+        self._splice = None
+        self._splice_pending = [0, 0]
         self._recv_pack_id = 0
         self._udp_send_pack_id = 0
         self._udpv6_send_pack_id = 0
@@ -230,7 +269,8 @@ class TCPRelayHandler(object):
         local_sock.setsockopt(socket.SOL_TCP, socket.TCP_NODELAY, 1)
         self._local_sock_fd = local_sock.fileno()
         fd_to_handlers[self._local_sock_fd] = self
-        loop.add(local_sock, eventloop.POLL_IN | eventloop.POLL_ERR, self._server)
+        loop.add(local_sock, eventloop.POLL_IN | eventloop.POLL_ERR, self._server,
+                 edge=True)
         self._stage = STAGE_INIT
 
     def __hash__(self):
@@ -370,59 +410,183 @@ class TCPRelayHandler(object):
                     self.destroy()
                     return False
             return True
+        if sock == self._local_sock:
+            queue = self._data_to_write_to_local
+            stream = STREAM_DOWN
+        elif sock == self._remote_sock:
+            queue = self._data_to_write_to_remote
+            stream = STREAM_UP
         else:
-            try:
-                if self._encrypt_correct:
-                    if sock == self._remote_sock:
-                        self._server.add_transfer_u(self._user, len(data))
-                self._update_activity(len(data))
-                if data:
-                    l = len(data)
-                    s = sock.send(data)
-                    if s < l:
-                        data = data[s:]
-                        uncomplete = True
-                else:
-                    return
-            except (OSError, IOError) as e:
-                error_no = eventloop.errno_from_exception(e)
-                if error_no in (errno.EAGAIN, errno.EINPROGRESS,
+            logging.error('write_all_to_sock:unknown socket from %s:%d' % (self._client_address[0], self._client_address[1]))
+            return False
+        if data:
+            self._queue_write(stream, data)
+        elif not queue:
+            return
+        sent = 0
+        try:
+            sent = self._send_queue(sock, queue)
+            self._write_buffered[stream] -= sent
+        except (OSError, IOError) as e:
+            error_no = eventloop.errno_from_exception(e)
+            if error_no not in (errno.EAGAIN, errno.EINPROGRESS,
                                 errno.EWOULDBLOCK):
-                    uncomplete = True
-                else:
-                    #traceback.print_exc()
-                    shell.print_exception(e)
-                    logging.error("exception from %s:%d" % (self._client_address[0], self._client_address[1]))
-                    self.destroy()
-                    return False
-            except Exception as e:
+                #traceback.print_exc()
                 shell.print_exception(e)
                 logging.error("exception from %s:%d" % (self._client_address[0], self._client_address[1]))
                 self.destroy()
                 return False
-        if uncomplete:
-            if sock == self._local_sock:
-                self._data_to_write_to_local.append(data)
-                self._update_stream(STREAM_DOWN, WAIT_STATUS_WRITING)
-            elif sock == self._remote_sock:
-                self._data_to_write_to_remote.append(data)
-                self._update_stream(STREAM_UP, WAIT_STATUS_WRITING)
-            else:
-                logging.error('write_all_to_sock:unknown socket from %s:%d' % (self._client_address[0], self._client_address[1]))
-        else:
-            if sock == self._local_sock:
-                self._update_stream(STREAM_DOWN, WAIT_STATUS_READING)
-            elif sock == self._remote_sock:
-                self._update_stream(STREAM_UP, WAIT_STATUS_READING)
-            else:
-                logging.error('write_all_to_sock:unknown socket from %s:%d' % (self._client_address[0], self._client_address[1]))
+        except Exception as e:
+            shell.print_exception(e)
+            logging.error("exception from %s:%d" % (self._client_address[0], self._client_address[1]))
+            self.destroy()
+            return False
+        if self._encrypt_correct and stream == STREAM_UP:
+            self._server.add_transfer_u(self._user, sent)
+        self._update_activity(sent)
+        self._update_stream(stream, self._buffered_status(stream))
         return True
 
+    def _queue_write(self, stream, data):
+        if stream == STREAM_DOWN:
+            self._data_to_write_to_local.append(memoryview(data))
+        else:
+            self._data_to_write_to_remote.append(memoryview(data))
+        self._write_buffered[stream] += len(data)
+
+    def _buffered_status(self, stream):
+        # status for a stream with data queued: keep reading below the high
+        # water mark; once above it, stop reading until the queue drains
+        # below the low water mark
+        buffered = self._write_buffered[stream]
+        if not buffered:
+            self._write_paused[stream] = False
+            return WAIT_STATUS_READING
+        if buffered >= self._write_high_water:
+            self._write_paused[stream] = True
+        elif buffered <= self._write_low_water:
+            self._write_paused[stream] = False
+        if self._write_paused[stream]:
+            return WAIT_STATUS_WRITING
+        return WAIT_STATUS_READWRITING
+
+    def get_buffered_bytes(self):
+        return self._write_buffered[STREAM_UP] + self._write_buffered[STREAM_DOWN] + \
+            self._splice_pending[STREAM_UP] + self._splice_pending[STREAM_DOWN]
+
+    def _start_splice(self):
+        # once streaming, an identity transform lets the kernel move the
+        # data: socket -> pipe -> socket, never copied into Python
+        config = self._config
+        if not HAS_SPLICE or not config.get('splice', True) or self._remote_udp or \
+                common.to_str(config['method']).lower() != 'none' or \
+                common.to_str(config['protocol']) != 'origin' or \
+                common.to_str(config['obfs']) != 'plain' or \
+                config.get('speed_limit_per_con', 0) or \
+                config.get('speed_limit_per_user', 0):
+            self._splice = False
+            return
+        if self._data_to_write_to_local or self._data_to_write_to_remote:
+            # decide again once the queues are flushed
+            return
+        try:
+            self._splice = (os.pipe2(os.O_NONBLOCK), os.pipe2(os.O_NONBLOCK))
+        except (OSError, IOError) as e:
+            logging.warn('splice disabled: %s' % (e,))
+            self._splice = False
+
+    def _splice_read(self, stream):
+        if stream == STREAM_UP:
+            sock = self._local_sock
+        else:
+            sock = self._remote_sock
+        try:
+            length = os.splice(sock.fileno(), self._splice[stream][1],
+                               SPLICE_SIZE, flags=SPLICE_FLAGS)
+        except (OSError, IOError) as e:
+            if eventloop.errno_from_exception(e) in \
+                    (errno.EAGAIN, errno.EWOULDBLOCK):
+                self._read_blocked = True
+                return
+            length = 0
+        if not length:
+            self.destroy()
+            return
+        if stream == STREAM_DOWN and not self._is_local and self._encrypt_correct:
+            self._server.add_transfer_d(self._user, length)
+        self._splice_pending[stream] += length
+        self._splice_write(stream)
+
+    def _splice_write(self, stream):
+        # like _write_to_sock, the pipe being the write queue
+        if stream == STREAM_UP:
+            sock = self._remote_sock
+        else:
+            sock = self._local_sock
+        sent = 0
+        try:
+            while self._splice_pending[stream]:
+                length = os.splice(self._splice[stream][0], sock.fileno(),
+                                   self._splice_pending[stream], flags=SPLICE_FLAGS)
+                if not length:
+                    break
+                self._splice_pending[stream] -= length
+                sent += length
+        except (OSError, IOError) as e:
+            if eventloop.errno_from_exception(e) not in \
+                    (errno.EAGAIN, errno.EWOULDBLOCK):
+                shell.print_exception(e)
+                logging.error("exception from %s:%d" % (self._client_address[0], self._client_address[1]))
+                self.destroy()
+                return
+        if self._encrypt_correct and stream == STREAM_UP:
+            self._server.add_transfer_u(self._user, sent)
+        self._update_activity(sent)
+        if self._splice_pending[stream]:
+            self._update_stream(stream, WAIT_STATUS_WRITING)
+        else:
+            self._update_stream(stream, WAIT_STATUS_READING)
+
+    @staticmethod
+    def _send_queue(sock, queue):
+        # send queued buffers with one sendmsg (writev) per batch; buffers
+        # sent completely are dropped, a partly sent one is replaced by a
+        # view of its unsent tail, nothing is copied. Returns the bytes
+        # sent, a full socket after some batches isn't an error
+        total = 0
+        while queue:
+            try:
+                if HAS_SENDMSG:
+                    batch = list(itertools.islice(queue, MAX_IOV))
+                    sent = sock.sendmsg(batch)
+                    size = sum(len(buf) for buf in batch)
+                else:
+                    sent = sock.send(queue[0])
+                    size = len(queue[0])
+            except (OSError, IOError) as e:
+                if eventloop.errno_from_exception(e) in \
+                        (errno.EAGAIN, errno.EINPROGRESS, errno.EWOULDBLOCK):
+                    break
+                raise
+            total += sent
+            left = sent
+            while left:
+                head = queue[0]
+                if len(head) <= left:
+                    left -= len(head)
+                    queue.popleft()
+                else:
+                    queue[0] = memoryview(head)[left:]
+                    left = 0
+            if sent < size:
+                break
+        return total
+
     def _handle_server_dns_resolved(self, error, remote_addr, server_addr, data):
         if error:
             return
         try:
-            addrs = socket.getaddrinfo(server_addr, remote_addr[1], 0, socket.SOCK_DGRAM, socket.SOL_UDP)
+            addrs = common.getaddrinfo(server_addr, remote_addr[1], socket.SOCK_DGRAM, socket.SOL_UDP)
             if not addrs: # drop
                 return
             af, socktype, proto, canonname, sa = addrs[0]
@@ -454,7 +618,7 @@ class TCPRelayHandler(object):
         items_sum = common.to_str(host_list[0]).rsplit('#', 1)
         if len(items_sum) < 2:
             hash_code = binascii.crc32(ogn_data)
-            addrs = socket.getaddrinfo(client_address[0], client_address[1], 0, socket.SOCK_STREAM, socket.SOL_TCP)
+            addrs = common.getaddrinfo(client_address[0], client_address[1], socket.SOCK_STREAM, socket.SOL_TCP)
             af, socktype, proto, canonname, sa = addrs[0]
             address_bytes = common.inet_pton(af, sa[0])
             if af == socket.AF_INET6:
@@ -535,7 +699,9 @@ class TCPRelayHandler(object):
                 data = self._encryptor.encrypt(data)
                 data = self._obfs.client_encode(data)
         if data:
-            self._data_to_write_to_remote.append(data)
+            self._queue_write(STREAM_UP, data)
+            if self._buffered_status(STREAM_UP) == WAIT_STATUS_WRITING:
+                self._update_stream(STREAM_UP, WAIT_STATUS_WRITING)
         if self._is_local and not self._fastopen_connected and \
                 self._config['fast_open']:
             # for sslocal and fastopen, we basically wait for data and use
@@ -546,15 +712,15 @@ class TCPRelayHandler(object):
                 remote_sock = \
                     self._create_remote_socket(self._chosen_server[0],
                                                self._chosen_server[1])
-                self._loop.add(remote_sock, eventloop.POLL_ERR, self._server)
+                self._loop.add(remote_sock, eventloop.POLL_ERR, self._server,
+                               edge=True)
                 data = b''.join(self._data_to_write_to_remote)
                 l = len(data)
                 s = remote_sock.sendto(data, MSG_FASTOPEN, self._chosen_server)
+                self._data_to_write_to_remote.clear()
+                self._write_buffered[STREAM_UP] = 0
                 if s < l:
-                    data = data[s:]
-                    self._data_to_write_to_remote = [data]
-                else:
-                    self._data_to_write_to_remote = []
+                    self._queue_write(STREAM_UP, memoryview(data)[s:])
                 self._update_stream(STREAM_UP, WAIT_STATUS_READWRITING)
             except (OSError, IOError) as e:
                 if eventloop.errno_from_exception(e) == errno.EINPROGRESS:
@@ -658,13 +824,13 @@ class TCPRelayHandler(object):
                     data_to_send = self._encryptor.encrypt(data)
                     data_to_send = self._obfs.client_encode(data_to_send)
                 if data_to_send:
-                    self._data_to_write_to_remote.append(data_to_send)
+                    self._queue_write(STREAM_UP, data_to_send)
                 # notice here may go into _handle_dns_resolved directly
                 self._dns_resolver.resolve(self._chosen_server[0],
                                            self._handle_dns_resolved)
             else:
                 if len(data) > header_length:
-                    self._data_to_write_to_remote.append(data[header_length:])
+                    self._queue_write(STREAM_UP, data[header_length:])
                 # notice here may go into _handle_dns_resolved directly
                 self._dns_resolver.resolve(remote_addr,
                                            self._handle_dns_resolved)
@@ -687,7 +853,7 @@ class TCPRelayHandler(object):
         if bind_addr in self._ignore_bind_list:
             bind_addr = None
         if bind_addr:
-            local_addrs = socket.getaddrinfo(bind_addr, 0, 0, socket.SOCK_STREAM, socket.SOL_TCP)
+            local_addrs = common.getaddrinfo(bind_addr, 0, socket.SOCK_STREAM, socket.SOL_TCP)
             if local_addrs[0][0] == af:
                 logging.debug("bind %s" % (bind_addr,))
                 try:
@@ -697,10 +863,10 @@ class TCPRelayHandler(object):
 
     def _create_remote_socket(self, ip, port):
         if self._remote_udp:
-            addrs_v6 = socket.getaddrinfo("::", 0, 0, socket.SOCK_DGRAM, socket.SOL_UDP)
-            addrs = socket.getaddrinfo("0.0.0.0", 0, 0, socket.SOCK_DGRAM, socket.SOL_UDP)
+            addrs_v6 = common.getaddrinfo("::", 0, socket.SOCK_DGRAM, socket.SOL_UDP)
+            addrs = common.getaddrinfo("0.0.0.0", 0, socket.SOCK_DGRAM, socket.SOL_UDP)
         else:
-            addrs = socket.getaddrinfo(ip, port, 0, socket.SOCK_STREAM, socket.SOL_TCP)
+            addrs = common.getaddrinfo(ip, port, socket.SOCK_STREAM, socket.SOL_TCP)
         if len(addrs) == 0:
             raise Exception("getaddrinfo failed for %s:%d" % (ip, port))
         af, socktype, proto, canonname, sa = addrs[0]
@@ -763,6 +929,9 @@ class TCPRelayHandler(object):
                         # for fastopen:
                         # wait for more data to arrive and send them in one SYN
                         self._stage = STAGE_CONNECTING
+                        # connect to the address just resolved, so neither
+                        # the socket nor sendto() looks the name up again
+                        self._chosen_server = (remote_addr, remote_port)
                         # we don't have to wait for remote since it's not
                         # created
                         self._update_stream(STREAM_UP, WAIT_STATUS_READING)
@@ -774,11 +943,11 @@ class TCPRelayHandler(object):
                         if self._remote_udp:
                             self._loop.add(remote_sock,
                                            eventloop.POLL_IN,
-                                           self._server)
+                                           self._server, edge=True)
                             if self._remote_sock_v6:
                                 self._loop.add(self._remote_sock_v6,
                                         eventloop.POLL_IN,
-                                        self._server)
+                                        self._server, edge=True)
                         else:
                             try:
                                 remote_sock.connect((remote_addr, remote_port))
@@ -794,14 +963,14 @@ class TCPRelayHandler(object):
 
                             self._loop.add(remote_sock,
                                        eventloop.POLL_ERR | eventloop.POLL_OUT,
-                                       self._server)
+                                       self._server, edge=True)
                         self._stage = STAGE_CONNECTING
                         self._update_stream(STREAM_UP, WAIT_STATUS_READWRITING)
                         self._update_stream(STREAM_DOWN, WAIT_STATUS_READING)
                         if self._remote_udp:
                             while self._data_to_write_to_remote:
-                                data = self._data_to_write_to_remote[0]
-                                del self._data_to_write_to_remote[0]
+                                data = self._data_to_write_to_remote.popleft()
+                                self._write_buffered[STREAM_UP] -= len(data)
                                 self._write_to_sock(data, self._remote_sock)
                     return
                 except Exception as e:
@@ -811,39 +980,56 @@ class TCPRelayHandler(object):
                     logging.error("exception from %s:%d" % (self._client_address[0], self._client_address[1]))
         self.destroy()
 
-    def _get_read_size(self, sock, recv_buffer_size, up):
+    def _get_read_size(self, recv_buffer_size, up):
+        # the most we may read now; after the speed limit kicked in this
+        # starts at one frame and grows by a frame per read
         if self._overhead == 0:
             return recv_buffer_size
-        buffer_size = len(sock.recv(recv_buffer_size, socket.MSG_PEEK))
         frame_size = self._tcp_mss - self._overhead
         if up:
-            buffer_size = min(buffer_size, self._recv_u_max_size)
+            buffer_size = min(recv_buffer_size, self._recv_u_max_size)
             self._recv_u_max_size = min(self._recv_u_max_size + frame_size, BUF_SIZE)
         else:
-            buffer_size = min(buffer_size, self._recv_d_max_size)
+            buffer_size = min(recv_buffer_size, self._recv_d_max_size)
             self._recv_d_max_size = min(self._recv_d_max_size + frame_size, BUF_SIZE)
-        if buffer_size == recv_buffer_size:
-            return buffer_size
-        if buffer_size > frame_size:
-            buffer_size = int(buffer_size / frame_size) * frame_size
         return buffer_size
 
+    def _split_frames(self, data, recv_buffer_size):
+        # a short read longer than a frame is cut at the last frame boundary
+        # and the two parts are encoded separately, so that full frames fill
+        # whole segments and only the tail goes out as a small packet
+        length = len(data)
+        if self._overhead == 0 or length == recv_buffer_size:
+            return (data,)
+        frame_size = self._tcp_mss - self._overhead
+        if length <= frame_size or length % frame_size == 0:
+            return (data,)
+        aligned = length - length % frame_size
+        return (data[:aligned], data[aligned:])
+
+    def _recv(self, sock, size):
+        # read into the relay's shared buffer, returns a memoryview that is
+        # only valid until the next read
+        view = self._server.recv_buffer
+        return view[:sock.recv_into(view, size)]
+
     def _on_local_read(self):
         # handle all local read events and dispatch them to methods for
         # each stage
         if not self._local_sock:
             return
         is_local = self._is_local
-        if is_local:
-            recv_buffer_size = self._get_read_size(self._local_sock, self._recv_buffer_size, True)
-        else:
-            recv_buffer_size = BUF_SIZE
         data = None
         try:
-            data = self._local_sock.recv(recv_buffer_size)
+            if is_local:
+                recv_buffer_size = self._get_read_size(self._recv_buffer_size, True)
+            else:
+                recv_buffer_size = BUF_SIZE
+            data = self._recv(self._local_sock, recv_buffer_size)
         except (OSError, IOError) as e:
             if eventloop.errno_from_exception(e) in \
                     (errno.ETIMEDOUT, errno.EAGAIN, errno.EWOULDBLOCK):
+                self._read_blocked = True
                 return
         if not data:
             self.destroy()
@@ -851,6 +1037,17 @@ class TCPRelayHandler(object):
 
         self.speed_tester_u.add(len(data))
         self._server.speed_tester_u(self._user_id).add(len(data))
+        if is_local and self._stage == STAGE_STREAM:
+            chunks = self._split_frames(data, recv_buffer_size)
+            if self._encryptor is not None:
+                data = b''.join([self._obfs.client_encode(self._encryptor.encrypt(
+                    self._protocol.client_pre_encrypt(chunk.tobytes())))
+                    for chunk in chunks])
+            else:
+                data = data.tobytes()
+            self._write_to_sock(data, self._remote_sock)
+            return
+        data = data.tobytes()
         ogn_data = data
         if not is_local:
             if self._encryptor is not None:
@@ -881,7 +1078,14 @@ class TCPRelayHandler(object):
                         if not self._protocol.obfs.server_info.recv_iv:
                             iv_len = len(self._protocol.obfs.server_info.iv)
                             self._protocol.obfs.server_info.recv_iv = obfs_decode[0][:iv_len]
-                        data = self._encryptor.decrypt(obfs_decode[0])
+                        try:
+                            data = self._encryptor.decrypt(obfs_decode[0])
+                        except Exception as e:
+                            # e.g. an AEAD chunk failing authentication
+                            shell.print_exception(e)
+                            logging.error("exception from %s:%d" % (self._client_address[0], self._client_address[1]))
+                            self.destroy()
+                            return
                     else:
                         data = obfs_decode[0]
                     try:
@@ -909,11 +1113,7 @@ class TCPRelayHandler(object):
             if not data:
                 return
         if self._stage == STAGE_STREAM:
-            if self._is_local:
-                if self._encryptor is not None:
-                    data = self._protocol.client_pre_encrypt(data)
-                    data = self._encryptor.encrypt(data)
-                    data = self._obfs.client_encode(data)
+            # the server side, the local one is handled above
             self._write_to_sock(data, self._remote_sock)
         elif is_local and self._stage == STAGE_INIT:
             # TODO check auth method
@@ -942,18 +1142,20 @@ class TCPRelayHandler(object):
                     ip = socket.inet_pton(socket.AF_INET6, addr[0])
                     data = b'\x00\x04' + ip + port + data
                 size = len(data) + 2
-                data = struct.pack('>H', size) + data
+                data = memoryview(struct.pack('>H', size) + data)
+                recv_buffer_size = size
                 #logging.info('UDP over TCP recvfrom %s:%d %d bytes to %s:%d' % (addr[0], addr[1], len(data), self._client_address[0], self._client_address[1]))
             else:
                 if self._is_local:
                     recv_buffer_size = BUF_SIZE
                 else:
-                    recv_buffer_size = self._get_read_size(self._remote_sock, self._recv_buffer_size, False)
-                data = self._remote_sock.recv(recv_buffer_size)
+                    recv_buffer_size = self._get_read_size(self._recv_buffer_size, False)
+                data = self._recv(self._remote_sock, recv_buffer_size)
                 self._recv_pack_id += 1
         except (OSError, IOError) as e:
             if eventloop.errno_from_exception(e) in \
                     (errno.ETIMEDOUT, errno.EAGAIN, errno.EWOULDBLOCK, 10035): #errno.WSAEWOULDBLOCK
+                self._read_blocked = True
                 return
         if not data:
             self.destroy()
@@ -963,6 +1165,7 @@ class TCPRelayHandler(object):
         self._server.speed_tester_d(self._user_id).add(len(data))
         if self._encryptor is not None:
             if self._is_local:
+                data = data.tobytes()
                 try:
                     obfs_decode = self._obfs.client_decode(data)
                 except Exception as e:
@@ -976,8 +1179,8 @@ class TCPRelayHandler(object):
                 if not self._protocol.obfs.server_info.recv_iv:
                     iv_len = len(self._protocol.obfs.server_info.iv)
                     self._protocol.obfs.server_info.recv_iv = obfs_decode[0][:iv_len]
-                data = self._encryptor.decrypt(obfs_decode[0])
                 try:
+                    data = self._encryptor.decrypt(obfs_decode[0])
                     data = self._protocol.client_post_decrypt(data)
                     if self._recv_pack_id == 1:
                         self._tcp_mss = self._protocol.get_server_info().tcp_mss
@@ -988,10 +1191,12 @@ class TCPRelayHandler(object):
                     return
             else:
                 if self._encrypt_correct:
-                    data = self._protocol.server_pre_encrypt(data)
-                    data = self._encryptor.encrypt(data)
-                    data = self._obfs.server_encode(data)
+                    data = b''.join([self._obfs.server_encode(self._encryptor.encrypt(
+                        self._protocol.server_pre_encrypt(chunk.tobytes())))
+                        for chunk in self._split_frames(data, recv_buffer_size)])
                     self._server.add_transfer_d(self._user, len(data))
+                else:
+                    data = data.tobytes()
                 self._update_activity(len(data))
         else:
             return
@@ -1006,20 +1211,20 @@ class TCPRelayHandler(object):
 
     def _on_local_write(self):
         # handle local writable event
-        if self._data_to_write_to_local:
-            data = b''.join(self._data_to_write_to_local)
-            self._data_to_write_to_local = []
-            self._write_to_sock(data, self._local_sock)
+        if self._splice_pending[STREAM_DOWN]:
+            self._splice_write(STREAM_DOWN)
+        elif self._data_to_write_to_local:
+            self._write_to_sock(b'', self._local_sock)
         else:
             self._update_stream(STREAM_DOWN, WAIT_STATUS_READING)
 
     def _on_remote_write(self):
         # handle remote writable event
         self._stage = STAGE_STREAM
-        if self._data_to_write_to_remote:
-            data = b''.join(self._data_to_write_to_remote)
-            self._data_to_write_to_remote = []
-            self._write_to_sock(data, self._remote_sock)
+        if self._splice_pending[STREAM_UP]:
+            self._splice_write(STREAM_UP)
+        elif self._data_to_write_to_remote:
+            self._write_to_sock(b'', self._remote_sock)
         else:
             self._update_stream(STREAM_UP, WAIT_STATUS_READING)
 
@@ -1055,28 +1260,42 @@ class TCPRelayHandler(object):
             if event & eventloop.POLL_ERR:
                 handle = True
                 self._on_remote_error()
-            elif event & (eventloop.POLL_IN | eventloop.POLL_HUP):
-                if not self.speed_tester_d.isExceed() and not self._server.speed_tester_d(self._user_id).isExceed():
+            else:
+                if event & (eventloop.POLL_IN | eventloop.POLL_HUP):
+                    speed_testers = (self.speed_tester_d,
+                                     self._server.speed_tester_d(self._user_id))
+                    if event & eventloop.POLL_HUP or \
+                            not self._pause_if_exceed(STREAM_DOWN, speed_testers):
+                        handle = True
+                        self._read_stream(STREAM_DOWN, sock, speed_testers)
+                    else:
+                        self._recv_d_max_size = self._tcp_mss - self._overhead
+                # in edge triggered mode a POLL_OUT that came with POLL_IN
+                # is not reported again, so handle both here
+                if event & eventloop.POLL_OUT and \
+                        self._stage != STAGE_DESTROYED:
                     handle = True
-                    self._on_remote_read(sock == self._remote_sock)
-                else:
-                    self._recv_d_max_size = self._tcp_mss - self._overhead
-            elif event & eventloop.POLL_OUT:
-                handle = True
-                self._on_remote_write()
+                    self._on_remote_write()
         elif fd == self._local_sock_fd:
             if event & eventloop.POLL_ERR:
                 handle = True
                 self._on_local_error()
-            elif event & (eventloop.POLL_IN | eventloop.POLL_HUP):
-                if not self.speed_tester_u.isExceed() and not self._server.speed_tester_u(self._user_id).isExceed():
+            else:
+                if event & (eventloop.POLL_IN | eventloop.POLL_HUP):
+                    speed_testers = (self.speed_tester_u,
+                                     self._server.speed_tester_u(self._user_id))
+                    if event & eventloop.POLL_HUP or \
+                            not self._pause_if_exceed(STREAM_UP, speed_testers):
+                        handle = True
+                        self._read_stream(STREAM_UP, sock, speed_testers)
+                    else:
+                        self._recv_u_max_size = self._tcp_mss - self._overhead
+                # in edge triggered mode a POLL_OUT that came with POLL_IN
+                # is not reported again, so handle both here
+                if event & eventloop.POLL_OUT and \
+                        self._stage != STAGE_DESTROYED:
                     handle = True
-                    self._on_local_read()
-                else:
-                    self._recv_u_max_size = self._tcp_mss - self._overhead
-            elif event & eventloop.POLL_OUT:
-                handle = True
-                self._on_local_write()
+                    self._on_local_write()
         else:
             logging.warn('unknown socket from %s:%d' % (self._client_address[0], self._client_address[1]))
             try:
@@ -1091,6 +1310,69 @@ class TCPRelayHandler(object):
 
         return handle
 
+    def _read_stream(self, stream, sock, speed_testers):
+        # level triggered: one read per event. Edge triggered: no new event
+        # arrives for data that is already queued, so read until EAGAIN or
+        # until the stream stops reading (pending writes, speed limit)
+        if self._splice is None and self._stage == STAGE_STREAM:
+            self._start_splice()
+        reads = 0
+        while True:
+            self._read_blocked = False
+            if self._splice:
+                self._splice_read(stream)
+            elif stream == STREAM_DOWN:
+                self._on_remote_read(sock == self._remote_sock)
+            else:
+                self._on_local_read()
+            if stream == STREAM_DOWN:
+                status = self._downstream_status
+            else:
+                status = self._upstream_status
+            reads += 1
+            if not self._loop.edge_triggered or self._read_blocked or \
+                    self._stage == STAGE_DESTROYED or \
+                    not status & WAIT_STATUS_READING or \
+                    self._pause_if_exceed(stream, speed_testers):
+                return
+            if reads >= MAX_DRAIN_READS:
+                # give other connections a turn, poll reports us again
+                self._loop.rearm(sock)
+                return
+
+    def _pause_if_exceed(self, stream, speed_testers):
+        # over the speed limit: stop polling the readable side of the stream
+        # and resume it by a timer, rather than spinning on it in the loop
+        exceed = False
+        delay = 0
+        for speed_tester in speed_testers:
+            if speed_tester.isExceed():
+                exceed = True
+                delay = max(delay, speed_tester.wait_time())
+        if not exceed:
+            return False
+        if stream == STREAM_DOWN:
+            status = self._downstream_status
+        else:
+            status = self._upstream_status
+        self._update_stream(stream, status & ~WAIT_STATUS_READING)
+        if stream not in self._resume_timers:
+            self._resume_timers[stream] = self._loop.call_later(
+                delay, self._resume_stream, stream)
+        return True
+
+    def _resume_stream(self, stream):
+        del self._resume_timers[stream]
+        if self._stage == STAGE_DESTROYED:
+            return
+        if stream == STREAM_DOWN:
+            status = self._downstream_status
+        else:
+            status = self._upstream_status
+        # above the high water mark the write path re-enables reading
+        if not self._write_paused[stream]:
+            self._update_stream(stream, status | WAIT_STATUS_READING)
+
     def _log_error(self, e):
         logging.error('%s when handling connection from %s:%d' %
                       (e, self._client_address[0], self._client_address[1]))
@@ -1111,6 +1393,9 @@ class TCPRelayHandler(object):
             logging.debug('already destroyed')
             return
         self._stage = STAGE_DESTROYED
+        for timer in self._resume_timers.values():
+            timer.cancel()
+        self._resume_timers.clear()
         if self._remote_address:
             logging.debug('destroy: %s:%d' %
                           self._remote_address)
@@ -1155,6 +1440,11 @@ class TCPRelayHandler(object):
                 shell.print_exception(e)
             self._local_sock.close()
             self._local_sock = None
+        if self._splice:
+            for pipe_r, pipe_w in self._splice:
+                os.close(pipe_r)
+                os.close(pipe_w)
+            self._splice = False
         if self._obfs:
             self._obfs.dispose()
             self._obfs = None
@@ -1185,6 +1475,9 @@ class TCPRelay(object):
         self._fd_to_handlers = {}
         self.server_transfer_ul = 0
         self.server_transfer_dl = 0
+        # shared by all handlers of this relay, they copy out what they keep
+        # before the next read
+        self.recv_buffer = memoryview(bytearray(BUF_SIZE))
         self.server_users = {}
         self.server_users_cfg = {}
         self.server_user_transfer_ul = {}
@@ -1222,6 +1515,10 @@ class TCPRelay(object):
         af, socktype, proto, canonname, sa = addrs[0]
         server_socket = socket.socket(af, socktype, proto)
         server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if config.get('reuse_port', False):
+            # several worker processes bind the same port, the kernel
+            # balances new connections between them
+            server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         server_socket.bind(sa)
         server_socket.setblocking(False)
         if config['fast_open']:
@@ -1245,6 +1542,7 @@ class TCPRelay(object):
         self._eventloop.add(self._server_socket,
                             eventloop.POLL_IN | eventloop.POLL_ERR, self)
         self._eventloop.add_periodic(self.handle_periodic)
+        self._timeout_cache.add_to_loop(loop)
 
     def remove_handler(self, client):
         if hash(client) in self._timeout_cache:
@@ -1260,6 +1558,11 @@ class TCPRelay(object):
     def get_users_ud(self):
         return (self.server_user_transfer_ul.copy(), self.server_user_transfer_dl.copy())
 
+    def get_buffered_bytes(self):
+        # bytes waiting in the write queues of all connections
+        return sum(handler.get_buffered_bytes()
+                   for handler in set(self._fd_to_handlers.values()))
+
     def _update_users(self, protocol_param, acl):
         if protocol_param is None:
             protocol_param = self._config['protocol_param']
@@ -1394,9 +1697,6 @@ class TCPRelay(object):
 
         self._timeout_cache[hash(client)] = client
 
-    def _sweep_timeout(self):
-        self._timeout_cache.sweep()
-
     def _close_tcp_client(self, client):
         if client.remote_address:
             logging.debug('timed out: %s:%d' %
@@ -1468,7 +1768,6 @@ class TCPRelay(object):
                 logging.info('closed TCP port %d', self._listen_port)
             for handler in list(self._fd_to_handlers.values()):
                 handler.destroy()
-        self._sweep_timeout()
 
     def close(self, next_tick=False):
         logging.debug('TCP close')
@@ -1480,3 +1779,48 @@ class TCPRelay(object):
             self._server_socket.close()
             for handler in list(self._fd_to_handlers.values()):
                 handler.destroy()
+
+
+def test_send_queue():
+    # one batch accepted, then the socket is full
+    class Sock(object):
+        def __init__(self):
+            self.calls = 0
+
+        def _send(self, size):
+            self.calls += 1
+            if self.calls > 1:
+                raise socket.error(errno.EAGAIN, 'full')
+            return size
+
+        def sendmsg(self, buffers):
+            return self._send(sum(len(buf) for buf in buffers))
+
+        def send(self, data):
+            return self._send(len(data))
+
+    queue = deque(memoryview(b'%02d' % i * 5) for i in range(MAX_IOV + 5))
+    sent = TCPRelayHandler._send_queue(Sock(), queue)
+    if HAS_SENDMSG:
+        assert sent == MAX_IOV * 10 and len(queue) == 5
+    else:
+        assert sent == 10 and len(queue) == MAX_IOV + 4
+    assert queue[0].tobytes() == b'%02d' % (MAX_IOV + 5 - len(queue)) * 5
+
+    # any other error is the caller's
+    class BrokenSock(object):
+        def sendmsg(self, buffers):
+            raise socket.error(errno.EPIPE, 'broken pipe')
+
+        send = sendmsg
+
+    try:
+        TCPRelayHandler._send_queue(BrokenSock(), deque([memoryview(b'x')]))
+    except socket.error as e:
+        assert e.errno == errno.EPIPE
+    else:
+        assert False, 'EPIPE swallowed'
+
+
+if __name__ == '__main__':
+    test_send_queue()
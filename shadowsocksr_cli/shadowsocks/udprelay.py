@@ -70,8 +70,9 @@ import random
 import binascii
 import traceback
 import threading
+from collections import OrderedDict
 
-from shadowsocksr_cli.shadowsocks import encrypt, obfs, eventloop, lru_cache, common, shell
+from shadowsocksr_cli.shadowsocks import encrypt, obfs, eventloop, lru_cache, common, shell, mmsg
 from shadowsocksr_cli.shadowsocks.common import pre_parse_header, parse_header, pack_addr, logging
 
 # for each handler, we have 2 stream directions:
@@ -94,6 +95,11 @@ DOUBLE_SEND_BEG_IDS = 16
 POST_MTU_MIN = 500
 POST_MTU_MAX = 1400
 SENDING_WINDOW_SIZE = 8192
+# datagrams read from one socket per readiness event, so a busy socket
+# can't starve the rest of the loop
+MAX_RECV_BATCH = 64
+# a DNS flow is closed after its first answer, or after this many seconds
+DNS_FLOW_TIMEOUT = 10
 
 STAGE_INIT = 0
 STAGE_RSP_ID = 1
@@ -122,9 +128,107 @@ RSP_STATE_ERROR = b"\x03"
 RSP_STATE_DISCONNECT = b"\x04"
 RSP_STATE_REDIRECT = b"\x05"
 
-def client_key(source_addr, server_af):
-    # notice this is server af, not dest af
-    return '%s:%s:%d' % (source_addr[0], source_addr[1], server_af)
+class UDPFlow(object):
+    __slots__ = ('key', 'client_addr', 'af', 'sock', 'fd', 'uid', 'is_dns',
+                 'timeout', 'last_time', 'timer')
+
+    def __init__(self, key, client_addr, af, sock, uid, is_dns, timeout, now):
+        self.key = key
+        self.client_addr = client_addr
+        self.af = af
+        self.sock = sock
+        self.fd = sock.fileno()
+        self.uid = uid
+        self.is_dns = is_dns
+        self.timeout = timeout
+        self.last_time = now
+        self.timer = None
+
+
+class FlowTable(object):
+    # UDP associations keyed by (source ip, source port, server af), notice
+    # this is server af, not dest af. All flows share one LRU order, the
+    # least recently used one is closed when there are more than capacity.
+    # get, get_by_fd, add and remove are O(1)
+
+    def __init__(self, capacity, close_callback):
+        self.capacity = capacity
+        self.close_callback = close_callback
+        self._flows = OrderedDict()
+        self._fd_to_flow = {}
+        self._loop = None
+        # loop.time() once on a loop, no syscall per packet
+        self._clock = eventloop.monotonic
+
+    def add_to_loop(self, loop):
+        if self._loop:
+            raise Exception('already add to loop')
+        self._loop = loop
+        self._clock = loop.time
+        for flow in self._flows.values():
+            self._add_timer(flow, flow.timeout)
+
+    def _add_timer(self, flow, delay):
+        flow.timer = self._loop.call_later(delay, self._expire, flow)
+
+    def _expire(self, flow):
+        flow.timer = None
+        if self._flows.get(flow.key) is not flow:
+            return
+        idle = self._clock() - flow.last_time
+        if idle <= flow.timeout:
+            self._add_timer(flow, flow.timeout - idle)
+            return
+        self.remove(flow)
+        self.close_callback(flow)
+
+    def _touch(self, flow):
+        flow.last_time = self._clock()
+        self._flows.move_to_end(flow.key)
+
+    def get(self, key):
+        flow = self._flows.get(key)
+        if flow is not None:
+            self._touch(flow)
+        return flow
+
+    def get_by_fd(self, fd):
+        flow = self._fd_to_flow.get(fd)
+        if flow is not None:
+            self._touch(flow)
+        return flow
+
+    def add(self, key, client_addr, af, sock, uid, is_dns, timeout):
+        flow = UDPFlow(key, client_addr, af, sock, uid, is_dns, timeout,
+                       self._clock())
+        self._flows[key] = flow
+        self._fd_to_flow[flow.fd] = flow
+        if self._loop is not None:
+            self._add_timer(flow, timeout)
+        while len(self._flows) > self.capacity:
+            oldest = next(iter(self._flows.values()))
+            self.remove(oldest)
+            self.close_callback(oldest)
+        return flow
+
+    def remove(self, flow):
+        del self._flows[flow.key]
+        del self._fd_to_flow[flow.fd]
+        if flow.timer is not None:
+            flow.timer.cancel()
+            flow.timer = None
+
+    def clear(self):
+        while self._flows:
+            flow = next(iter(self._flows.values()))
+            self.remove(flow)
+            self.close_callback(flow)
+
+    def __contains__(self, key):
+        return key in self._flows
+
+    def __len__(self):
+        return len(self._flows)
 
 class UDPRelay(object):
     def __init__(self, config, dns_resolver, is_local, stat_callback=None, stat_counter=None):
@@ -146,12 +250,8 @@ class UDPRelay(object):
         self._method = config['method']
         self._timeout = config['timeout']
         self._is_local = is_local
-        self._udp_cache_size = config['udp_cache']
-        self._cache = lru_cache.LRUCache(timeout=config['udp_timeout'],
-                                         close_callback=self._close_client_pair)
-        self._cache_dns_client = lru_cache.LRUCache(timeout=10,
-                                         close_callback=self._close_client_pair)
-        self._client_fd_to_server_addr = {}
+        self._udp_timeout = config['udp_timeout']
+        self._flows = FlowTable(max(config['udp_cache'], 1), self._close_flow)
         #self._dns_cache = lru_cache.LRUCache(timeout=1800)
         self._eventloop = None
         self._closed = False
@@ -186,6 +286,9 @@ class UDPRelay(object):
         self._fd_to_handlers = {}
         self._reqid_to_hd = {}
         self._data_to_write_to_server_socket = []
+        self._mmsg = None
+        if config.get('udp_mmsg', True) and mmsg.available():
+            self._mmsg = mmsg.MessageBatch()
 
         self._timeout_cache = lru_cache.LRUCache(timeout=self._timeout,
                                          close_callback=self._close_tcp_client)
@@ -210,6 +313,8 @@ class UDPRelay(object):
                             (self._listen_addr, self._listen_port))
         af, socktype, proto, canonname, sa = addrs[0]
         server_socket = socket.socket(af, socktype, proto)
+        if config.get('reuse_port', False):
+            server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         server_socket.bind((self._listen_addr, self._listen_port))
         server_socket.setblocking(False)
         server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 1024 * 1024)
@@ -291,26 +396,13 @@ class UDPRelay(object):
             self.server_user_transfer_dl[user] += transfer + self.server_transfer_dl
             self.server_transfer_dl = 0
 
-    def _close_client_pair(self, client_pair):
-        client, uid = client_pair
-        self._close_client(client)
-
-    def _close_client(self, client):
-        if hasattr(client, 'close'):
-            if not self._is_local:
-                if client.fileno() in self._client_fd_to_server_addr:
-                    logging.debug('close_client: %s' %
-                                 (self._client_fd_to_server_addr[client.fileno()],))
-                else:
-                    client.info('close_client')
-            self._sockets.remove(client.fileno())
-            self._eventloop.remove(client)
-            del self._client_fd_to_server_addr[client.fileno()]
-            client.close()
-        else:
-            # just an address
-            client.info('close_client pass %s' % client)
-            pass
+    def _close_flow(self, flow):
+        client = flow.sock
+        if not self._is_local:
+            logging.debug('close_client: %s' % ((flow.client_addr, flow.af),))
+        self._sockets.remove(flow.fd)
+        self._eventloop.remove(client)
+        client.close()
 
     def _handel_protocol_error(self, client_address, ogn_data):
         #raise Exception('can not parse header')
@@ -327,7 +419,7 @@ class UDPRelay(object):
         if bind_addr in self._ignore_bind_list:
             bind_addr = None
         if bind_addr:
-            local_addrs = socket.getaddrinfo(bind_addr, 0, 0, socket.SOCK_DGRAM, socket.SOL_UDP)
+            local_addrs = common.getaddrinfo(bind_addr, 0, socket.SOCK_DGRAM, socket.SOL_UDP)
             if local_addrs[0][0] == af:
                 logging.debug("bind %s" % (bind_addr,))
                 try:
@@ -335,9 +427,34 @@ class UDPRelay(object):
                 except Exception as e:
                     logging.warn("bind %s fail" % (bind_addr,))
 
+    def _recv_batch(self, sock):
+        # read until EAGAIN or MAX_RECV_BATCH datagrams, recvmmsg if we can
+        packets = []
+        try:
+            while len(packets) < MAX_RECV_BATCH:
+                if self._mmsg:
+                    batch = self._mmsg.recv(sock)
+                    if not batch:
+                        break
+                    packets.extend(batch)
+                else:
+                    packets.append(sock.recvfrom(BUF_SIZE))
+        except (OSError, IOError) as e:
+            if eventloop.errno_from_exception(e) not in \
+                    (errno.EAGAIN, errno.EWOULDBLOCK) and not packets:
+                raise
+        return packets
+
     def _handle_server(self):
-        server = self._server_socket
-        data, r_addr = server.recvfrom(BUF_SIZE)
+        for data, r_addr in self._recv_batch(self._server_socket):
+            try:
+                self._handle_server_packet(data, r_addr)
+            except Exception as e:
+                shell.print_exception(e)
+                if self._config['verbose']:
+                    traceback.print_exc()
+
+    def _handle_server_packet(self, data, r_addr):
         ogn_data = data
         if not data:
             logging.debug('UDP handle_server: data is empty')
@@ -401,17 +518,15 @@ class UDPRelay(object):
         user_id = self._listen_port
         try:
             server_port = remote_addr[1]
-            addrs = socket.getaddrinfo(server_addr, server_port, 0,
-                                        socket.SOCK_DGRAM, socket.SOL_UDP)
+            addrs = common.getaddrinfo(server_addr, server_port,
+                                       socket.SOCK_DGRAM, socket.SOL_UDP)
             if not addrs: # drop
                 return
             af, socktype, proto, canonname, sa = addrs[0]
             server_addr = sa[0]
-            key = client_key(r_addr, af)
-            client_pair = self._cache.get(key, None)
-            if client_pair is None:
-                client_pair = self._cache_dns_client.get(key, None)
-            if client_pair is None:
+            key = (r_addr[0], r_addr[1], af)
+            flow = self._flows.get(key)
+            if flow is None:
                 if self._forbidden_iplist:
                     if common.to_str(sa[0]) in self._forbidden_iplist:
                         logging.debug('IP %s is in forbidden list, drop' % common.to_str(sa[0]))
@@ -433,22 +548,21 @@ class UDPRelay(object):
                     pass
                 if sa[1] == 53 and is_dns: #DNS
                     logging.debug("DNS query %s from %s:%d" % (common.to_str(sa[0]), r_addr[0], r_addr[1]))
-                    self._cache_dns_client[key] = (client, uid)
+                    timeout = DNS_FLOW_TIMEOUT
                 else:
-                    self._cache[key] = (client, uid)
-                self._client_fd_to_server_addr[client.fileno()] = (r_addr, af)
+                    is_dns = False
+                    timeout = self._udp_timeout
 
                 self._sockets.add(client.fileno())
                 self._eventloop.add(client, eventloop.POLL_IN, self)
+                self._flows.add(key, r_addr, af, client, uid, is_dns, timeout)
 
                 logging.debug('UDP port %5d sockets %d' % (self._listen_port, len(self._sockets)))
 
                 if uid is not None:
                     user_id = struct.unpack('<I', client_uid)[0]
             else:
-                client, client_uid = client_pair
-            self._cache.clear(self._udp_cache_size)
-            self._cache_dns_client.clear(16)
+                client, client_uid = flow.sock, flow.uid
 
             if self._is_local:
                 ref_iv = [encrypt.encrypt_new_iv(self._method)]
@@ -469,7 +583,7 @@ class UDPRelay(object):
         try:
             client.sendto(data, (server_addr, server_port))
             self.add_transfer_u(client_uid, len(data))
-            if client_pair is None: # new request
+            if flow is None: # new request
                 addr, port = client.getsockname()[:2]
                 common.connect_log('UDP data to %s(%s):%d from %s:%d by user %d' %
                         (common.to_str(remote_addr[0]), common.to_str(server_addr), server_port, addr, port, user_id))
@@ -482,23 +596,29 @@ class UDPRelay(object):
                 shell.print_exception(e)
 
     def _handle_client(self, sock):
-        data, r_addr = sock.recvfrom(BUF_SIZE)
+        fd = sock.fileno()
+        for data, r_addr in self._recv_batch(sock):
+            try:
+                self._handle_client_packet(sock, data, r_addr)
+            except Exception as e:
+                shell.print_exception(e)
+                if self._config['verbose']:
+                    traceback.print_exc()
+            if fd not in self._sockets:
+                # a DNS client is closed after its first answer
+                break
+
+    def _handle_client_packet(self, sock, data, r_addr):
         if not data:
             logging.debug('UDP handle_client: data is empty')
             return
         if self._stat_callback:
             self._stat_callback(self._listen_port, len(data))
 
-        client_addr = self._client_fd_to_server_addr.get(sock.fileno())
+        flow = self._flows.get_by_fd(sock.fileno())
         client_uid = None
-        if client_addr:
-            key = client_key(client_addr[0], client_addr[1])
-            client_pair = self._cache.get(key, None)
-            client_dns_pair = self._cache_dns_client.get(key, None)
-            if client_pair:
-                client, client_uid = client_pair
-            elif client_dns_pair:
-                client, client_uid = client_dns_pair
+        if flow:
+            client_uid = flow.uid
 
         if not self._is_local:
             addrlen = len(r_addr[0])
@@ -529,44 +649,46 @@ class UDPRelay(object):
 
             response = b'\x00\x00\x00' + data
 
-        if client_addr:
+        if flow:
             if client_uid:
                 self.add_transfer_d(client_uid, len(response))
             else:
                 self.server_transfer_dl += len(response)
-            self.write_to_server_socket(response, client_addr[0])
-            if client_dns_pair:
-                logging.debug("remove dns client %s:%d" % (client_addr[0][0], client_addr[0][1]))
-                del self._cache_dns_client[key]
-                self._close_client(client_dns_pair[0])
+            self.write_to_server_socket(response, flow.client_addr)
+            if flow.is_dns:
+                logging.debug("remove dns client %s:%d" % (flow.client_addr[0], flow.client_addr[1]))
+                self._flows.remove(flow)
+                self._close_flow(flow)
         else:
             # this packet is from somewhere else we know
             # simply drop that packet
             pass
 
     def write_to_server_socket(self, data, addr):
-        uncomplete = False
-        retry = 0
-        try:
-            self._server_socket.sendto(data, addr)
-            data = None
-            while self._data_to_write_to_server_socket:
-                data_buf = self._data_to_write_to_server_socket[0]
-                retry = data_buf[1] + 1
-                del self._data_to_write_to_server_socket[0]
-                data, addr = data_buf[0]
-                self._server_socket.sendto(data, addr)
-        except (OSError, IOError) as e:
-            error_no = eventloop.errno_from_exception(e)
-            uncomplete = True
-            if error_no in (errno.EWOULDBLOCK,):
-                pass
-            else:
+        # sent by _flush_server_socket once the current event is handled
+        self._data_to_write_to_server_socket.append((data, addr))
+
+    def _flush_server_socket(self):
+        queue = self._data_to_write_to_server_socket
+        if not queue:
+            return
+        self._data_to_write_to_server_socket = []
+        pos = 0
+        while pos < len(queue):
+            try:
+                if self._mmsg:
+                    pos += self._mmsg.send(self._server_socket, queue[pos:])
+                else:
+                    data, addr = queue[pos]
+                    self._server_socket.sendto(data, addr)
+                    pos += 1
+            except (OSError, IOError) as e:
+                error_no = eventloop.errno_from_exception(e)
+                if error_no in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    # UDP, drop what the socket can't take now
+                    break
                 shell.print_exception(e)
-                return False
-        #if uncomplete and data is not None and retry < 3:
-        #    self._data_to_write_to_server_socket.append([(data, addr), retry])
-        #'''
+                pos += 1
 
     def add_to_loop(self, loop):
         if self._eventloop:
@@ -579,6 +701,8 @@ class UDPRelay(object):
         self._eventloop.add(server_socket,
                             eventloop.POLL_IN | eventloop.POLL_ERR, self)
         loop.add_periodic(self.handle_periodic)
+        self._flows.add_to_loop(loop)
+        self._timeout_cache.add_to_loop(loop)
 
     def remove_handler(self, client):
         if hash(client) in self._timeout_cache:
@@ -587,9 +711,6 @@ class UDPRelay(object):
     def update_activity(self, client):
         self._timeout_cache[hash(client)] = client
 
-    def _sweep_timeout(self):
-        self._timeout_cache.sweep()
-
     def _close_tcp_client(self, client):
         if client.remote_address:
             logging.debug('timed out: %s:%d' %
@@ -600,6 +721,7 @@ class UDPRelay(object):
         client.destroy_local()
 
     def handle_event(self, sock, fd, event):
+        handle = True
         if sock == self._server_socket:
             if event & eventloop.POLL_ERR:
                 logging.error('UDP server_socket err')
@@ -618,18 +740,22 @@ class UDPRelay(object):
                 shell.print_exception(e)
                 if self._config['verbose']:
                     traceback.print_exc()
+            self._flush_server_socket()
         else:
             if sock:
                 handler = self._fd_to_handlers.get(fd, None)
                 if handler:
                     handler.handle_event(sock, event)
+                else:
+                    handle = False
             else:
                 logging.warn('poll removed fd')
+                handle = False
+        return handle
 
     def handle_periodic(self):
         if self._closed:
-            self._cache.clear(0)
-            self._cache_dns_client.clear(0)
+            self._flows.clear()
             if self._eventloop:
                 self._eventloop.remove_periodic(self.handle_periodic)
                 self._eventloop.remove(self._server_socket)
@@ -637,13 +763,6 @@ class UDPRelay(object):
                 self._server_socket.close()
                 self._server_socket = None
                 logging.info('closed UDP port %d', self._listen_port)
-        else:
-            before_sweep_size = len(self._sockets)
-            self._cache.sweep()
-            self._cache_dns_client.sweep()
-            if before_sweep_size != len(self._sockets):
-                logging.debug('UDP port %5d sockets %d' % (self._listen_port, len(self._sockets)))
-            self._sweep_timeout()
 
     def close(self, next_tick=False):
         logging.debug('UDP close')
@@ -653,5 +772,57 @@ class UDPRelay(object):
                 self._eventloop.remove_periodic(self.handle_periodic)
                 self._eventloop.remove(self._server_socket)
             self._server_socket.close()
-            self._cache.clear(0)
-            self._cache_dns_client.clear(0)
+            self._flows.clear()
+
+
+def test_flow_table():
+    closed = []
+    table = FlowTable(3, closed.append)
+    socks = [socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+             for i in range(6)]
+
+    def add(i, is_dns=False, timeout=60):
+        return table.add(('127.0.0.1', i, socket.AF_INET),
+                         ('127.0.0.1', i), socket.AF_INET, socks[i], None,
+                         is_dns, timeout)
+
+    try:
+        flows = [add(0), add(1), add(2)]
+        # touched by get and get_by_fd, so 2 is the least recently used
+        assert table.get(('127.0.0.1', 0, socket.AF_INET)) is flows[0]
+        assert table.get_by_fd(socks[1].fileno()) is flows[1]
+        assert table.get_by_fd(socks[5].fileno()) is None
+        # a DNS flow counts against the same limit
+        dns = add(3, is_dns=True, timeout=DNS_FLOW_TIMEOUT)
+        assert closed == [flows[2]] and len(table) == 3
+        assert table.get_by_fd(socks[2].fileno()) is None
+        add(4)
+        assert closed == [flows[2], flows[0]]
+        assert dns.key in table
+
+        # timers, on the loop clock
+        loop = eventloop.EventLoop()
+        table.add_to_loop(loop)
+        assert table._clock == loop.time
+        del closed[:]
+        table.remove(dns)
+        short = add(5, timeout=0.4)
+        touched = table.get_by_fd(socks[1].fileno())
+        touched.timeout = 0.4
+        touched.timer.cancel()
+        table._add_timer(touched, 0.4)
+        loop.call_later(0.3, table.get_by_fd, socks[1].fileno())
+        loop.call_later(0.6, table.get_by_fd, socks[1].fileno())
+        loop.call_later(0.9, loop.stop)
+        loop.run()
+        assert closed == [short]
+        assert touched.key in table and len(table) == 2
+        table.clear()
+        assert len(table) == 0 and len(closed) == 3
+    finally:
+        for sock in socks:
+            sock.close()
+
+
+if __name__ == '__main__':
+    test_flow_table()